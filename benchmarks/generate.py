@@ -0,0 +1,164 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+generate.py
+
+Builds synthetic image libraries to benchmark against: nested directories
+of EXIF dated JPEG and PNG files from a few bytes over the header to many
+megabytes, with byte identical duplicates and renamed copies at set ratios.
+
+Every file is one of a few small rendered images padded after its end of
+image marker with random bytes, so files are still readable images but
+each has its own hash and the size asked for.
+"""
+import argparse
+from datetime import datetime, timedelta
+import io
+import json
+import os
+import random
+import shutil
+
+from PIL import Image
+
+# Distinct images rendered, the rest of every file is random padding
+TEMPLATES = 8
+DATE_TIME_ORIGINAL = 36867
+DATE_TIME = 306
+EXIF_IFD = 0x8769
+
+class LibrarySpec:
+    """The shape of a synthetic library"""
+    def __init__(self, files: int = 1000, median_size: int = 256 * 1024,
+                 tiny_ratio: float = 0.05, huge_ratio: float = 0.01,
+                 huge_size: int = 32 * 1024 * 1024, png_ratio: float = 0.2,
+                 duplicate_ratio: float = 0.1, depth: int = 3, seed: int = 0):
+        self.files = files
+        self.median_size = median_size
+        self.tiny_ratio = tiny_ratio
+        self.huge_ratio = huge_ratio
+        self.huge_size = huge_size
+        self.png_ratio = png_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.depth = depth
+        self.seed = seed
+
+def render(rnd: random.Random, format: str, taken: datetime) -> bytes:
+    """returns a small image carrying the date taken in its EXIF"""
+    image = Image.new('RGB', (64, 48), tuple(rnd.randrange(256) for _ in range(3)))
+    image.putdata([tuple(rnd.randrange(256) for _ in range(3)) for _ in range(64 * 48)])
+    exif = Image.Exif()
+    exif[DATE_TIME] = taken.strftime('%Y:%m:%d %H:%M:%S')
+    exif.get_ifd(EXIF_IFD)[DATE_TIME_ORIGINAL] = taken.strftime('%Y:%m:%d %H:%M:%S')
+    buf = io.BytesIO()
+    image.save(buf, format, exif=exif)
+    return buf.getvalue()
+
+def file_size(rnd: random.Random, spec: LibrarySpec) -> int:
+    """returns a size drawn from the mix of tiny, typical and huge files"""
+    draw = rnd.random()
+    if draw < spec.tiny_ratio:
+        return 0 # just the rendered image, a few KB
+    if draw < spec.tiny_ratio + spec.huge_ratio:
+        return spec.huge_size
+    # camera files cluster around a size with a long tail
+    return int(rnd.lognormvariate(0, 0.5) * spec.median_size)
+
+def write_file(path: str, header: bytes, size: int, rnd: random.Random):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(header)
+        remaining = max(0, size - len(header))
+        while remaining:
+            chunk = min(remaining, 1024 * 1024)
+            f.write(rnd.randbytes(chunk))
+            remaining -= chunk
+
+def generate_library(root: str, spec: LibrarySpec) -> dict:
+    """writes a library to root and returns a summary of what is in it"""
+    rnd = random.Random(spec.seed)
+    start = datetime(2010, 1, 1)
+    templates = {format: [render(rnd, format, start + timedelta(days=rnd.randrange(5000)))
+                          for _ in range(TEMPLATES)]
+                 for format in ('JPEG', 'PNG')}
+    written, total_bytes, duplicates = [], 0, 0
+    for n in range(spec.files):
+        dirs = [f'{rnd.choice(["event", "trip", "album", "misc"])}-{rnd.randrange(20)}'
+                for _ in range(rnd.randrange(spec.depth + 1))]
+        if written and rnd.random() < spec.duplicate_ratio:
+            original = rnd.choice(written)
+            path = os.path.join(root, *dirs, f'copy-{n}{os.path.splitext(original)[1]}')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(original, path)
+            duplicates += 1
+        else:
+            format = 'PNG' if rnd.random() < spec.png_ratio else 'JPEG'
+            ext = '.png' if format == 'PNG' else '.jpg'
+            path = os.path.join(root, *dirs, f'IMG_{n:06d}{ext}')
+            write_file(path, rnd.choice(templates[format]), file_size(rnd, spec), rnd)
+            written.append(path)
+        total_bytes += os.path.getsize(path)
+    return {'files': spec.files, 'bytes': total_bytes, 'duplicates': duplicates}
+
+def derive_target(reference: str, target: str, duplicate_ratio: float = 0.3,
+                  rename_ratio: float = 0.1, seed: int = 0) -> dict:
+    """writes a second library sharing files with reference, some under the
+       same name, some renamed and the rest modified, to dedupe against it"""
+    rnd = random.Random(seed)
+    counts = {'files': 0, 'bytes': 0, 'duplicates': 0, 'renames': 0, 'modified': 0}
+    for root, _, files in os.walk(reference):
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            src = os.path.join(root, name)
+            rel_name = os.path.relpath(src, reference)
+            draw = rnd.random()
+            if draw < duplicate_ratio:
+                dest, kind = os.path.join(target, rel_name), 'duplicates'
+            elif draw < duplicate_ratio + rename_ratio:
+                dest, kind = os.path.join(target, os.path.dirname(rel_name), f'renamed-{name}'), 'renames'
+            else:
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(src, dest)
+            if kind == 'duplicates' and rnd.random() < 0.1:
+                with open(dest, 'ab') as f:
+                    f.write(rnd.randbytes(16)) # same name, different content
+                kind = 'modified'
+            counts[kind] += 1
+            counts['files'] += 1
+            counts['bytes'] += os.path.getsize(dest)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description='generate a synthetic image library')
+    parser.add_argument('output', help='directory to create the library in')
+    parser.add_argument('-n', '--files', type=int, default=1000)
+    parser.add_argument('--median-size', type=int, default=256 * 1024)
+    parser.add_argument('--huge-size', type=int, default=32 * 1024 * 1024)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    spec = LibrarySpec(files=args.files, median_size=args.median_size,
+                       huge_size=args.huge_size, duplicate_ratio=args.duplicate_ratio,
+                       seed=args.seed)
+    print(json.dumps(generate_library(args.output, spec)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+run.py
+
+Runs each command end to end against a synthetic library, see generate.py,
+in a fresh interpreter and reports its throughput, peak memory and I/O.
+Results are saved as JSON to compare runs across commits:
+
+    python -m benchmarks.run -n 2000 -j 4
+    python -m benchmarks.run --compare benchmarks/results/<earlier>.json
+
+I/O counts come from /proc/self/io so are only reported on Linux, where
+syscalls counts the read and write calls made.
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.generate import LibrarySpec, derive_target, generate_library
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+# runs the cli in the child and writes what it cost to the file named first
+CHILD = """
+import json, os, resource, sys, time
+from imagectl.__main__ import main
+out = sys.argv.pop(1)
+start = time.perf_counter()
+status = 0
+try:
+    main(sys.argv[1:])
+except SystemExit as exit:
+    status = exit.code or 0
+elapsed = time.perf_counter() - start
+usage = resource.getrusage(resource.RUSAGE_SELF)
+io = {}
+if os.path.exists('/proc/self/io'):
+    with open('/proc/self/io') as f:
+        io = {key: int(value) for key, value in (line.split(': ') for line in f)}
+with open(out, 'w') as f:
+    json.dump({'status': status, 'seconds': elapsed, 'peak_rss_kb': usage.ru_maxrss,
+               'user_seconds': usage.ru_utime, 'system_seconds': usage.ru_stime,
+               'context_switches': usage.ru_nvcsw + usage.ru_nivcsw,
+               'syscalls_read': io.get('syscr'), 'syscalls_write': io.get('syscw'),
+               'bytes_read': io.get('rchar'), 'bytes_written': io.get('wchar')}, f)
+"""
+
+def run_cli(args: list[str], files: int, size: int) -> dict:
+    """runs imagectl with args and returns its costs and throughput"""
+    with tempfile.NamedTemporaryFile(suffix='.json') as out:
+        proc = subprocess.run([sys.executable, '-c', CHILD, out.name] + args,
+                              capture_output=True, text=True)
+        if proc.returncode:
+            raise RuntimeError(f'imagectl {" ".join(args)} failed: {proc.stderr}')
+        with open(out.name) as f:
+            result = json.load(f)
+    result['files_per_second'] = files / result['seconds']
+    result['mb_per_second'] = size / 1e6 / result['seconds']
+    return result
+
+def remove_index(base: str):
+    for name in os.listdir(base):
+        if name.startswith('.imagectl'):
+            os.remove(os.path.join(base, name))
+
+def benchmarks(ref: str, trgt: str, out: str, jobs: int) -> list[tuple]:
+    """returns the name, setup and arguments of each benchmark in the order
+       they must run, as later ones rely on the index written earlier"""
+    cli = ['--no-cache']
+    jobs = ['-j', str(jobs)]
+    return [
+        ('index', lambda: remove_index(ref), cli + ['index', '-i', ref] + jobs),
+        ('index_incremental', None, cli + ['index', '-i', ref, '-u'] + jobs),
+        ('verify', None, cli + ['verify', '-i', ref] + jobs),
+        ('dedupe_content', None, cli + ['dedupe', '-c', '-r', ref]),
+        ('dedupe', lambda: remove_index(trgt), cli + ['dedupe', '-r', ref, '-t', trgt]),
+        ('organise', lambda: shutil.rmtree(out, ignore_errors=True),
+         cli + ['organise', '-i', ref, '-o', out] + jobs),
+    ]
+
+def git_commit() -> str | None:
+    proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                          capture_output=True, text=True)
+    return proc.stdout.strip() or None
+
+def compare(base: dict, current: dict):
+    """prints the change in throughput of each benchmark since base"""
+    for name, result in current['results'].items():
+        before = base['results'].get(name)
+        if before is None:
+            continue
+        change = result['files_per_second'] / before['files_per_second'] - 1
+        print(f"{name:20} {before['files_per_second']:10.1f} -> "
+              f"{result['files_per_second']:10.1f} files/s ({change:+.1%}), "
+              f"peak rss {before['peak_rss_kb'] // 1024} -> {result['peak_rss_kb'] // 1024} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark imagectl commands')
+    parser.add_argument('-n', '--files', type=int, default=1000,
+                        help='files in the generated library (default: %(default)s)')
+    parser.add_argument('--median-size', type=int, default=256 * 1024,
+                        help='median file size in bytes (default: %(default)s)')
+    parser.add_argument('--huge-size', type=int, default=32 * 1024 * 1024,
+                        help='size of the largest files in bytes (default: %(default)s)')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1,
+                        help='fraction of files copied within the library (default: %(default)s)')
+    parser.add_argument('--rename-ratio', type=float, default=0.1,
+                        help='fraction of files copied to the target renamed (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='jobs for the commands that take them (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='runs of each benchmark, the fastest is kept (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='where to generate libraries (default: a temporary directory)')
+    parser.add_argument('-o', '--output', help='results file (default: in benchmarks/results)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='imagectl-bench-')
+    ref, trgt, out = (os.path.join(workdir, name) for name in ('reference', 'target', 'organised'))
+    spec = LibrarySpec(files=args.files, median_size=args.median_size,
+                       huge_size=args.huge_size, duplicate_ratio=args.duplicate_ratio,
+                       seed=args.seed)
+    try:
+        if not os.path.isdir(ref):
+            library = generate_library(ref, spec)
+            target = derive_target(ref, trgt, rename_ratio=args.rename_ratio, seed=args.seed)
+        else: # reuse a library generated by an earlier run
+            library = {'files': args.files, 'bytes': sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, files in os.walk(ref) for name in files if name[0] != '.')}
+            target = {}
+        print(f"library: {library['files']} files, {library['bytes'] / 1e6:.1f} MB", file=sys.stderr)
+
+        results = {}
+        for name, setup, cli_args in benchmarks(ref, trgt, out, args.jobs):
+            runs = []
+            for _ in range(args.repeat):
+                if setup is not None:
+                    setup()
+                runs.append(run_cli(cli_args, library['files'], library['bytes']))
+            results[name] = min(runs, key=lambda run: run['seconds'])
+            print(f"{name:20} {results[name]['files_per_second']:10.1f} files/s "
+                  f"{results[name]['mb_per_second']:8.1f} MB/s "
+                  f"peak rss {results[name]['peak_rss_kb'] // 1024} MB", file=sys.stderr)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'commit': git_commit(), 'date': datetime.now().isoformat(),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'jobs': args.jobs, 'spec': vars(spec),
+              'library': library, 'target': target, 'results': results}
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%dT%H%M%S}-{report['commit']}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results written to {output}', file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
@@ -17,28 +17,41 @@
 #
 ###############################################################################
 import argparse
-import hashlib
 import importlib
-import inspect
 import logging
+import os
 import sys
+from typing import TYPE_CHECKING
 
-import imagectl.cmds
-from imagectl.api import ImageCommand, ImageCommandOptions
+from imagectl.cmds import COMMANDS
 from imagectl.constants import TOOL
+from imagectl.metrics import (DEFAULT_PROGRESS_INTERVAL, ProgressReporter, current_metrics,
+                              reset_metrics)
+
+if TYPE_CHECKING:
+    from imagectl.api import ImageCommand, ImageCommandOptions
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
-commands: dict
 
-def get_hash(in_file: str) -> str:
-    """returns the hash of the specified file"""
-    with open(in_file, 'rb') as f:
-        hasher = hashlib.md5()
-        hasher.update(f.read())
-        in_hash=hasher.hexdigest()
-        logger.debug('hash of %s is %s', in_file, in_hash)
-    return in_hash
+def __getattr__(name):
+    # importing hashing here would slow every start up for the few callers
+    # that still expect get_hash from this module
+    if name == 'get_hash':
+        from imagectl.hashing import get_hash
+        return get_hash
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class CommandRegistry(dict):
+    """commands by name, each imported the first time it is used"""
+    def __missing__(self, name: str) -> 'ImageCommand':
+        if name not in COMMANDS:
+            raise KeyError(name)
+        # a command run from another needs no place in the main parser
+        self[name] = load_command(name, argparse.ArgumentParser().add_subparsers())
+        return self[name]
+
+commands = CommandRegistry()
 
 def init_logging(args): 
     """initialise logging system"""
@@ -48,23 +61,53 @@ def init_logging(args):
     logger.setLevel(args.verbose)
     logger.info("log verbosity set to %s", args.verbose)
 
-def register_commands(parser):
-    """locate and instantiate all the commands available"""
+def add_global_arguments(parser):
+    """adds the options accepted before the command name"""
+    parser.add_argument("-v", "--verbose", help="increase output verbosity")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not read or update the persistent hash cache")
+    parser.add_argument("--progress", action="store_true",
+                        help="report the rate and time left every so often")
+    parser.add_argument("--progress-interval", type=float, metavar="SECONDS",
+                        help="seconds between progress reports, implies --progress "
+                             f"(default: {DEFAULT_PROGRESS_INTERVAL})")
+    parser.add_argument("--metrics-out", metavar="PATH",
+                        help="write the time spent in each stage to PATH when done, "
+                             "in the Prometheus text format if it ends .prom or else JSON")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the command with cProfile, writing the stats "
+                             "alongside the metrics or to imagectl-COMMAND.prof")
+
+def load_command(name: str, subparsers) -> 'ImageCommand':
+    """imports and instantiates a single command"""
+    info = COMMANDS[name]
+    logger.info('importing %s from %s', info.class_name, info.module)
+    module = importlib.import_module('imagectl.cmds.' + info.module)
+    return getattr(module, info.class_name)(subparsers)
+
+def selected_command(argv: list[str] | None = None) -> str | None:
+    """returns the command named on the command line, if any"""
+    parser = argparse.ArgumentParser(add_help=False)
+    add_global_arguments(parser)
+    parser.add_argument("command", nargs='?')
+    args, _ = parser.parse_known_args(argv)
+    return args.command
+
+def register_commands(parser, selected: str | None = None) -> CommandRegistry:
+    """adds every command to the parser but only imports the selected one,
+       the others need nothing more than a name and help to be listed"""
     logger.info('registering commands')
 
     cmd_parsers = parser.add_subparsers(dest='command')
-    commands = {}
-    for mod_name in imagectl.cmds.__all__:
-        logger.info('importing commands from %s', mod_name)
-        module = importlib.import_module('imagectl.cmds.'+mod_name)
-        for _, clazz in inspect.getmembers(module, inspect.isclass):
-            if issubclass(clazz, ImageCommand) and not inspect.isabstract(clazz):
-                logger.info('  registering %s', clazz)
-                cmd = clazz(cmd_parsers)
-                commands[cmd.NAME] = cmd
-    return commands
-
-def exec_cmd(cmd: str, options: ImageCommandOptions):
+    registered = CommandRegistry()
+    for name, info in COMMANDS.items():
+        if name == selected:
+            registered[name] = load_command(name, cmd_parsers)
+        else:
+            cmd_parsers.add_parser(name, help=info.help)
+    return registered
+
+def exec_cmd(cmd: str, options: 'ImageCommandOptions'):
     try:
         commands[cmd].execute(options)
     except ValueError as err:
@@ -72,23 +115,64 @@ def exec_cmd(cmd: str, options: ImageCommandOptions):
         commands[cmd].cmd.print_help(sys.stderr)
         sys.exit(1)
 
-def main():
+def profile_path(args) -> str:
+    """returns where to write the profile of a command"""
+    if args.metrics_out is not None:
+        return os.path.splitext(args.metrics_out)[0] + '.prof'
+    return f'imagectl-{args.command}.prof'
+
+def progress_interval(args) -> float | None:
+    """returns the seconds between progress reports, or None for none"""
+    if args.progress_interval is not None:
+        return args.progress_interval
+    return DEFAULT_PROGRESS_INTERVAL if args.progress else None
+
+def run_instrumented(args):
+    """runs the command, reporting progress, and then writes its metrics and
+       profile if asked to"""
+    reset_metrics()
+    profiler = None
+    if args.profile:
+        import cProfile
+        # only the main thread is profiled, use --jobs 1 to see the workers
+        profiler = cProfile.Profile()
+    try:
+        with ProgressReporter(args.command, progress_interval(args)):
+            if profiler is None:
+                exec_cmd(args.command, args)
+            else:
+                profiler.runcall(exec_cmd, args.command, args)
+    finally:
+        metrics = current_metrics()
+        for line in metrics.summary():
+            logger.info(line)
+        if args.metrics_out is not None:
+            metrics.write(args.metrics_out, args.command)
+        if profiler is not None:
+            profiler.dump_stats(profile_path(args))
+            logger.warning('profile written to %s', profile_path(args))
+
+def main(argv: list[str] | None = None):
     '''Main entry point'''
 
     parser = argparse.ArgumentParser(prog=TOOL.get("name"))
-    parser.add_argument("-v", "--verbose", help="increase output verbosity")
+    add_global_arguments(parser)
     parser._positionals.title = "commands"
 
     global commands
-    commands = register_commands(parser)
-    args = parser.parse_args()
+    commands = register_commands(parser, selected_command(argv))
+    args = parser.parse_args(argv)
     init_logging(args)
+    if args.no_cache:
+        # sqlite3 is only loaded by the commands that hash
+        from imagectl import hashcache
+        hashcache.configure(enabled=False)
 
     if args.command is None:
         parser.print_help(sys.stderr)
         sys.exit(1)
     else:
-        exec_cmd(args.command, args)
+        run_instrumented(args)
 
-if __name__ == "main":
-    main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
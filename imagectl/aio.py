@@ -0,0 +1,155 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+aio.py
+
+An asyncio engine for libraries on network storage, where each listing,
+stat and open is a round trip. Blocking calls run on a thread pool while
+the event loop keeps up to io_depth of each kind in flight, so throughput
+is bounded by bandwidth rather than by the latency of each call.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, TypeVar
+
+from imagectl.constants import DEFAULT_IO_DEPTH, valid_extensions
+from imagectl.metrics import current_metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# Items started per unit of io_depth before results must be consumed
+QUEUE_DEPTH = 4
+
+def _list_dir(path: str) -> tuple[list[str], list[str]]:
+    """returns the child directories and images of path, the type of each
+       coming with the listing so nothing is statted"""
+    dirs, files = [], []
+    with current_metrics().stage('walk'), os.scandir(path) as it:
+        for entry in it:
+            # as os.walk, links to directories are not followed
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.path)
+            elif entry.name[0] == '.':
+                continue # ignore hidden files, but not hidden directories
+            elif any(entry.name.lower().endswith(ext) for ext in valid_extensions):
+                files.append(entry.path)
+    return dirs, files
+
+def _stat(path: str) -> os.stat_result:
+    with current_metrics().stage('stat'):
+        return os.stat(path)
+
+class AsyncEngine:
+    """Runs blocking file operations with a limit on each kind in flight"""
+    def __init__(self, io_depth: int = DEFAULT_IO_DEPTH):
+        if io_depth < 1:
+            raise ValueError("IO depth must be at least 1")
+        self.io_depth = io_depth
+        # enough threads for every kind of operation to be at its limit
+        self.executor = ThreadPoolExecutor(max_workers=3 * io_depth, thread_name_prefix='aio')
+        self.listing = asyncio.Semaphore(io_depth)
+        self.statting = asyncio.Semaphore(io_depth)
+        self.reading = asyncio.Semaphore(io_depth)
+
+    async def run(self, limit: asyncio.Semaphore, fn: Callable[..., R], *args) -> R:
+        """runs fn(*args) on the thread pool once limit allows"""
+        async with limit:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def stat(self, path: str) -> os.stat_result:
+        return await self.run(self.statting, _stat, path)
+
+    async def read(self, fn: Callable[..., R], *args) -> R:
+        """runs fn, which reads file content, on the thread pool"""
+        return await self.run(self.reading, fn, *args)
+
+    async def walk(self, base: str) -> AsyncIterator[tuple[str, str]]:
+        """yields the qualified and relative names of every image below base,
+           listing up to io_depth directories at a time"""
+        loop = asyncio.get_running_loop()
+        pending = {loop.create_task(self.run(self.listing, _list_dir, base))}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    dirs, files = task.result()
+                except OSError as e:
+                    # as os.walk, one unreadable directory does not stop the walk
+                    logger.warning('cannot list %s', e)
+                    continue
+                pending.update(loop.create_task(self.run(self.listing, _list_dir, path))
+                               for path in dirs)
+                for path in files:
+                    yield path, path[len(base) + 1:]
+
+    async def map(self, fn: Callable[..., Awaitable[R]],
+                  items: AsyncIterable[tuple]) -> AsyncIterator[R]:
+        """yields fn(*item) for each item as each completes, starting more
+           only while fewer than io_depth * QUEUE_DEPTH are unfinished"""
+        loop = asyncio.get_running_loop()
+        pending = set()
+        async for item in items:
+            pending.add(loop.create_task(fn(*item)))
+            if len(pending) >= self.io_depth * QUEUE_DEPTH:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    async def ordered_map(self, fn: Callable[..., Awaitable[R]],
+                          items: AsyncIterable[tuple]) -> AsyncIterator[R]:
+        """yields fn(*item) for each item in input order, starting more only
+           while fewer than io_depth * QUEUE_DEPTH are unfinished or waiting
+           on an earlier item"""
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        async for item in items:
+            pending.append(loop.create_task(fn(*item)))
+            if len(pending) >= self.io_depth * QUEUE_DEPTH:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+
+    def close(self):
+        self.executor.shutdown()
+
+async def aiter_sync(items) -> AsyncIterator:
+    """returns an async iterator over an ordinary iterable"""
+    for item in items:
+        yield item
+
+def run(main: Callable[[AsyncEngine], Awaitable[T]], io_depth: int = DEFAULT_IO_DEPTH) -> T:
+    """runs main with a new engine on a new event loop"""
+    async def with_engine():
+        engine = AsyncEngine(io_depth)
+        try:
+            return await main(engine)
+        finally:
+            engine.close()
+    return asyncio.run(with_engine())
@@ -0,0 +1,270 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+binindex.py
+
+A compact binary index format that is memory mapped rather than parsed.
+The file is a header, fixed width records sorted by name and a table of
+the UTF-8 names they point into:
+
+    header   magic, digest size, record count
+    records  digest, flags, size, created ns, modified ns,
+             name offset and length, phash offset and length,
+             width, height, orientation, date taken offset and length,
+             camera model offset and length
+    strings  names, perceptual hashes, dates taken and camera models
+
+Indexes written before the metadata was recorded, version 1, are still
+read, their entries have no metadata.
+
+Entries are decoded field by field as they are accessed, so opening an
+index costs the same whatever its size and lookups by name are a binary
+search of the mapped records.
+"""
+from datetime import datetime, timedelta
+from hmac import compare_digest
+import mmap
+import os
+import struct
+from typing import Iterable, Iterator
+
+from imagectl.hashing import algorithm_for_digest, get_hash
+from imagectl.models import IndexEntry, iso_to_us, same_time, wall_clock
+
+MAGIC_V1 = b'IMGCTLB1'
+MAGIC = b'IMGCTLB2'
+HEADER = struct.Struct('<8sIQ')
+HAS_HASH = 1
+
+def _record(digest_size: int, magic: bytes = MAGIC) -> struct.Struct:
+    if magic == MAGIC_V1:
+        return struct.Struct(f'<{digest_size}sBqqqQIQI')
+    return struct.Struct(f'<{digest_size}sBqqqQIQIIIHQIQI')
+
+def ns_to_iso(ns: int) -> str:
+    """returns the index timestamp of a time in nanoseconds since the epoch"""
+    seconds, remainder = divmod(ns, 1_000_000_000)
+    return (datetime.fromtimestamp(seconds) + timedelta(microseconds=remainder // 1000)).isoformat()
+
+class BinaryEntry:
+    """A read only view of one record, with the attributes and methods of
+       IndexEntry that the commands use"""
+    __slots__ = ('_index', '_fields')
+
+    def __init__(self, index: "BinaryIndex", position: int):
+        self._index = index
+        self._fields = index._record.unpack_from(index._map, index._offset(position))
+
+    @property
+    def name(self) -> str:
+        return self._index._string(self._fields[5], self._fields[6])
+
+    @property
+    def hash(self) -> str:
+        return self._fields[0].hex() if self._fields[1] & HAS_HASH else ''
+
+    @property
+    def size(self) -> int:
+        return self._fields[2]
+
+    @property
+    def created_ns(self) -> int:
+        return self._fields[3]
+
+    @property
+    def modified_ns(self) -> int:
+        return self._fields[4]
+
+    @property
+    def created(self) -> str:
+        return ns_to_iso(self._fields[3])
+
+    @property
+    def modified(self) -> str:
+        return ns_to_iso(self._fields[4])
+
+    @property
+    def phash(self) -> str | None:
+        return self._index._string(self._fields[7], self._fields[8]) or None
+
+    def _metadata(self, field: int) -> int | None:
+        # zero is never a valid width, height or orientation
+        return self._fields[field] or None if len(self._fields) > field else None
+
+    @property
+    def width(self) -> int | None:
+        return self._metadata(9)
+
+    @property
+    def height(self) -> int | None:
+        return self._metadata(10)
+
+    @property
+    def orientation(self) -> int | None:
+        return self._metadata(11)
+
+    @property
+    def taken(self) -> str | None:
+        if len(self._fields) <= 12:
+            return None
+        return self._index._string(self._fields[12], self._fields[13]) or None
+
+    @property
+    def model(self) -> str | None:
+        if len(self._fields) <= 14:
+            return None
+        return self._index._string(self._fields[14], self._fields[15]) or None
+
+    def has_metadata(self) -> bool:
+        return any(value is not None for value in
+                   (self.taken, self.width, self.height, self.model, self.orientation))
+
+    def stat_matches(self, st: os.stat_result) -> bool:
+        return (self.size == st.st_size \
+                and self._same_time(self.modified_ns, st.st_mtime_ns) \
+                and self._same_time(self.created_ns, st.st_ctime_ns))
+
+    @staticmethod
+    def _same_time(indexed_ns: int, ns: int) -> bool:
+        # times converted from the index's local times may be an hour out
+        # in the hour repeated when daylight saving ends
+        return abs(indexed_ns // 1000 - ns // 1000) <= 1 \
+               or same_time(wall_clock(indexed_ns), ns)
+
+    def matches(self, qual_name: str) -> bool:
+        return self.stat_matches(os.stat(qual_name))
+
+    def same_stat(self, other) -> bool:
+        return (self.size == other.size \
+                and self.created == other.created \
+                and self.modified == other.modified)
+
+    def hash_matches(self, qual_name: str, use_cache: bool = True) -> bool:
+        digest = get_hash(qual_name, algorithm_for_digest(self.hash), use_cache=use_cache)
+        return compare_digest(self.hash, digest)
+
+    def to_entry(self) -> IndexEntry:
+        return IndexEntry(name=self.name, created=self.created, modified=self.modified,
+                          size=self.size, hash=self.hash, phash=self.phash,
+                          taken=self.taken, width=self.width, height=self.height,
+                          model=self.model, orientation=self.orientation)
+
+    def model_dump(self) -> str:
+        return self.to_entry().model_dump()
+
+class BinaryIndex:
+    """A memory mapped binary index file"""
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, digest_size, self._count = HEADER.unpack_from(self._map, 0)
+        if magic not in (MAGIC, MAGIC_V1):
+            self._map.close()
+            raise ValueError(f'{path} is not a binary index')
+        self._record = _record(digest_size, magic)
+        self._strings = HEADER.size + self._count * self._record.size
+
+    def _offset(self, position: int) -> int:
+        return HEADER.size + position * self._record.size
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self._strings + offset
+        return self._map[start:start + length].decode('utf-8')
+
+    def _name_bytes(self, position: int) -> bytes:
+        fields = self._record.unpack_from(self._map, self._offset(position))
+        start = self._strings + fields[5]
+        return self._map[start:start + fields[6]]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, position: int) -> BinaryEntry:
+        if not 0 <= position < self._count:
+            raise IndexError(position)
+        return BinaryEntry(self, position)
+
+    def __iter__(self) -> Iterator[BinaryEntry]:
+        return (BinaryEntry(self, i) for i in range(self._count))
+
+    def _lower_bound(self, key: bytes) -> int:
+        """returns the position of the first name not less than key"""
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._name_bytes(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def get(self, name: str) -> BinaryEntry | None:
+        """binary search for the entry with name"""
+        key = name.encode('utf-8')
+        position = self._lower_bound(key)
+        if position < self._count and self._name_bytes(position) == key:
+            return BinaryEntry(self, position)
+        return None
+
+    def with_prefix(self, prefix: str) -> Iterator[BinaryEntry]:
+        """yields the entries whose names start with prefix, in name order"""
+        key = prefix.encode('utf-8')
+        position = self._lower_bound(key)
+        while position < self._count and self._name_bytes(position).startswith(key):
+            yield BinaryEntry(self, position)
+            position += 1
+
+    def close(self):
+        self._map.close()
+
+def write_binary_index(path: str, entries: Iterable):
+    """writes entries sorted by name, replacing path atomically"""
+    rows = []
+    strings = bytearray()
+    digest_size = None
+    for entry in entries:
+        digest = bytes.fromhex(entry.hash) if entry.hash else b''
+        if digest:
+            if digest_size is None:
+                digest_size = len(digest)
+            elif len(digest) != digest_size:
+                raise ValueError('all hashes in a binary index must use the same algorithm')
+        name = entry.name.encode('utf-8')
+        phash = (entry.phash or '').encode('utf-8')
+        rows.append((name, digest, entry.size, iso_to_us(entry.created) * 1000,
+                     iso_to_us(entry.modified) * 1000, phash,
+                     entry.width or 0, entry.height or 0, entry.orientation or 0,
+                     (entry.taken or '').encode('utf-8'), (entry.model or '').encode('utf-8')))
+    rows.sort(key=lambda row: row[0])
+    digest_size = digest_size or 16
+    record = _record(digest_size)
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, digest_size, len(rows)))
+        for (name, digest, size, created, modified, phash,
+             width, height, orientation, taken, model) in rows:
+            offsets = []
+            for value in (name, phash, taken, model):
+                offsets += [len(strings), len(value)]
+                strings += value
+            out.write(record.pack(digest, HAS_HASH if digest else 0, size, created, modified,
+                                  *offsets[:4], width, height, orientation, *offsets[4:]))
+        out.write(strings)
+    os.replace(tmp, path)
@@ -16,7 +16,36 @@
 # Command line client for managing an image library.
 #
 ###############################################################################
-from os.path import dirname, basename, isfile, join
-import glob
-modules = glob.glob(join(dirname(__file__), "*.py"))
-__all__ = [ basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
+"""
+The commands available and just enough about each to list them in the help
+without importing the module that implements them.
+"""
+from typing import NamedTuple
+
+class CommandInfo(NamedTuple):
+    """Where a command is implemented and its one line help"""
+    module: str
+    class_name: str
+    help: str
+
+COMMANDS = {
+    'compare': CommandInfo('compare', 'CompareCommand',
+                           'compare two indexed image libraries, reading only what differs'),
+    'convert': CommandInfo('convert', 'ConvertCommand',
+                           'import or export an index between storage formats'),
+    'dedupe': CommandInfo('dedupe', 'DedupeCommand',
+                          'identify duplicates between 2 image libraries'),
+    'diff': CommandInfo('diff', 'DiffCommand',
+                        'plan bringing one image library up to date with another from their indexes'),
+    'index': CommandInfo('index', 'IndexCommand', 'index an image library'),
+    'organise': CommandInfo('organise', 'OrganiserCommand',
+                            'organise images in a standard structure'),
+    'serve': CommandInfo('serve', 'ServeCommand',
+                         'answer queries against indexes held in memory over a local socket'),
+    'similar': CommandInfo('similar', 'SimilarCommand',
+                           'find near duplicate images using perceptual hashes'),
+    'verify': CommandInfo('verify', 'VerifyCommand', 'verify images against index'),
+    'watch': CommandInfo('watch', 'WatchCommand',
+                         'keep the index current as images are added, changed or removed'),
+}
+__all__ = sorted({info.module for info in COMMANDS.values()})
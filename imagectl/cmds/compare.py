@@ -0,0 +1,76 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+import logging
+
+from imagectl.api import ImageCommand, ImageCommandOptions
+from imagectl.cmds import COMMANDS
+from imagectl.merkle import DIFFERENT, EXTRA, MISSING, diff_trees, load_tree
+from imagectl.metrics import current_metrics
+from imagectl.storage import open_store
+
+logger = logging.getLogger(__name__)
+
+class CompareCommand(ImageCommand):
+    """Command to compare two indexed image libraries"""
+    NAME = 'compare'
+    def __init__(self, subparsers):
+        super().__init__(self)
+        self.cmd = subparsers.add_parser(self.NAME,
+                   help=COMMANDS[self.NAME].help)
+        self.cmd.add_argument("-i", "--input", help="base image directory")
+        self.cmd.add_argument("-t", "--target", help="image directory to compare with, e.g. a backup")
+        self.cmd.add_argument("-d", "--directory", default='',
+                              help="compare only below this directory of both (default: all)")
+
+    def execute(self, options: ImageCommandOptions):
+        logger.setLevel(options.verbose)
+        if options.input is None or options.target is None:
+            raise ValueError("Both input and target collections must be specified")
+        logger.info("comparing %s with %s", options.input, options.target)
+
+        with open_store(options.input) as left, open_store(options.target) as right:
+            for store in (left, right):
+                if not store.exists():
+                    raise ValueError(f"No index found at {store.path}, index the collection first")
+            left_tree, right_tree = load_tree(left), load_tree(right)
+            if left_tree.algorithm and right_tree.algorithm \
+                    and left_tree.algorithm != right_tree.algorithm:
+                raise ValueError(f"Indexes use different hash algorithms, {left_tree.algorithm} "
+                                 f"and {right_tree.algorithm}, reindex one with -a")
+
+            counts = {MISSING: 0, EXTRA: 0, DIFFERENT: 0}
+            for difference in diff_trees(left_tree, right_tree, left, right,
+                                         options.directory.strip('/')):
+                counts[difference.kind] += difference.count
+                path = difference.path
+                if path.endswith('/'):
+                    path = f'{path} ({difference.count} images)'
+                if difference.kind == MISSING:
+                    logger.warning('...%s is missing from the target', path)
+                elif difference.kind == EXTRA:
+                    logger.warning('...%s is only in the target', path)
+                else:
+                    logger.warning('...%s is different in the target', difference.path)
+
+        read = current_metrics().stages.get('compare')
+        logger.warning("compared %s with %s: %d missing, %d extra, %d different, "
+                       "%d of %d directories read",
+                       options.input, options.target, counts[MISSING], counts[EXTRA],
+                       counts[DIFFERENT], 0 if read is None else read.count,
+                       len(left_tree.dirs))
@@ -0,0 +1,52 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+import logging
+
+from imagectl.api import ImageCommand, ImageCommandOptions
+from imagectl.cmds import COMMANDS
+from imagectl.storage import BACKENDS, open_store
+
+logger = logging.getLogger(__name__)
+
+class ConvertCommand(ImageCommand):
+    """Command to copy an index between storage backends"""
+    NAME = 'convert'
+    def __init__(self, subparsers):
+        super().__init__(self)
+        self.cmd = subparsers.add_parser(self.NAME,
+                   help=COMMANDS[self.NAME].help)
+        self.cmd.add_argument("-i", "--input", help="base image directory")
+        self.cmd.add_argument("-f", "--from", dest="source", choices=BACKENDS.keys(),
+                              help="storage to read (default: the existing index)")
+        self.cmd.add_argument("-t", "--to", dest="dest", choices=BACKENDS.keys(),
+                              help="storage to write")
+
+    def execute(self, options: ImageCommandOptions):
+        logger.setLevel(options.verbose)
+        if options.input is None or options.dest is None:
+            raise ValueError("Input collection and storage to write must be specified")
+
+        with open_store(options.input, options.source) as source, \
+                open_store(options.input, options.dest) as dest:
+            if not source.exists():
+                raise ValueError(f"No index found at {source.path}")
+            if source.path == dest.path:
+                raise ValueError("Index is already stored as " + options.dest)
+            logger.info("converting %s to %s", source.path, dest.path)
+            dest.write(source.entries())
@@ -19,16 +19,20 @@
 from datetime import datetime
 import logging
 import os
-from os.path import exists, join, splitext
-from shutil import move
+from os.path import abspath, basename, exists, join, splitext
 
-from pydantic_core import ValidationError
 from imagectl.__main__ import exec_cmd
 
 from imagectl.api import ImageCommand, ImageCommandOptions
-from imagectl.cmds.index import IndexCommandOptions
-from imagectl.constants import TOOL
-from imagectl.models import IndexEntry
+from imagectl.cmds import COMMANDS
+from imagectl.cmds.index import IndexCommandOptions, walk_library
+from imagectl.duplicates import Candidate, ContentIndex, find_duplicates
+from imagectl.hashing import get_hash
+from imagectl.metrics import current_metrics
+from imagectl.plan import (APPLIED, DELETE, FAILED, MOVE, RENAME, SKIPPED, Action,
+                           apply_plan, journal_path, read_plan, write_plan)
+from imagectl.storage import IndexStore, open_store
+from imagectl.transfer import LINK_MODES
 
 logger = logging.getLogger(__name__)
 
@@ -38,55 +42,194 @@ class DedupeCommand(ImageCommand):
     def __init__(self, subparsers):
         super().__init__(self)
         self.cmd = subparsers.add_parser(self.NAME,
-                   help='identify duplicates between 2 image libraries')
+                   help=COMMANDS[self.NAME].help)
         self.cmd.add_argument("-e", "--exec", action="store_true",
                                help="perform the recommended actions")
         self.cmd.add_argument("-r", "--reference", help="reference image directory")
         self.cmd.add_argument("-t", "--target", help="directory to search for duplicates")
+        self.cmd.add_argument("-l", "--link-mode", choices=LINK_MODES, default='auto',
+                               help="how to copy files moved between filesystems (default: %(default)s)")
+        self.cmd.add_argument("-c", "--content", action="store_true",
+                               help="match files by content regardless of name, "
+                                    "the target may be omitted to search only the reference")
+        self.cmd.add_argument("-C", "--collection", action="append", metavar="DIR",
+                               help="another collection to consolidate into the reference, "
+                                    "may be repeated, matching by the content in their indexes")
+        self.cmd.add_argument("-p", "--plan", metavar="FILE",
+                               help="write the recommended actions to FILE for review")
+        self.cmd.add_argument("-a", "--apply", metavar="FILE",
+                               help="perform the actions of a plan, resuming if it was interrupted")
+        self.cmd.add_argument("-j", "--jobs", type=int, default=4,
+                               help="number of directories to apply actions to in parallel "
+                                    "(default: %(default)s)")
 
     def execute(self, options: ImageCommandOptions):
         logger.setLevel(options.verbose)
-        if options.reference is None or options.target is None:
-            raise ValueError("Both reference and target collections must be specified")
+        if options.jobs < 1:
+            raise ValueError("Jobs must be at least 1")
+        if options.apply is not None:
+            header, actions = read_plan(options.apply)
+            logger.info("applying %d actions planned %s", len(actions), header.get('created'))
+            return self.apply(actions, options, journal_path(options.apply))
 
+        if options.collection:
+            if options.reference is None:
+                raise ValueError("Reference collection must be specified")
+            actions = self.plan_collections(options)
+        elif options.content is True:
+            if options.reference is None:
+                raise ValueError("Reference collection must be specified")
+            actions = self.plan_content(options)
+        else:
+            if options.reference is None or options.target is None:
+                raise ValueError("Both reference and target collections must be specified")
+            actions = self.plan_names(options)
+
+        if options.plan is not None:
+            count = write_plan(options.plan, actions, reference=options.reference,
+                               target=options.target, content=options.content,
+                               collections=options.collection)
+            logger.warning("%d actions written to %s", count, options.plan)
+        if options.exec is True:
+            self.apply(actions, options)
+
+    def apply(self, actions: list[Action], options: ImageCommandOptions, journal: str = None):
+        outcomes = apply_plan(actions, options.jobs, options.link_mode, journal)
+        logger.warning("applied %d actions, %d skipped, %d failed",
+                       outcomes[APPLIED], outcomes[SKIPPED], outcomes[FAILED])
+
+    def plan_names(self, options: ImageCommandOptions) -> list[Action]:
+        """returns the actions to remove target files that match a reference
+           file of the same name and move the others into the reference"""
         logger.info("searching %s\nfor files already in %s",
                     options.target, options.reference)
 
-        ref_idx = join(options.reference, f'.{TOOL.get("name")}')
-        if not exists(ref_idx):
-            exec_cmd('index', IndexCommandOptions(
-                input=options.reference, verbose=options.verbose))
-        with open(ref_idx, 'r') as index:
-            self.ref_entries = [IndexEntry.from_str(line)
-                                for line in index.readlines()]
-            self.ref_by_name = {entry.name: entry for entry in self.ref_entries}
-
-        trgt_idx = join(options.target, f'.{TOOL.get("name")}')
-        if not exists(trgt_idx):
-            exec_cmd('index', IndexCommandOptions(
-                input=options.target, verbose=options.verbose))
-        with open(trgt_idx, 'r') as index:
-            for line in index.readlines():
-                try:
-                    entry = IndexEntry.from_str(line)
-                    if entry.name in self.ref_by_name:
-                        ref = self.ref_by_name.get(entry.name)
-                        if entry.hash == ref.hash:
-                            logger.warning('...%s is matched, delete from target', entry.name)
-                            if options.exec is True:
-                                os.remove(join(options.target, entry.name))
-                        else:
-                            logger.warning('...%s is different in reference, target file must be renamed', entry.name)
-                            if options.exec is True:
-                                parts = splitext(entry.name)
-                                now = datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
-                                move(join(options.target, entry.name),
-                                    join(options.reference, f'{parts[0]}.{now}{parts[1]}'))
+        ref_store = self.open_index(options.reference, options.verbose)
+        trgt_store = self.open_index(options.target, options.verbose)
+        metrics = current_metrics()
+        actions = []
+        with ref_store, trgt_store:
+            metrics.expect(trgt_store.count())
+            for entry in trgt_store.entries():
+                metrics.progress()
+                source = abspath(join(options.target, entry.name))
+                ref = ref_store.get(entry.name)
+                if ref is not None:
+                    if entry.hash == ref.hash:
+                        logger.warning('...%s is matched, delete from target', entry.name)
+                        actions.append(Action(op=DELETE, source=source, size=entry.size, hash=entry.hash,
+                                              keep=abspath(join(options.reference, ref.name))))
                     else:
-                        logger.warning(f'...%s to be added to reference', entry.name)
-                        if options.exec is True:
-                            move(join(options.target, entry.name),
-                                 join(options.reference, entry.name))
-                except ValidationError as ve:
-                    logger.error('unable to parse %s', line)
+                        logger.warning('...%s is different in reference, target file must be renamed', entry.name)
+                        actions.append(self.to_reference(options, source, entry.size,
+                                                         self.renamed(entry.name)))
+                else:
+                    logger.warning(f'...%s to be added to reference', entry.name)
+                    actions.append(self.to_reference(options, source, entry.size, entry.name))
+        return actions
+
+    def plan_content(self, options: ImageCommandOptions) -> list[Action]:
+        """returns the actions to remove byte identical files whatever their
+           names, keeping the copy in the reference or else the first found,
+           and to add the remaining target files to the reference"""
+        collections = [options.reference] if options.target is None \
+                      else [options.reference, options.target]
+        files = [Candidate(i, rel_name, qual_name, os.stat(qual_name).st_size)
+                 for i, base in enumerate(collections)
+                 for qual_name, rel_name in walk_library(base)]
+        logger.info("comparing content of %d files", len(files))
+
+        actions = []
+        redundant = set()
+        for keep, *copies in find_duplicates(files):
+            for copy in copies:
+                if copy.collection == 0 and options.target is not None:
+                    logger.warning('...%s duplicates %s in reference', copy.name, keep.name)
                     continue
+                logger.warning('...%s duplicates %s, delete', copy.path, keep.path)
+                redundant.add(copy.path)
+                actions.append(Action(op=DELETE, source=abspath(copy.path), size=copy.size,
+                                      hash=get_hash(keep.path), keep=abspath(keep.path)))
+
+        for f in files:
+            if f.collection == 0 or f.path in redundant:
+                continue
+            new_name = f.name
+            if exists(join(options.reference, f.name)):
+                new_name = self.renamed(f.name)
+            logger.warning('...%s to be added to reference as %s', f.name, new_name)
+            actions.append(self.to_reference(options, abspath(f.path), f.size, new_name))
+        return actions
+
+    def plan_collections(self, options: ImageCommandOptions) -> list[Action]:
+        """returns the actions to consolidate every collection into the
+           reference, keeping one copy of each file, found by merging their
+           indexes into one content index rather than comparing each pair"""
+        collections = [options.reference] + ([options.target] if options.target else []) \
+                      + options.collection
+        content = ContentIndex()
+        metrics = current_metrics()
+        for i, base in enumerate(collections):
+            with self.open_index(base, options.verbose) as store:
+                for entry in store.entries():
+                    content.add(i, base, entry)
+                    metrics.progress()
+        if len(content.algorithms) > 1:
+            logger.warning("collections are indexed with %s, files hashed differently never match",
+                           ', '.join(sorted(content.algorithms)))
+
+        actions = []
+        taken = set()
+        groups = redundant = reclaimable = 0
+        for hash, (keep, *copies) in content.groups():
+            kept = abspath(keep.path)
+            if keep.collection != 0:
+                new_name = self.reference_name(options.reference, keep.name, taken)
+                actions.append(self.to_reference(options, kept, keep.size, new_name))
+                kept = abspath(join(options.reference, new_name))
+            if not copies:
+                continue
+            groups += 1
+            logger.warning('...duplicates: %s', ', '.join(f.path for f in [keep, *copies]))
+            for copy in copies:
+                if copy.collection == 0:
+                    continue # duplicates within the reference are only reported
+                actions.append(Action(op=DELETE, source=abspath(copy.path), size=copy.size,
+                                      hash=hash, keep=kept))
+                redundant += 1
+                reclaimable += copy.size
+        logger.warning("%d collections: %d duplicate groups, %d files to delete, %.1f MB reclaimable",
+                       len(collections), groups, redundant, reclaimable / 1e6)
+        return actions
+
+    def reference_name(self, reference: str, name: str, taken: set[str]) -> str:
+        """returns a name for a file moved into the reference that neither an
+           existing file nor one planned to move there already has"""
+        new_name = name
+        while new_name in taken or exists(join(reference, new_name)):
+            new_name = self.renamed(new_name)
+        taken.add(new_name)
+        return new_name
+
+    @staticmethod
+    def to_reference(options: ImageCommandOptions, source: str, size: int, new_name: str) -> Action:
+        """returns the action moving a target file into the reference"""
+        dest = abspath(join(options.reference, new_name))
+        op = MOVE if basename(dest) == basename(source) else RENAME
+        return Action(op=op, source=source, size=size, dest=dest)
+
+    @staticmethod
+    def renamed(name: str) -> str:
+        """returns name with a timestamp added to avoid a collision"""
+        parts = splitext(name)
+        now = datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
+        return f'{parts[0]}.{now}{parts[1]}'
+
+    @staticmethod
+    def open_index(base_dir: str, verbose: str) -> IndexStore:
+        """returns the index of a collection, indexing it first if necessary"""
+        store = open_store(base_dir)
+        if not store.exists():
+            exec_cmd('index', IndexCommandOptions(input=base_dir, verbose=verbose))
+            store = open_store(base_dir)
+        return store
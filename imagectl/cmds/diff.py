@@ -0,0 +1,127 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+import logging
+from os.path import abspath, basename, isdir, join
+from typing import Iterator, TextIO
+
+from imagectl.api import ImageCommand, ImageCommandOptions
+from imagectl.cmds import COMMANDS
+from imagectl.metrics import current_metrics
+from imagectl.plan import (APPLIED, COPY, FAILED, MOVE, RENAME, SKIPPED, Action,
+                           apply_plan, journal_path, read_plan, write_plan)
+from imagectl.storage import open_index
+from imagectl.sync import ADDED, MODIFIED, REMOVED, RENAMED, UNCHANGED, Change, diff_indexes
+from imagectl.transfer import LINK_MODES
+
+logger = logging.getLogger(__name__)
+
+class DiffCommand(ImageCommand):
+    """Command to plan bringing one image library up to date with another
+       from their indexes"""
+    NAME = 'diff'
+    def __init__(self, subparsers):
+        super().__init__(self)
+        self.cmd = subparsers.add_parser(self.NAME,
+                   help=COMMANDS[self.NAME].help)
+        self.cmd.add_argument("-i", "--input", help="source image directory or index file")
+        self.cmd.add_argument("-t", "--target",
+                              help="image directory or index file to bring up to date")
+        self.cmd.add_argument("--transfer", metavar="FILE",
+                              help="write the names to copy to FILE, for rsync --files-from")
+        self.cmd.add_argument("-p", "--plan", metavar="FILE",
+                              help="write the copies and renames to bring the target up to date "
+                                   "to FILE for review")
+        self.cmd.add_argument("-a", "--apply", metavar="FILE",
+                              help="perform the actions of a plan, resuming if it was interrupted")
+        self.cmd.add_argument("-j", "--jobs", type=int, default=4,
+                              help="number of directories to apply actions to in parallel "
+                                   "(default: %(default)s)")
+        self.cmd.add_argument("-l", "--link-mode", choices=LINK_MODES, default='auto',
+                              help="how to copy files (default: %(default)s)")
+
+    def execute(self, options: ImageCommandOptions):
+        logger.setLevel(options.verbose)
+        if options.jobs < 1:
+            raise ValueError("Jobs must be at least 1")
+        if options.apply is not None:
+            header, actions = read_plan(options.apply)
+            logger.info("applying %d actions planned %s", len(actions), header.get('created'))
+            outcomes = apply_plan(actions, options.jobs, options.link_mode,
+                                  journal_path(options.apply))
+            logger.warning("applied %d actions, %d skipped, %d failed",
+                           outcomes[APPLIED], outcomes[SKIPPED], outcomes[FAILED])
+            return
+        if options.input is None or options.target is None:
+            raise ValueError("Both input and target must be specified")
+        if options.plan is not None and not (isdir(options.input) and isdir(options.target)):
+            raise ValueError("A plan needs the input and target image directories, not index files")
+        logger.info("comparing the index of %s with %s", options.input, options.target)
+
+        with open_index(options.input) as source, open_index(options.target) as target:
+            for store in (source, target):
+                if not store.exists():
+                    raise ValueError(f"No index found at {store.path}, index the collection first")
+            # changes of each kind and the bytes to copy
+            counts = dict.fromkeys((ADDED, MODIFIED, RENAMED, REMOVED, UNCHANGED, 'bytes'), 0)
+            transfer = None if options.transfer is None else open(options.transfer, 'w')
+            try:
+                actions = self.plan(diff_indexes(source, target), options, counts, transfer)
+                if options.plan is not None:
+                    count = write_plan(options.plan, actions, input=options.input,
+                                       target=options.target)
+                    logger.warning("%d actions written to %s", count, options.plan)
+                else:
+                    for _ in actions:
+                        pass
+            finally:
+                if transfer is not None:
+                    transfer.close()
+        logger.warning("%s to %s: %d added, %d modified, %d renamed, %d removed, %d unchanged, "
+                       "%.1f MB to transfer", options.input, options.target, counts[ADDED],
+                       counts[MODIFIED], counts[RENAMED], counts[REMOVED], counts[UNCHANGED],
+                       counts['bytes'] / 1e6)
+
+    @staticmethod
+    def plan(changes: Iterator[Change], options: ImageCommandOptions, counts: dict[str, int],
+             transfer: TextIO | None) -> Iterator[Action]:
+        """counts and reports the changes, writing the names to copy to
+           transfer if there is one, and yields the actions to bring the target up to date"""
+        metrics = current_metrics()
+        for change in changes:
+            counts[change.kind] += 1
+            metrics.progress()
+            if change.kind == UNCHANGED:
+                continue
+            if change.kind == REMOVED:
+                logger.info('...%s is only in the target', change.name)
+                continue
+            if change.kind == RENAMED:
+                logger.info('...%s was renamed from %s', change.name, change.old_name)
+                source = abspath(join(options.target, change.old_name))
+                dest = abspath(join(options.target, change.name))
+                yield Action(op=MOVE if basename(source) == basename(dest) else RENAME,
+                             source=source, size=change.size, dest=dest)
+                continue
+            logger.info('...%s is %s', change.name, change.kind)
+            counts['bytes'] += change.size
+            if transfer is not None:
+                transfer.write(change.name + '\n')
+            yield Action(op=COPY, source=abspath(join(options.input, change.name)),
+                         size=change.size, hash=change.hash or None,
+                         dest=abspath(join(options.target, change.name)))
@@ -16,20 +16,123 @@
 # Command line client for managing an image library.
 #
 ###############################################################################
-from datetime import datetime
 import logging
 import os
-from os.path import join, getctime, getmtime, getsize
+from os.path import join
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, Iterator
 
 from imagectl.api import ImageCommand, ImageCommandOptions
-from imagectl.constants import TOOL, valid_extensions
-from imagectl.models import IndexEntry
+from imagectl.cmds import COMMANDS
+from imagectl.constants import DEFAULT_HASH_ALGORITHM, DEFAULT_IO_DEPTH, valid_extensions
+from imagectl.exif import ImageMetadata, read_metadata
+from imagectl.hashing import HASH_ALGORITHMS, algorithm_for_digest
+from imagectl.merkle import write_tree
+from imagectl.metrics import current_metrics
+from imagectl.models import METADATA_FIELDS, IndexEntry
+from imagectl.perceptual import (DEFAULT_PERCEPTUAL_ALGORITHM, PERCEPTUAL_ALGORITHMS,
+                                 check_algorithm, perceptual_hash)
+from imagectl.pipeline import ordered_map
+from imagectl.storage import BACKENDS, IndexStore, open_store
+
+if TYPE_CHECKING:
+    from imagectl.aio import AsyncEngine
 
 logger = logging.getLogger(__name__)
 
+def walk_library(base: str) -> Iterator[tuple[str, str]]:
+    """yields the qualified and relative names of every image below base"""
+    metrics = current_metrics()
+    walk = os.walk(base)
+    while True:
+        with metrics.stage('walk'):
+            try:
+                root, dirs, files = next(walk)
+            except StopIteration:
+                return
+        dir = root[len(base)+1:] if root.index(base) > -1 else ''
+        logger.debug("...%s", dir)
+        for name in files:
+            if name[0] == '.':
+                continue # ignore hidden files
+            if not any(name.lower().endswith(ext) for ext in valid_extensions):
+                continue # ignore invalid file types
+            yield join(root, name), join(dir, name)
+
+def index_file(qual_name: str, rel_name: str,
+               algorithm: str = DEFAULT_HASH_ALGORITHM,
+               previous: IndexStore = None, perceptual: str = None) -> IndexEntry:
+    """returns a hashed index entry for a single file, reusing the hashes of
+       the entry in previous if the file is unchanged"""
+    logger.debug("...%s", rel_name)
+    with current_metrics().stage('stat'):
+        st = os.stat(qual_name)
+    return hash_entry(qual_name, IndexEntry.from_stat(rel_name, st), algorithm,
+                      previous, perceptual)
+
+def hash_entry(qual_name: str, entry: IndexEntry,
+               algorithm: str = DEFAULT_HASH_ALGORITHM,
+               previous: IndexStore = None, perceptual: str = None) -> IndexEntry:
+    """completes an entry made from the stat of a file with its hashes and
+       metadata, reusing those of the entry in previous if the file is
+       unchanged"""
+    old = None if previous is None else previous.get(entry.name)
+    unchanged = old is not None and old.same_stat(entry)
+    if unchanged and old.hash and algorithm_for_digest(old.hash) == algorithm:
+        entry.hash = old.hash
+        if old.has_metadata():
+            entry.set_metadata(ImageMetadata(*(getattr(old, field) for field in METADATA_FIELDS)))
+        else: # indexed before metadata was recorded
+            entry.set_metadata(read_metadata(qual_name))
+    else:
+        entry.calc_hash(qual_name, algorithm, metadata=True)
+    if perceptual is not None:
+        if unchanged and old.phash and old.phash.startswith(perceptual + ':'):
+            entry.phash = old.phash
+        else:
+            entry.phash = perceptual_hash(qual_name, perceptual)
+    elif unchanged:
+        entry.phash = old.phash
+    return entry
+
+def index_files(files: Iterable[tuple[str, str]], jobs: int = 1,
+                algorithm: str = DEFAULT_HASH_ALGORITHM,
+                previous: IndexStore = None,
+                perceptual: str = None) -> Iterator[IndexEntry]:
+    """hashes files on up to jobs threads, yielding entries in input order"""
+    # hashlib releases the GIL while digesting so threads keep every core
+    # and the device queue busy
+    return ordered_map(index_file, ((qual_name, rel_name, algorithm, previous, perceptual)
+                                    for qual_name, rel_name in files),
+                       jobs, 'hasher')
+
+async def index_library_async(engine: 'AsyncEngine', base: str,
+                              algorithm: str = DEFAULT_HASH_ALGORITHM,
+                              previous: IndexStore = None, perceptual: str = None,
+                              skip: set[str] = frozenset()) -> AsyncIterator[IndexEntry]:
+    """yields hashed entries for the images below base, other than those in
+       skip, in the order they are listed with listings, stats and reads
+       overlapped"""
+    async def index_one(qual_name: str, rel_name: str) -> IndexEntry:
+        st = await engine.stat(qual_name)
+        return await engine.read(hash_entry, qual_name, IndexEntry.from_stat(rel_name, st),
+                                 algorithm, previous, perceptual)
+
+    files = ((qual_name, rel_name) async for qual_name, rel_name in engine.walk(base)
+             if rel_name not in skip)
+    async for entry in engine.ordered_map(index_one, files):
+        yield entry
+
 class IndexCommandOptions(ImageCommandOptions):
     """configuration required by Index and Verify commands"""
     input: str
+    algorithm: str = DEFAULT_HASH_ALGORITHM
+    jobs: int = 1
+    incremental: bool = False
+    backend: str = None
+    perceptual: str = None
+    resume: bool = False
+    use_async: bool = False
+    io_depth: int = DEFAULT_IO_DEPTH
 
 class IndexCommand(ImageCommand):
     """Command to index an image library"""
@@ -38,36 +141,92 @@ class IndexCommand(ImageCommand):
     def __init__(self, subparsers):
         super().__init__(self)
         self.cmd = subparsers.add_parser(self.NAME,
-                   help='index an image library')
+                   help=COMMANDS[self.NAME].help)
         self.cmd.add_argument("-i", "--input", help="base image directory")
+        self.cmd.add_argument("-a", "--algorithm", choices=HASH_ALGORITHMS.keys(),
+                              default=DEFAULT_HASH_ALGORITHM,
+                              help="hash algorithm (default: %(default)s)")
+        self.cmd.add_argument("-j", "--jobs", type=int, default=1,
+                              help="number of files to hash in parallel (default: %(default)s)")
+        self.cmd.add_argument("-u", "--incremental", action="store_true",
+                              help="only hash files that changed since the last index")
+        self.cmd.add_argument("-b", "--backend", choices=BACKENDS.keys(),
+                              help="index storage (default: the existing index or csv)")
+        self.cmd.add_argument("-p", "--perceptual", nargs="?", choices=PERCEPTUAL_ALGORITHMS.keys(),
+                              const=DEFAULT_PERCEPTUAL_ALGORITHM,
+                              help="also record a perceptual hash (default: %(const)s)")
+        self.cmd.add_argument("-r", "--resume", action="store_true",
+                              help="continue an interrupted run from its partial index")
+        self.cmd.add_argument("--async", dest="use_async", action="store_true",
+                              help="overlap listings, stats and reads, for network storage")
+        self.cmd.add_argument("--io-depth", type=int, default=DEFAULT_IO_DEPTH,
+                              help="operations of each kind in flight with --async (default: %(default)s)")
 
     def execute(self, options: ImageCommandOptions):
         logger.setLevel(options.verbose)
         if options.input is None:
             raise ValueError("Input collection must be specified")
+        if options.jobs < 1:
+            raise ValueError("Jobs must be at least 1")
+        if options.io_depth < 1:
+            raise ValueError("IO depth must be at least 1")
+        if options.perceptual is not None:
+            check_algorithm(options.perceptual)
         if options.input[-1:] == '/':
             options.input = options.input[:-1]
         logger.info("indexing %s", options.input)
 
-        index = []
-        for root, dirs, files in os.walk(options.input):
-            dir = root[len(options.input)+1:] if root.index(options.input) > -1 else ''
-            logger.info("...%s", dir)
-            for name in files:
-                if name[0] == '.':
-                    continue # ignore hidden files
-                if not any(name.lower().endswith(ext) for ext in valid_extensions):
-                    continue # ignore invalid file types
-                qual_name = join(root, name)
-                rel_name = join(dir, name)
-                logger.debug("...%s", rel_name)
-                entry = IndexEntry(name=rel_name,
-                                    created=datetime.fromtimestamp(getctime(qual_name)).isoformat(),
-                                    modified=datetime.fromtimestamp(getmtime(qual_name)).isoformat(),
-                                    size=getsize(qual_name))
-                entry.calc_hash(qual_name)
-                index.append(entry)
-        with open(join(options.input, f'.{TOOL.get("name")}'), 'w') as out:
-            out.write("NAME,CREATED,MODIFIED,SIZE,HASH\n")
-            for entry in index:
-                out.write(entry.model_dump())
+        store = open_store(options.input, options.backend)
+        metrics = current_metrics()
+        previous = None
+        if options.incremental and store.exists():
+            previous = store
+            prior_count = store.count()
+            metrics.expect(prior_count) # the best estimate available
+            logger.info("reusing %d entries from %s", prior_count, store.path)
+
+        counts = {'reused': 0, 'rehashed': 0, 'added': 0}
+        carried = 0
+        with store, store.writer(options.resume) as writer:
+            if previous is not None:
+                carried = sum(1 for name in writer.done if previous.get(name) is not None)
+
+            def record(entry: IndexEntry):
+                with metrics.stage('index_write'):
+                    writer.add(entry)
+                metrics.progress()
+                if previous is None:
+                    return
+                old = previous.get(entry.name)
+                if old is None:
+                    counts['added'] += 1
+                elif old.hash == entry.hash and old.same_stat(entry):
+                    counts['reused'] += 1
+                else:
+                    counts['rehashed'] += 1
+
+            # files written by an interrupted run are already in the new index
+            if options.use_async:
+                from imagectl import aio # asyncio is only worth importing when used
+
+                async def index_all(engine):
+                    async for entry in index_library_async(engine, options.input, options.algorithm,
+                                                           previous, options.perceptual,
+                                                           writer.done):
+                        record(entry)
+                aio.run(index_all, options.io_depth)
+            else:
+                files = ((qual_name, rel_name) for qual_name, rel_name in walk_library(options.input)
+                         if rel_name not in writer.done)
+                for entry in index_files(files, options.jobs, options.algorithm,
+                                         previous, options.perceptual):
+                    record(entry)
+        with store:
+            write_tree(store)
+        if writer.done:
+            logger.warning("resumed %s: %d entries from the interrupted run, %d new",
+                           options.input, len(writer.done), writer.count)
+        if previous is not None:
+            logger.warning("indexed %s: %d reused, %d rehashed, %d added, %d removed",
+                           options.input, counts['reused'], counts['rehashed'], counts['added'],
+                           prior_count - counts['reused'] - counts['rehashed'] - carried)
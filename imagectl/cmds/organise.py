@@ -16,44 +16,65 @@
 # Command line client for managing an image library.
 #
 ###############################################################################
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from hmac import compare_digest
 import os
-import shutil
+import threading
+from typing import Iterator
 
-from PIL import Image
-
-from imagectl.__main__ import get_hash
 from imagectl.api import ImageCommand, ImageCommandOptions
+from imagectl.cmds import COMMANDS
 from imagectl.constants import valid_extensions
+from imagectl.exif import get_date_taken
+from imagectl.hashing import algorithm_for_digest, get_hash
+from imagectl.metrics import current_metrics
+from imagectl.models import IndexEntry
+from imagectl.pipeline import QUEUE_DEPTH, ordered_map
+from imagectl.storage import IndexStore, open_store
+from imagectl.transfer import LINK_MODES, copy_file, move_file
 
 logger = logging.getLogger(__name__)
 
-try:
-    import pillow_heif
-    pillow_heif.register_heif_opener()
-except ImportError:
-    logger.warning("pillow_heif not installed, HEIC files will not be processable")
-
 class OrganiserCommand(ImageCommand):
     """Command to organise an image library"""
     NAME = 'organise'
     def __init__(self, subparsers):
         super().__init__(self)
         self.cmd = subparsers.add_parser(self.NAME,
-                   help='organise images in a standard structure')
+                   help=COMMANDS[self.NAME].help)
         self.cmd.add_argument("-i", "--input", help="base image directory")
         self.cmd.add_argument("-o", "--output", help="output directory")
         self.cmd.add_argument("-m", "--move", action="store_true", help="move the file (default is to copy)")
         self.cmd.add_argument("-r", "--recurse", action="store_true", help="process child directories as well")
         self.cmd.add_argument("-v", "--verbose", action="store_true", help="increase the progess messages")
+        self.cmd.add_argument("-j", "--jobs", type=int, default=1,
+                              help="number of images to process in parallel (default: %(default)s)")
+        self.cmd.add_argument("-l", "--link-mode", choices=LINK_MODES, default='auto',
+                              help="how to copy files, auto picks the cheapest that works (default: %(default)s)")
+        self.cmd.add_argument("--from-index", action="store_true",
+                              help="take dates from the input's index and check for collisions in "
+                                   "the output's, reading only the files copied")
+        self.link_mode = 'auto'
+
+    @property
+    def metrics(self):
+        return current_metrics()
 
     def execute(self, options: ImageCommandOptions):
         logger.setLevel(options.verbose)
+        if options.jobs < 1:
+            raise ValueError("Jobs must be at least 1")
         in_dir = options.input
         out_dir = options.output
         move = options.move
-        self.process_dir(in_dir, out_dir, move)
+        self.link_mode = options.link_mode
+        if options.from_index:
+            self.process_index(in_dir, out_dir, move)
+        elif options.jobs == 1:
+            self.process_dir(in_dir, out_dir, move)
+        else:
+            self.process_parallel(in_dir, out_dir, move, options.jobs)
 
     @staticmethod
     def get_new_file_name(in_file: str, year: str, month: str, day: str) -> str:
@@ -78,74 +99,175 @@ class OrganiserCommand(ImageCommand):
                          in_hash, out_hash)
             return compare_digest(in_hash.strip(), out_hash.strip())
 
-    def process_dir(self, in_dir: str, out_dir: str, move: bool = False):
-        logger.info('processing dir: %s to %s', in_dir, out_dir)
+    def find_images(self, in_dir: str) -> Iterator[str]:
+        """yields the images in in_dir and its child directories"""
+        logger.debug('processing dir: %s', in_dir)
 
-        file_names = os.listdir(in_dir)
-        for file_name in file_names:
-            file_ext = os.path.splitext(file_name)[1]
+        # the type of each entry comes with the listing, saving a stat each
+        with self.metrics.stage('walk'), os.scandir(in_dir) as it:
+            entries = list(it)
+        for entry in entries:
+            file_ext = os.path.splitext(entry.name)[1]
 
             # process image / dir / other
             if (file_ext and file_ext.lower() in valid_extensions):
-                self.process_image(os.path.join(in_dir, file_name), out_dir, move=move)
-            elif (os.path.isdir(os.path.join(in_dir, file_name))):
-                self.process_dir(os.path.join(in_dir, file_name), out_dir, move=move)
+                yield entry.path
+            elif entry.is_dir():
+                yield from self.find_images(entry.path)
             else:
                 logger.warning('skipping unsupported extension: %s', file_ext)
                 continue
 
-    def process_image(self, in_file: str, out_dir: str, move: bool = False):
-        logger.info('process image: %s to %s', in_file, out_dir)
+    def process_dir(self, in_dir: str, out_dir: str, move: bool = False):
+        for in_file in self.find_images(in_dir):
+            self.process_image(in_file, out_dir, move=move)
+
+    def process_parallel(self, in_dir: str, out_dir: str, move: bool = False, jobs: int = 2):
+        """reads dates on a pool of threads while copying on another, files
+           for the same destination are always written by the same thread in
+           the order found so collisions resolve as they do serially"""
+        writers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'writer-{i}')
+                   for i in range(jobs)]
+        in_flight = threading.BoundedSemaphore(jobs * QUEUE_DEPTH)
+
+        def written(future):
+            in_flight.release()
+            self.metrics.progress()
+            if future.exception() is not None:
+                logger.error('cannot write image: %s', future.exception())
 
-        image = None
         try:
-            logger.debug('opening image: %s', in_file)
-            image = Image.open(in_file)
-            exif_data = image.getexif()
-            
-            if not exif_data:
-                raise ValueError(f'no EXIF data available in {in_file}')
-
-            # EXIF date taken is tag 36867 (DateTime), 306 (DateTime), or 36865 (DateTimeOriginal)
-            date_taken = exif_data.get(36867) or exif_data.get(306) or exif_data.get(36865)
+            located = ordered_map(lambda in_file: (in_file, self.get_destination(in_file, out_dir)),
+                                  ((in_file,) for in_file in self.find_images(in_dir)),
+                                  jobs, 'reader')
+            for in_file, new_file_path in located:
+                if new_file_path is None:
+                    self.metrics.progress()
+                    continue
+                in_flight.acquire()
+                writer = writers[hash(new_file_path) % jobs]
+                writer.submit(self.write_image, in_file, new_file_path, move).add_done_callback(written)
+        finally:
+            for writer in writers:
+                writer.shutdown()
+
+    def get_destination(self, in_file: str, out_dir: str) -> str | None:
+        """returns the path to organise in_file to, or None if it has no date"""
+        logger.debug('process image: %s to %s', in_file, out_dir)
+
+        try:
+            date_taken = get_date_taken(in_file)
             if not date_taken:
                 raise ValueError(f'no date taken in EXIF data for {in_file}')
-        except IndexError:
-            logger.warning('skipping %s because no date taken in EXIF data', in_file)
-            return
         except ValueError as ve:
             logger.warning(ve)
-            return
+            return None
         except Exception as e:
             logger.warning('cannot open %s: %s', in_file, str(e))
-            return
-        finally:
-            if image:
-                image.close()
+            return None
+
+        return self.dated_destination(in_file, date_taken, out_dir)
 
+    def dated_destination(self, in_file: str, date_taken: str, out_dir: str) -> str:
+        """returns the path to organise in_file to given its date taken, in
+           EXIF or ISO format"""
         # extract parts of date and format
         year = date_taken[0:4]
         month = date_taken[5:7]
         day = date_taken[8:10]
 
         out_file = self.get_new_file_name(in_file, year, month, day)
+        return os.path.join(out_dir, year, month, out_file)
 
-        if not (os.path.exists(out_dir)):
-            os.mkdir(out_dir)
-        trgt_path = os.path.join(out_dir, year)
-        if not (os.path.exists(trgt_path)):
-            os.mkdir(trgt_path)
-        trgt_path = os.path.join(trgt_path, month)
-        if not (os.path.exists(trgt_path)):
-            os.mkdir(trgt_path)
-
-        new_file_path = os.path.join(trgt_path, out_file)
-
-        if self.is_writable(in_file, out_file):
-            # copy / move the file
-            if (move):
-                logger.debug('moving from %s to %s', in_file, new_file_path)
-                shutil.move(in_file, new_file_path)
-            else:
-                logger.debug('copying from %s to %s', in_file, new_file_path)
-                shutil.copy2(in_file, new_file_path)
+    def write_image(self, in_file: str, new_file_path: str, move: bool = False):
+        """copies or moves in_file unless a different file is already there"""
+        if not self.is_writable(in_file, new_file_path):
+            logger.warning('skipping %s, a different file exists at %s', in_file, new_file_path)
+            return
+        self.transfer(in_file, new_file_path, move)
+
+    def transfer(self, in_file: str, new_file_path: str, move: bool = False):
+        """copies or moves in_file, replacing any file at new_file_path"""
+        # safe when several threads create the same year and month
+        os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
+        if (move):
+            logger.debug('moving from %s to %s', in_file, new_file_path)
+            move_file(in_file, new_file_path, self.link_mode)
+        else:
+            logger.debug('copying from %s to %s', in_file, new_file_path)
+            copy_file(in_file, new_file_path, self.link_mode)
+
+    def process_index(self, in_dir: str, out_dir: str, move: bool = False):
+        """organises the images in the index of in_dir by the dates recorded
+           there, checking for a different file at each destination in the
+           index of out_dir, which is updated with the files written"""
+        with open_store(in_dir) as source, open_store(out_dir) as target:
+            if not source.exists():
+                raise ValueError(f"No index found at {source.path}, index the collection first")
+            indexed = target.exists()
+            if not indexed:
+                logger.warning('no index found at %s, files already there will be hashed', target.path)
+            # organising a library in place updates a single index
+            same_index = os.path.abspath(source.path) == os.path.abspath(target.path)
+            self.metrics.expect(source.count())
+            written = {} # names organised by this run and their hashes
+            organised, moved = [], []
+            for entry in source.entries():
+                self.metrics.progress()
+                if not entry.taken:
+                    logger.warning('no date taken in the index for %s', entry.name)
+                    continue
+                in_file = os.path.join(in_dir, entry.name)
+                new_file_path = self.dated_destination(in_file, entry.taken, out_dir)
+                rel_name = os.path.relpath(new_file_path, out_dir)
+                existing = self.existing_hash(rel_name, new_file_path, entry.hash,
+                                              target if indexed else None, written)
+                if existing is not None and existing != entry.hash:
+                    logger.warning('skipping %s, a different file exists at %s', in_file, new_file_path)
+                    continue
+                if existing is not None and os.path.exists(new_file_path) \
+                        and os.path.samefile(in_file, new_file_path):
+                    logger.debug('%s is already organised', in_file)
+                    continue
+                if existing is not None and not move:
+                    logger.debug('%s is already at %s', in_file, new_file_path)
+                    continue
+                try:
+                    self.transfer(in_file, new_file_path, move)
+                except OSError as err:
+                    logger.error('cannot organise %s: %s', in_file, err)
+                    continue
+                written[rel_name] = entry.hash
+                if move:
+                    moved.append(entry.name)
+                if indexed:
+                    organised.append(IndexEntry.from_stat(rel_name, os.stat(new_file_path))
+                                     .copy_content(entry))
+            if organised:
+                target.upsert(organised)
+            if same_index:
+                moved = [name for name in moved if name not in written]
+            if moved:
+                (target if same_index else source).remove(moved)
+
+    @staticmethod
+    def existing_hash(rel_name: str, new_file_path: str, hash: str,
+                      target: IndexStore | None, written: dict[str, str]) -> str | None:
+        """returns the hash of the file already at a destination, or None if
+           there is not one, from the index of the output where it has one
+           and otherwise by hashing any file on disk the index does not know"""
+        if rel_name in written:
+            return written[rel_name]
+        if target is not None:
+            old = target.get(rel_name)
+            if old is not None:
+                return old.hash
+        if os.path.exists(new_file_path):
+            return get_hash(new_file_path, algorithm_for_digest(hash))
+        return None
+
+    def process_image(self, in_file: str, out_dir: str, move: bool = False):
+        new_file_path = self.get_destination(in_file, out_dir)
+        if new_file_path is not None:
+            self.write_image(in_file, new_file_path, move)
+        self.metrics.progress()
@@ -0,0 +1,77 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+import logging
+import signal
+import threading
+
+from imagectl.api import ImageCommand, ImageCommandOptions
+from imagectl.cmds import COMMANDS
+from imagectl.server import (DEFAULT_RELOAD_INTERVAL, IndexServer, Library, default_socket,
+                             make_server, reload_forever, remove_socket)
+
+logger = logging.getLogger(__name__)
+
+class ServeCommand(ImageCommand):
+    """Command to answer queries against indexes held in memory"""
+    NAME = 'serve'
+    def __init__(self, subparsers):
+        super().__init__(self)
+        self.cmd = subparsers.add_parser(self.NAME,
+                   help=COMMANDS[self.NAME].help)
+        self.cmd.add_argument("-i", "--input", action="append", metavar="DIR",
+                              help="image directory whose index to serve, may be repeated")
+        self.cmd.add_argument("-s", "--socket",
+                              help=f"Unix socket to listen on (default: {default_socket()})")
+        self.cmd.add_argument("-p", "--port", type=int,
+                              help="listen on this TCP port of localhost instead of a socket")
+        self.cmd.add_argument("--interval", type=float, default=DEFAULT_RELOAD_INTERVAL,
+                              help="seconds between checks for changed indexes (default: %(default)s)")
+
+    def execute(self, options: ImageCommandOptions):
+        logger.setLevel(options.verbose)
+        if not options.input:
+            raise ValueError("At least one input collection must be specified")
+        if options.interval <= 0:
+            raise ValueError("Interval must be more than 0 seconds")
+        if options.socket is not None and options.port is not None:
+            raise ValueError("Listen on either a socket or a port, not both")
+
+        libraries = [Library(base_dir.rstrip('/') or '/') for base_dir in options.input]
+        for library in libraries:
+            library.reload()
+        address = options.port if options.port is not None else (options.socket or default_socket())
+        stop = threading.Event()
+        reloader = threading.Thread(target=reload_forever, name='reloader',
+                                    args=(libraries, options.interval, stop), daemon=True)
+        with make_server(IndexServer(libraries), address) as server:
+            logger.warning("serving %d images from %s on %s",
+                           sum(len(library.names) for library in libraries),
+                           ', '.join(options.input), address)
+            reloader.start()
+            # stop cleanly when run as a service, shutdown waits for
+            # serve_forever so must be called from another thread
+            signal.signal(signal.SIGTERM,
+                          lambda *_: threading.Thread(target=server.shutdown).start())
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                logger.info("stopped serving")
+            finally:
+                stop.set()
+                remove_socket(server)
@@ -0,0 +1,84 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from os.path import join
+
+from imagectl.api import ImageCommand, ImageCommandOptions
+from imagectl.binindex import BinaryEntry
+from imagectl.cmds import COMMANDS
+from imagectl.metrics import current_metrics
+from imagectl.perceptual import (DEFAULT_DISTANCE, DEFAULT_PERCEPTUAL_ALGORITHM,
+                                 PERCEPTUAL_ALGORITHMS, check_algorithm,
+                                 parse_perceptual_hash, perceptual_hash, similar_groups)
+from imagectl.storage import open_store
+
+logger = logging.getLogger(__name__)
+
+class SimilarCommand(ImageCommand):
+    """Command to find visually similar images in a library"""
+    NAME = 'similar'
+    def __init__(self, subparsers):
+        super().__init__(self)
+        self.cmd = subparsers.add_parser(self.NAME,
+                   help=COMMANDS[self.NAME].help)
+        self.cmd.add_argument("-i", "--input", help="base image directory")
+        self.cmd.add_argument("-p", "--perceptual", choices=PERCEPTUAL_ALGORITHMS.keys(),
+                              default=DEFAULT_PERCEPTUAL_ALGORITHM,
+                              help="perceptual hash algorithm (default: %(default)s)")
+        self.cmd.add_argument("-d", "--distance", type=int, default=DEFAULT_DISTANCE,
+                              help="largest Hamming distance of a match (default: %(default)s)")
+        self.cmd.add_argument("-j", "--jobs", type=int, default=1,
+                              help="number of images to hash in parallel (default: %(default)s)")
+
+    def execute(self, options: ImageCommandOptions):
+        logger.setLevel(options.verbose)
+        if options.input is None:
+            raise ValueError("Input collection must be specified")
+        if options.jobs < 1:
+            raise ValueError("Jobs must be at least 1")
+        check_algorithm(options.perceptual)
+        logger.info("searching %s for similar images", options.input)
+
+        with open_store(options.input) as store:
+            if not store.exists():
+                raise ValueError(f"No index found at {store.path}, index the collection first")
+
+            # calculate any hashes missing from the index and save them
+            prefix = options.perceptual + ':'
+            # binary index entries are read only views of the mapped file
+            missing = [entry.to_entry() if isinstance(entry, BinaryEntry) else entry
+                       for entry in store.entries()
+                       if not (entry.phash or '').startswith(prefix)]
+            if missing:
+                logger.info("calculating %d perceptual hashes", len(missing))
+                with ThreadPoolExecutor(max_workers=options.jobs) as pool:
+                    hashes = pool.map(lambda e: perceptual_hash(join(options.input, e.name),
+                                                                options.perceptual), missing)
+                    current_metrics().expect(len(missing))
+                    for entry, phash in zip(missing, hashes):
+                        entry.phash = phash
+                        current_metrics().progress()
+                store.upsert(entry for entry in missing if entry.phash is not None)
+
+            hashes = ((entry.name, parse_perceptual_hash(entry.phash)[1])
+                      for entry in store.entries()
+                      if (entry.phash or '').startswith(prefix))
+            for group in similar_groups(hashes, options.distance):
+                logger.warning('...similar images: %s', ', '.join(group))
@@ -16,43 +16,225 @@
 # Command line client for managing an image library.
 #
 ###############################################################################
+import json
 import logging
+import os
 from os.path import join
-
-from pydantic_core import ValidationError
+import random
+import time
+from typing import TYPE_CHECKING, AsyncIterator, Iterable
+from zlib import crc32
 
 from imagectl.api import ImageCommand, ImageCommandOptions
-from imagectl.constants import TOOL
+from imagectl.cmds import COMMANDS
+from imagectl.constants import DEFAULT_IO_DEPTH
+from imagectl.metrics import current_metrics
 from imagectl.models import IndexEntry
+from imagectl.pipeline import ordered_map
+from imagectl.storage import open_store
+
+if TYPE_CHECKING:
+    from imagectl.aio import AsyncEngine
 
 logger = logging.getLogger(__name__)
 
+VERIFIED = 'verified'
+CHANGED = 'changed'
+CORRUPT = 'corrupt'
+MISSING = 'missing'
+UNDECODABLE = 'undecodable'
+
+class Sampler:
+    """Chooses the entries to fully rehash on this run. Rotating sampling
+       splits the library into 1/fraction buckets by name and checks a
+       different bucket each day, so every file is read within that many
+       days; random sampling picks each file with the given probability."""
+    def __init__(self, fraction: float, mode: str = 'rotating', day: int = None):
+        self.fraction = fraction
+        self.mode = mode
+        self.buckets = max(1, round(1 / fraction)) if fraction > 0 else 0
+        self.bucket = (int(time.time() // 86400) if day is None else day) % max(1, self.buckets)
+
+    def __call__(self, entry: IndexEntry) -> bool:
+        if self.fraction <= 0:
+            return False
+        if self.mode == 'random':
+            return random.random() < self.fraction
+        return crc32(entry.name.encode()) % self.buckets == self.bucket
+
 class VerifyCommand(ImageCommand):
     """Command to verify an image library"""
     NAME = 'verify'
     def __init__(self, subparsers):
         super().__init__(self)
         self.cmd = subparsers.add_parser(self.NAME,
-                   help='verify images against index')
+                   help=COMMANDS[self.NAME].help)
         self.cmd.add_argument("-i", "--input", help="base image directory")
+        self.cmd.add_argument("-j", "--jobs", type=int, default=8,
+                              help="number of files to check in parallel (default: %(default)s)")
+        self.cmd.add_argument("-s", "--sample", type=float, default=0,
+                              help="fraction of files to fully rehash, e.g. 0.1 (default: none)")
+        self.cmd.add_argument("--sample-mode", choices=['rotating', 'random'], default='rotating',
+                              help="rotating covers every file within 1/SAMPLE days (default: %(default)s)")
+        self.cmd.add_argument("--async", dest="use_async", action="store_true",
+                              help="overlap stats and reads, for network storage")
+        self.cmd.add_argument("--io-depth", type=int, default=DEFAULT_IO_DEPTH,
+                              help="operations of each kind in flight with --async (default: %(default)s)")
+        self.cmd.add_argument("-d", "--decode", action="store_true",
+                              help="also decode every image not already known to decode, to find "
+                                   "files that were damaged before they were indexed")
+        self.cmd.add_argument("--decode-jobs", type=int, default=0,
+                              help="number of processes decoding images (default: one per core)")
+        self.cmd.add_argument("-r", "--report", metavar="FILE",
+                              help="write each file that failed as a line of JSON to FILE")
+
+    @staticmethod
+    def check(base_dir: str, entry: IndexEntry, audit: bool) -> str:
+        """returns the state of one indexed file, reading its content only if
+           it has changed or is being audited"""
+        qual_name = join(base_dir, entry.name)
+        try:
+            with current_metrics().stage('stat'):
+                st = os.stat(qual_name)
+        except FileNotFoundError:
+            return MISSING
+        return VerifyCommand.check_stat(qual_name, entry, st, audit)
+
+    @staticmethod
+    async def check_async(engine: 'AsyncEngine', checks: Iterable[tuple[str, IndexEntry, bool]]
+                          ) -> AsyncIterator[tuple[IndexEntry, bool, str]]:
+        """yields the entry, whether audited and state of each check as they
+           complete, with stats and reads overlapped"""
+        from imagectl.aio import aiter_sync
+
+        async def check(base_dir: str, entry: IndexEntry, audit: bool):
+            qual_name = join(base_dir, entry.name)
+            try:
+                st = await engine.stat(qual_name)
+            except FileNotFoundError:
+                return entry, audit, MISSING
+            if not audit and entry.stat_matches(st):
+                return entry, audit, VERIFIED # nothing to read
+            return entry, audit, await engine.read(VerifyCommand.check_stat, qual_name,
+                                                   entry, st, audit)
+
+        async for result in engine.map(check, aiter_sync(checks)):
+            yield result
+
+    @staticmethod
+    def check_stat(qual_name: str, entry: IndexEntry, st: os.stat_result, audit: bool) -> str:
+        """returns the state of an indexed file that has been statted"""
+        if audit:
+            if entry.size != st.st_size or not entry.hash_matches(qual_name, use_cache=False):
+                return CORRUPT
+            return VERIFIED if entry.stat_matches(st) else CHANGED
+        if entry.stat_matches(st):
+            return VERIFIED
+        return CHANGED if entry.hash_matches(qual_name) else CORRUPT
 
     def execute(self, options: ImageCommandOptions):
         logger.setLevel(options.verbose)
         if options.input is None:
             raise ValueError("Input collection must be specified")
+        if options.jobs < 1:
+            raise ValueError("Jobs must be at least 1")
+        if not 0 <= options.sample <= 1:
+            raise ValueError("Sample must be a fraction between 0 and 1")
+        if options.io_depth < 1:
+            raise ValueError("IO depth must be at least 1")
+        if options.decode_jobs < 0:
+            raise ValueError("Decode jobs must be at least 1, or 0 for one per core")
         logger.info("verifying %s", options.input)
 
-        with open(join(options.input, f'.{TOOL.get("name")}'), 'r') as index:
-            for line in index.readlines():
-                try:
-                    entry = IndexEntry.from_str(line)
-                    qual_name = join(options.input, entry.name)
-                    if entry.matches(qual_name):
-                        logger.info('...%s is verified', entry.name)
-                    elif entry.hash_matches(qual_name):
-                        logger.info('...%s has the expected hash, update index', entry.name)
-                    else:
-                        logger.error("...%s has the wrong hash, investigate", entry.name)
-                except ValidationError as ve:
-                    logger.error('unable to parse %s', line)
+        sampler = Sampler(options.sample, options.sample_mode)
+        counts = {VERIFIED: 0, CHANGED: 0, CORRUPT: 0, MISSING: 0, UNDECODABLE: 0}
+        audited = 0
+        failures = []
+        to_decode = [] # name, hash and size of each intact file to decode
+        metrics = current_metrics()
+        with open_store(options.input) as store:
+            metrics.expect(store.count())
+            checks = ((options.input, entry, sampler(entry)) for entry in store.entries())
+
+            def report(entry: IndexEntry, audit: bool, state: str):
+                nonlocal audited
+                counts[state] += 1
+                audited += audit
+                metrics.progress()
+                if state == VERIFIED:
+                    logger.debug('...%s is verified', entry.name)
+                elif state == CHANGED:
+                    logger.info('...%s has the expected hash, update index', entry.name)
+                elif state == MISSING:
+                    logger.error("...%s is missing", entry.name)
+                else:
+                    logger.error("...%s has the wrong hash, investigate", entry.name)
+                if state in (MISSING, CORRUPT):
+                    failures.append({'name': entry.name, 'state': state,
+                                     'size': entry.size, 'hash': entry.hash})
+                elif state == VERIFIED and options.decode and entry.hash:
+                    # only files known to still have their indexed hash, the
+                    # result is remembered against it
+                    to_decode.append((entry.name, entry.hash, entry.size))
+
+            if options.use_async:
+                from imagectl import aio # asyncio is only worth importing when used
+
+                async def check_all(engine):
+                    async for result in self.check_async(engine, checks):
+                        report(*result)
+                aio.run(check_all, options.io_depth)
+            else:
+                for result in ordered_map(lambda base_dir, entry, audit: (entry, audit,
+                                                                          self.check(base_dir, entry, audit)),
+                                          checks, options.jobs, 'verifier'):
+                    report(*result)
+        decoded, known = self.decode(options.input, to_decode, options.decode_jobs, failures) \
+                         if options.decode else (0, 0)
+        counts[UNDECODABLE] = sum(failure['state'] == UNDECODABLE for failure in failures)
+        if options.report is not None:
+            with open(options.report, 'w') as f:
+                for failure in failures:
+                    f.write(json.dumps(failure) + '\n')
+        logger.warning("verified %s: %d verified, %d changed, %d wrong hash, %d missing, %d rehashed in full",
+                       options.input, counts[VERIFIED], counts[CHANGED], counts[CORRUPT],
+                       counts[MISSING], audited)
+        if options.decode:
+            logger.warning("decoded %d images, %d already known to decode, %d cannot be decoded",
+                           decoded, known, counts[UNDECODABLE])
+
+    @staticmethod
+    def decode(base_dir: str, files: list[tuple[str, str, int]], jobs: int,
+               failures: list[dict], cache_path: str = None) -> tuple[int, int]:
+        """decodes each file whose hash has not decoded before, adding those
+           that cannot be to failures, and returns the number of images
+           decoded and of files skipped as their content decoded before"""
+        from imagectl.scrub import DecodedCache, decode_all
+        metrics = current_metrics()
+        decoded = known = 0
+        with DecodedCache(cache_path) as cache:
+            pending = {} # names with each hash, so copies are decoded once
+            for name, hash, size in files:
+                if hash in cache:
+                    known += 1
+                else:
+                    pending.setdefault((hash, size), []).append(name)
+            metrics.expect(metrics.done + len(pending))
+            logger.info("decoding %d images", len(pending))
+            # largest first, so a long decode does not hold up the end of the run
+            order = sorted(pending.items(), key=lambda item: -item[0][1])
+            for ((hash, size), names), error, seconds in decode_all(
+                    ((join(base_dir, names[0]), (key, names)) for key, names in order),
+                    jobs or None):
+                decoded += 1
+                metrics.add('decode', seconds, bytes=size)
+                metrics.progress()
+                if error is None:
+                    logger.debug('...%s decodes', names[0])
+                    cache.add(hash)
                     continue
+                for name in names:
+                    logger.error('...%s cannot be decoded: %s', name, error)
+                    failures.append({'name': name, 'state': UNDECODABLE, 'size': size,
+                                     'hash': hash, 'error': error})
+        return decoded, known
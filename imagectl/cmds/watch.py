@@ -0,0 +1,231 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+import logging
+import os
+from os.path import dirname, join, relpath
+
+from imagectl.api import ImageCommand, ImageCommandOptions
+from imagectl.cmds import COMMANDS
+from imagectl.cmds.index import index_file, walk_library
+from imagectl.constants import DEFAULT_HASH_ALGORITHM
+from imagectl.hashing import HASH_ALGORITHMS
+from imagectl.merkle import load_tree, update_tree, write_tree
+from imagectl.models import IndexEntry
+from imagectl.perceptual import (DEFAULT_PERCEPTUAL_ALGORITHM, PERCEPTUAL_ALGORITHMS,
+                                 check_algorithm)
+from imagectl.pipeline import ordered_map
+from imagectl.storage import BACKENDS, IndexStore, SqliteIndexStore, open_store
+from imagectl.transfer import LINK_MODES
+from imagectl.watcher import DEFAULT_DEBOUNCE, DEFAULT_REWRITE_INTERVAL, Changes, open_watcher
+
+logger = logging.getLogger(__name__)
+
+class WatchCommand(ImageCommand):
+    """Command to keep the index of an image library current as it changes"""
+    NAME = 'watch'
+
+    def __init__(self, subparsers):
+        super().__init__(self)
+        self.cmd = subparsers.add_parser(self.NAME,
+                   help=COMMANDS[self.NAME].help)
+        self.cmd.add_argument("-i", "--input", help="base image directory")
+        self.cmd.add_argument("-o", "--output",
+                              help="also organise new and changed images into this directory")
+        self.cmd.add_argument("-m", "--move", action="store_true",
+                              help="move images organised to the output (default is to copy)")
+        self.cmd.add_argument("-l", "--link-mode", choices=LINK_MODES, default='auto',
+                              help="how to copy files, auto picks the cheapest that works (default: %(default)s)")
+        self.cmd.add_argument("-a", "--algorithm", choices=HASH_ALGORITHMS.keys(),
+                              default=DEFAULT_HASH_ALGORITHM,
+                              help="hash algorithm (default: %(default)s)")
+        self.cmd.add_argument("-j", "--jobs", type=int, default=1,
+                              help="number of files to hash in parallel (default: %(default)s)")
+        self.cmd.add_argument("-b", "--backend", choices=BACKENDS.keys(),
+                              help="index storage (default: the existing index or csv)")
+        self.cmd.add_argument("-p", "--perceptual", nargs="?", choices=PERCEPTUAL_ALGORITHMS.keys(),
+                              const=DEFAULT_PERCEPTUAL_ALGORITHM,
+                              help="also record a perceptual hash (default: %(const)s)")
+        self.cmd.add_argument("-d", "--debounce", type=float, default=DEFAULT_DEBOUNCE,
+                              help="seconds without changes before indexing them (default: %(default)s)")
+        self.cmd.add_argument("--poll", type=float, metavar="SECONDS",
+                              help="scan for changes at this interval instead of using inotify")
+        self.cmd.add_argument("--interval", type=float, metavar="SECONDS",
+                              help="least time between index updates (default: "
+                                   f"{DEFAULT_REWRITE_INTERVAL:g} for csv and binary indexes, "
+                                   "which are rewritten whole, otherwise none)")
+        self.tree = None
+
+    def execute(self, options: ImageCommandOptions):
+        logger.setLevel(options.verbose)
+        if options.input is None:
+            raise ValueError("Input collection must be specified")
+        if options.jobs < 1:
+            raise ValueError("Jobs must be at least 1")
+        if options.perceptual is not None:
+            check_algorithm(options.perceptual)
+        if options.input[-1:] == '/':
+            options.input = options.input[:-1]
+
+        # watch before scanning so nothing changed during the scan is missed
+        with open_watcher(options.input, options.poll) as watcher, \
+                open_store(options.input, options.backend) as store:
+            interval = options.interval
+            if not isinstance(store, SqliteIndexStore):
+                logger.warning("every update rewrites the whole of %s, convert it to sqlite "
+                               "for large libraries", store.path)
+                if interval is None:
+                    interval = DEFAULT_REWRITE_INTERVAL
+            logger.info("watching %s", options.input)
+            self.tree = None
+            self.apply(self.full_scan(options.input, store), store, options)
+            try:
+                for changes in watcher.batches(options.debounce, interval=interval or 0):
+                    if changes.rescan:
+                        changes = self.full_scan(options.input, store)
+                    self.apply(changes, store, options)
+            except KeyboardInterrupt:
+                logger.info("stopped watching %s", options.input)
+
+    @staticmethod
+    def full_scan(base: str, store: IndexStore) -> Changes:
+        """returns every image on disk or in the index as changed, unchanged
+           files are recognised by their size and times and not rehashed"""
+        changes = Changes()
+        if store.exists():
+            changes.files.update(entry.name for entry in store.entries())
+        else:
+            store.write([])
+        changes.files.update(rel_name for _, rel_name in walk_library(base))
+        return changes
+
+    def apply(self, changes: Changes, store: IndexStore, options: ImageCommandOptions):
+        """updates the index, and organises new images when there is an
+           output, for a batch of changes"""
+        base = options.input
+        files = set(changes.files)
+        for rel_dir in changes.dirs:
+            files.update(join(rel_dir, rel_name)
+                         for _, rel_name in walk_library(join(base, rel_dir)))
+
+        removed = set()
+        if changes.removed_dirs:
+            prefixes = tuple(join(rel_dir, '') for rel_dir in changes.removed_dirs)
+            removed.update(entry.name for entry in store.entries()
+                           if entry.name.startswith(prefixes))
+
+        if options.output is not None:
+            self.organise(sorted(files), store, options)
+
+        renamed, to_hash = [], []
+        for name in sorted(files):
+            try:
+                st = os.stat(join(base, name))
+            except FileNotFoundError:
+                removed.add(name)
+                continue
+            old_name = changes.renamed.get(name)
+            old = None if old_name is None else store.get(old_name)
+            entry = self.reuse_renamed(name, st, old)
+            if entry is None:
+                to_hash.append((join(base, name), name))
+            else:
+                renamed.append(entry)
+
+        indexed = [entry for entry in ordered_map(
+            self.index_file, ((qual_name, rel_name, options, store)
+                              for qual_name, rel_name in to_hash),
+            options.jobs, 'hasher')
+            if entry is not None and not self.unchanged(store.get(entry.name), entry)]
+        removed.difference_update(entry.name for entry in renamed + indexed)
+        if removed:
+            store.remove(removed)
+        if renamed or indexed:
+            store.upsert(renamed + indexed)
+        if removed or renamed or indexed:
+            self.update_tree(store, {dirname(name) for name in removed}
+                             | {dirname(entry.name) for entry in renamed + indexed})
+        logger.info("updated %s: %d indexed, %d renamed, %d removed",
+                    base, len(indexed), len(renamed), len(removed))
+
+    def update_tree(self, store: IndexStore, dirs: set[str]):
+        """saves the directory digests of the index, recomputing only those
+           of dirs and the directories above them once they are known"""
+        if self.tree is None:
+            self.tree = load_tree(store)
+        else:
+            self.tree = update_tree(self.tree, store, dirs)
+            write_tree(store, self.tree)
+
+    @staticmethod
+    def unchanged(old: IndexEntry | None, entry: IndexEntry) -> bool:
+        """true if the index already holds entry"""
+        return (old is not None and old.same_stat(entry)
+                and old.hash == entry.hash and old.phash == entry.phash)
+
+    @staticmethod
+    def reuse_renamed(name: str, st: os.stat_result, old: IndexEntry | None) -> IndexEntry | None:
+        """returns an entry for a renamed file with the hashes it had under
+           its old name, or None if it changed too"""
+        entry = IndexEntry.from_stat(name, st)
+        # renaming updates the created (change) time but never the modified
+        if old is None or not old.hash or old.size != entry.size or old.modified != entry.modified:
+            return None
+        return entry.copy_content(old)
+
+    @staticmethod
+    def index_file(qual_name: str, rel_name: str, options: ImageCommandOptions,
+                   previous: IndexStore) -> IndexEntry | None:
+        """returns the entry for a file, or None if it went away meanwhile"""
+        try:
+            return index_file(qual_name, rel_name, options.algorithm, previous,
+                              options.perceptual)
+        except FileNotFoundError:
+            return None
+
+    def organise(self, names: list[str], store: IndexStore, options: ImageCommandOptions):
+        """organises the new and modified images into the output and adds
+           them to its index, if it has one"""
+        from imagectl.__main__ import commands
+        organiser = commands['organise']
+        organiser.link_mode = options.link_mode
+        output_store = open_store(options.output)
+        organised = []
+        with output_store:
+            for name in names:
+                qual_name = join(options.input, name)
+                try:
+                    entry = IndexEntry.from_stat(name, os.stat(qual_name))
+                except FileNotFoundError:
+                    continue
+                old = store.get(name)
+                if old is not None and old.same_stat(entry):
+                    continue # already organised when it last changed
+                new_file_path = organiser.get_destination(qual_name, options.output)
+                if new_file_path is None:
+                    continue
+                try:
+                    organiser.write_image(qual_name, new_file_path, options.move)
+                except OSError as err:
+                    logger.error('cannot organise %s: %s', qual_name, err)
+                    continue
+                if output_store.exists() and os.path.exists(new_file_path):
+                    organised.append(index_file(new_file_path, relpath(new_file_path, options.output),
+                                                options.algorithm))
+            if organised:
+                output_store.upsert(organised)
@@ -19,11 +19,31 @@
 """
 constants.py
 """
-from importlib.metadata import version
 
-TOOL = {
-    "name": "imagectl",
-    "version":  version(__package__),
-}
+class _ToolInfo(dict):
+    """details of the tool, reading the installed version only when asked
+       as importlib.metadata is slow to import"""
+    def __missing__(self, key):
+        if key != "version":
+            raise KeyError(key)
+        from importlib.metadata import version
+        self[key] = version(__package__)
+        return self[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+TOOL = _ToolInfo(name="imagectl")
 # Set list of valid file extensions
-valid_extensions = [".heic", ".jpg", ".jpeg", ".png"]
\ No newline at end of file
+valid_extensions = [".heic", ".jpg", ".jpeg", ".png"]
+# Hash algorithm used for index entries, md5 keeps existing indexes valid
+DEFAULT_HASH_ALGORITHM = "md5"
+# Size of the buffer used when reading files to hash them
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Bytes read from each end of a file to cheaply rule out duplicates
+PARTIAL_HASH_SIZE = 4 * 1024
+# Operations of each kind kept in flight by the asyncio engine, for network storage
+DEFAULT_IO_DEPTH = 32
@@ -0,0 +1,87 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+duplicates.py
+
+Content based duplicate detection. Candidates are narrowed down by file
+size, then by a partial hash of both ends of each file, so full hashes are
+only calculated for files that are still indistinguishable. Collections that
+are already indexed are merged by the size and hash in their indexes.
+"""
+from collections import defaultdict
+import logging
+from os.path import join
+from typing import Callable, Hashable, Iterable, Iterator, NamedTuple
+
+from imagectl.hashing import algorithm_for_digest, get_hash, get_partial_hash
+
+logger = logging.getLogger(__name__)
+
+class Candidate(NamedTuple):
+    """A file that may have duplicates, ordered by collection then name"""
+    collection: int
+    name: str
+    path: str
+    size: int
+
+def _collisions(files: Iterable[Candidate],
+                key: Callable[[Candidate], Hashable]) -> list[list[Candidate]]:
+    """groups files by key, returning only groups with more than one file"""
+    groups = defaultdict(list)
+    for f in files:
+        groups[key(f)].append(f)
+    return [group for group in groups.values() if len(group) > 1]
+
+def find_duplicates(files: Iterable[Candidate]) -> list[list[Candidate]]:
+    """returns groups of byte identical files, each group and the list of
+       groups sorted so the first file is the one to keep"""
+    by_size = _collisions(files, lambda f: f.size)
+    logger.info('%d sizes shared by more than one file', len(by_size))
+
+    by_partial = [group for candidates in by_size
+                  for group in _collisions(candidates, lambda f: get_partial_hash(f.path))]
+    logger.info('%d groups left after partial hashing', len(by_partial))
+
+    duplicates = [sorted(group) for candidates in by_partial
+                  for group in _collisions(candidates, lambda f: get_hash(f.path))]
+    return sorted(duplicates)
+
+class ContentIndex:
+    """The files of any number of collections by content, merged from their
+       indexes in a single pass. Entries are bucketed by size first, most
+       sizes are unique so their hashes are never compared."""
+    def __init__(self):
+        self.by_size: dict[int, dict[str, list[Candidate]]] = defaultdict(lambda: defaultdict(list))
+        self.algorithms: set[str] = set()
+
+    def add(self, collection: int, base_dir: str, entry) -> None:
+        """adds an index entry of the collection rooted at base_dir"""
+        if not entry.hash:
+            logger.warning('%s has no hash in the index of %s, ignored', entry.name, base_dir)
+            return
+        self.algorithms.add(algorithm_for_digest(entry.hash))
+        self.by_size[entry.size][entry.hash].append(
+            Candidate(collection, entry.name, join(base_dir, entry.name), entry.size))
+
+    def groups(self) -> Iterator[tuple[str, list[Candidate]]]:
+        """yields the hash and files of every set of identical files, the
+           file to keep first, and every unique file alone"""
+        for size in sorted(self.by_size):
+            for hash, files in self.by_size[size].items():
+                yield hash, sorted(files)
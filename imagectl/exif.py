@@ -0,0 +1,332 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+exif.py
+
+A minimal EXIF reader that finds the TIFF structure inside a JPEG APP1
+segment or the Exif item of a HEIF file without decoding the image.
+Only the first few KB of most files are touched, Pillow is used for any
+file this reader cannot make sense of. The same parsing gives the metadata
+recorded in the index from the first chunk read while hashing.
+"""
+import logging
+import mmap
+import re
+import struct
+from typing import NamedTuple
+
+from imagectl.imaging import open_image
+from imagectl.metrics import current_metrics
+
+logger = logging.getLogger(__name__)
+
+# EXIF date taken is tag 36867 (DateTimeOriginal), 306 (DateTime), or 36865,
+# looked up in the order Pillow's getexif presents them
+DATE_TAGS = (36867, 306, 36865)
+MODEL_TAG = 272
+ORIENTATION_TAG = 274
+# pointer to the Exif IFD, which holds the pixel dimensions
+EXIF_IFD_TAG = 34665
+PIXEL_X_TAG = 40962
+PIXEL_Y_TAG = 40963
+# Largest number of bytes scanned for the JPEG APP1 segment or HEIF meta box
+MAX_HEADER_SCAN = 256 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# A date taken as recorded in the index, anything else is not recorded
+TAKEN_PATTERN = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d')
+
+class ImageMetadata(NamedTuple):
+    """What the index records about an image besides its hashes, date taken
+       is ISO formatted, 'YYYY-MM-DDTHH:MM:SS'"""
+    taken: str | None = None
+    width: int | None = None
+    height: int | None = None
+    model: str | None = None
+    orientation: int | None = None
+
+ASCII, SHORT, LONG = 2, 3, 4
+TYPE_SIZES = {1: 1, ASCII: 1, SHORT: 2, LONG: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+def _read_value(data, endian: str, type: int, count: int, offset: int):
+    if type == ASCII:
+        return bytes(data[offset:offset + count]).split(b'\0', 1)[0].decode('latin-1')
+    if type == SHORT or type == LONG:
+        fmt = endian + ('H' if type == SHORT else 'L') * count
+        values = struct.unpack_from(fmt, data, offset)
+        return values[0] if count == 1 else values
+    return None # types not needed by imagectl are skipped
+
+def parse_ifd(data, offset: int, endian: str) -> dict[int, object]:
+    """returns the ASCII, SHORT and LONG values of a TIFF image file directory"""
+    tags = {}
+    count, = struct.unpack_from(endian + 'H', data, offset)
+    for i in range(count):
+        tag, type, n, value = struct.unpack_from(endian + 'HHL4s', data, offset + 2 + i * 12)
+        size = TYPE_SIZES.get(type, 0) * n
+        if size == 0 or type not in (ASCII, SHORT, LONG):
+            continue
+        if size <= 4:
+            tags[tag] = _read_value(value, endian, type, n, 0)
+        else:
+            value_offset, = struct.unpack(endian + 'L', value)
+            if value_offset + size <= len(data):
+                tags[tag] = _read_value(data, endian, type, n, value_offset)
+    return tags
+
+def parse_tiff(data) -> tuple[dict, str, int]:
+    """returns the first IFD of the TIFF structure in data with its byte
+       order and offset"""
+    if data[:2] == b'II':
+        endian = '<'
+    elif data[:2] == b'MM':
+        endian = '>'
+    else:
+        raise ValueError('not a TIFF header')
+    magic, ifd0 = struct.unpack_from(endian + 'HL', data, 2)
+    if magic != 42:
+        raise ValueError('not a TIFF header')
+    return parse_ifd(data, ifd0, endian), endian, ifd0
+
+def _jpeg_exif(data, size: bool = False) -> bytes | tuple | None:
+    """returns the TIFF structure from the APP1 segment of a JPEG, or None if
+       there is none before the image data, and if size is true the width and
+       height from its start of frame too; raises ValueError if the segments
+       run past the bytes scanned, so the caller can fall back to Pillow"""
+    tiff = None
+    pos = 2
+    limit = min(len(data), MAX_HEADER_SCAN)
+    while pos + 4 <= limit:
+        if data[pos] != 0xFF:
+            raise ValueError('corrupt JPEG marker')
+        marker = data[pos + 1]
+        if marker == 0xFF: # fill byte
+            pos += 1
+            continue
+        if marker in (0xD9, 0xDA): # end of image or start of scan
+            break
+        length, = struct.unpack_from('>H', data, pos + 2)
+        if marker == 0xE1 and tiff is None and data[pos + 4:pos + 10] == b'Exif\0\0':
+            if pos + 2 + length > len(data):
+                raise ValueError('EXIF segment runs past the bytes read')
+            tiff = data[pos + 10:pos + 2 + length]
+            if not size:
+                return tiff
+        elif size and 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack_from('>HH', data, pos + 5)
+            return tiff, (width, height)
+        pos += 2 + length
+    else:
+        if not size or tiff is None:
+            raise ValueError('no start of scan within the bytes scanned')
+    return (tiff, None) if size else tiff
+
+def _boxes(data, start: int, end: int):
+    """yields the type, payload start and end of the ISOBMFF boxes in a range"""
+    pos = start
+    while pos + 8 <= end:
+        size, type = struct.unpack_from('>L4s', data, pos)
+        header = 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, pos + 8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError('corrupt ISOBMFF box')
+        yield type, pos + header, min(pos + size, end)
+        pos += size
+
+def _heif_exif_location(data, start: int, end: int) -> tuple[int, int] | None:
+    """returns the offset and length of the Exif item described by a meta box,
+       or None if there is no Exif item"""
+    exif_id = None
+    locations = {}
+    for type, payload, box_end in _boxes(data, start + 4, end): # skip version/flags
+        if type == b'iinf':
+            version = data[payload]
+            pos = payload + (8 if version else 6) # version/flags and entry count
+            for infe, infe_start, _ in _boxes(data, pos, box_end):
+                if infe != b'infe' or data[infe_start] < 2:
+                    continue
+                if data[infe_start] == 2:
+                    item_id, = struct.unpack_from('>H', data, infe_start + 4)
+                    item_type = data[infe_start + 8:infe_start + 12]
+                else:
+                    item_id, = struct.unpack_from('>L', data, infe_start + 4)
+                    item_type = data[infe_start + 10:infe_start + 14]
+                if item_type == b'Exif':
+                    exif_id = item_id
+        elif type == b'iloc':
+            locations = _parse_iloc(data, payload)
+    if exif_id is None:
+        return None
+    if locations.get(exif_id) is None:
+        raise ValueError('Exif item location not supported')
+    return locations[exif_id]
+
+def _parse_iloc(data, pos: int) -> dict[int, tuple[int, int]]:
+    """returns the offset and length of the first extent of each item, or
+       None for items not stored in the file (construction method 0)"""
+    def read(size, at):
+        return int.from_bytes(data[at:at + size], 'big'), at + size
+
+    version = data[pos]
+    pos += 4
+    offset_size, length_size = data[pos] >> 4, data[pos] & 0xF
+    base_offset_size, index_size = data[pos + 1] >> 4, data[pos + 1] & 0xF
+    pos += 2
+    item_count, pos = read(4 if version == 2 else 2, pos)
+    items = {}
+    for _ in range(item_count):
+        item_id, pos = read(4 if version == 2 else 2, pos)
+        method = 0
+        if version in (1, 2):
+            method, pos = read(2, pos)
+            method &= 0xF
+        pos += 2 # data reference index
+        base, pos = read(base_offset_size, pos)
+        extents, pos = read(2, pos)
+        for n in range(extents):
+            if version in (1, 2) and index_size:
+                pos += index_size
+            offset, pos = read(offset_size, pos)
+            length, pos = read(length_size, pos)
+            if n == 0:
+                items[item_id] = (base + offset, length) if method == 0 else None
+    return items
+
+def _heif_exif(data) -> bytes | None:
+    """returns the TIFF structure from the Exif item of a HEIF file, or None
+       if it has none; raises ValueError if the meta box or item lie past the
+       bytes scanned, so the caller can fall back to Pillow"""
+    limit = min(len(data), MAX_HEADER_SCAN)
+    for type, payload, end in _boxes(data, 0, limit):
+        if type == b'meta':
+            if end == limit < len(data):
+                raise ValueError('meta box runs past the bytes scanned')
+            location = _heif_exif_location(data, payload, end)
+            if location is None:
+                return None
+            offset, length = location
+            if offset + length > len(data):
+                raise ValueError('Exif item lies past the bytes read')
+            # the item starts with the offset of the TIFF header within it
+            skip, = struct.unpack_from('>L', data, offset)
+            return data[offset + 4 + skip:offset + length]
+    if limit < len(data):
+        raise ValueError('no meta box within the bytes scanned')
+    return None
+
+def read_exif(in_file: str) -> dict[int, object] | None:
+    """returns the first IFD of the file's EXIF data, which is empty if there
+       is none, or None if the file is not a JPEG or HEIF this can parse"""
+    with open(in_file, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            return None
+        with data:
+            try:
+                if data[:2] == b'\xff\xd8':
+                    tiff = _jpeg_exif(data)
+                elif data[4:8] == b'ftyp':
+                    tiff = _heif_exif(data)
+                else:
+                    return None
+                return {} if tiff is None else parse_tiff(tiff)[0]
+            except (ValueError, struct.error, IndexError) as e:
+                logger.debug('cannot parse EXIF of %s: %s', in_file, e)
+                return None
+
+def _iso_date(value) -> str | None:
+    # blank or malformed dates, such as '    :  :     ', are not recorded
+    if not isinstance(value, str):
+        return None
+    date = value.strip().replace(':', '-', 2).replace(' ', 'T', 1)
+    return date if TAKEN_PATTERN.fullmatch(date) else None
+
+def _metadata(tags, size: tuple[int, int] | None, exif_ifd: dict | None = None) -> ImageMetadata:
+    taken = next((date for date in map(_iso_date, (tags.get(tag) for tag in DATE_TAGS))
+                  if date is not None), None)
+    if size is None and exif_ifd and exif_ifd.get(PIXEL_X_TAG) and exif_ifd.get(PIXEL_Y_TAG):
+        size = exif_ifd[PIXEL_X_TAG], exif_ifd[PIXEL_Y_TAG]
+    model = tags.get(MODEL_TAG)
+    orientation = tags.get(ORIENTATION_TAG)
+    return ImageMetadata(taken, *(size or (None, None)),
+                         model.strip() or None if isinstance(model, str) else None,
+                         orientation if isinstance(orientation, int) else None)
+
+def parse_metadata(data) -> ImageMetadata | None:
+    """returns the metadata of an image from its first bytes, or None if it
+       is not a JPEG, HEIF or PNG this can parse"""
+    try:
+        if data[:8] == PNG_SIGNATURE:
+            return None # dates are only found by Pillow, if at all
+        if data[:2] == b'\xff\xd8':
+            tiff, size = _jpeg_exif(data, size=True)
+        elif data[4:8] == b'ftyp':
+            tiff, size = _heif_exif(data), None
+        else:
+            return None
+        if tiff is None:
+            return ImageMetadata(None, *(size or (None, None)))
+        tags, endian, _ = parse_tiff(tiff)
+        exif_ifd = None
+        if size is None and isinstance(tags.get(EXIF_IFD_TAG), int):
+            exif_ifd = parse_ifd(tiff, tags[EXIF_IFD_TAG], endian)
+        return _metadata(tags, size, exif_ifd)
+    except (ValueError, struct.error, IndexError):
+        return None
+
+def _pillow_metadata(in_file: str) -> ImageMetadata:
+    logger.debug('reading metadata of %s with Pillow', in_file)
+    try:
+        with open_image(in_file) as image:
+            return _metadata(image.getexif(), image.size)
+    except Exception as e:
+        logger.warning('cannot read metadata of %s: %s', in_file, e)
+        return ImageMetadata()
+
+def read_metadata(in_file: str, head=None) -> ImageMetadata:
+    """returns the metadata of an image, parsed from head, the first bytes
+       of the file if they have already been read, or else the file itself,
+       falling back to Pillow"""
+    with current_metrics().stage('exif'):
+        metadata = None if head is None else parse_metadata(head)
+        if not any(metadata or ()):
+            with open(in_file, 'rb') as f:
+                try:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        metadata = parse_metadata(data)
+                except ValueError: # empty file
+                    return ImageMetadata()
+        if metadata is None:
+            metadata = _pillow_metadata(in_file)
+        return metadata
+
+def get_date_taken(in_file: str) -> str | None:
+    """returns the EXIF date taken of an image, as 'YYYY:MM:DD HH:MM:SS',
+       parsing the file directly or falling back to Pillow"""
+    with current_metrics().stage('exif'):
+        tags = read_exif(in_file)
+        if tags is None:
+            logger.debug('reading EXIF of %s with Pillow', in_file)
+            with open_image(in_file) as image:
+                tags = image.getexif()
+    return next((tags.get(tag) for tag in DATE_TAGS if tags.get(tag)), None)
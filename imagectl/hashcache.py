@@ -0,0 +1,161 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+hashcache.py
+
+A persistent cache of file hashes shared by every command, keyed by device,
+inode, size and modification time so a file is only read again once it
+changes, whichever path it is reached through.
+"""
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Largest number of hashes kept, the least recently used are evicted
+DEFAULT_MAX_ENTRIES = 5_000_000
+# Number of writes between commits, a crash loses at most this many hashes
+COMMIT_INTERVAL = 1000
+# Files modified this recently are not cached because a further write in the
+# same clock tick would not change their modification time
+RACY_SECONDS = 2
+
+def default_path() -> str:
+    """returns the cache file location under $XDG_CACHE_HOME"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'imagectl', 'hashes.db')
+
+class HashCache:
+    """Hashes stored in an SQLite database"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS hashes (
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            algorithm TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            used INTEGER NOT NULL,
+            PRIMARY KEY (dev, ino, algorithm)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used);
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # a connection must not be shared with a forked child process
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False,
+                                         timeout=30, isolation_level='DEFERRED')
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+            self._pid = os.getpid()
+            self._writes = 0
+        return self._conn
+
+    def lookup(self, st: os.stat_result, algorithm: str) -> str | None:
+        """returns the cached digest of the file st describes, if unchanged"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND algorithm = ? "
+                "AND size = ? AND mtime_ns = ?",
+                (st.st_dev, st.st_ino, algorithm, st.st_size, st.st_mtime_ns)).fetchone()
+            if row is None:
+                return None
+            self._write("UPDATE hashes SET used = ? WHERE dev = ? AND ino = ? AND algorithm = ?",
+                        (int(time.time()), st.st_dev, st.st_ino, algorithm))
+            return row[0]
+
+    def store(self, st: os.stat_result, algorithm: str, digest: str):
+        """records the digest of the file st describes"""
+        if st.st_mtime_ns > (time.time() - RACY_SECONDS) * 1e9:
+            return
+        with self._lock:
+            self._write("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (st.st_dev, st.st_ino, algorithm, st.st_size,
+                         st.st_mtime_ns, digest, int(time.time())))
+
+    def _write(self, sql: str, params: tuple):
+        self.conn.execute(sql, params)
+        self._writes += 1
+        if self._writes >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """saves pending writes and evicts the least recently used hashes"""
+        with self._lock:
+            if self._conn is None or self._pid != os.getpid():
+                return
+            excess = self._conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0] \
+                     - self.max_entries
+            if excess > 0:
+                self._conn.execute("DELETE FROM hashes WHERE (dev, ino, algorithm) IN "
+                                   "(SELECT dev, ino, algorithm FROM hashes ORDER BY used LIMIT ?)",
+                                   (excess,))
+            self._conn.commit()
+            self._writes = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self.commit()
+                self._conn.close()
+                self._conn = None
+
+_cache: HashCache | None = None
+_enabled = os.environ.get('IMAGECTL_HASH_CACHE', 'on').lower() not in ('0', 'off', 'false', 'no')
+
+def configure(enabled: bool = True, path: str = None,
+              max_entries: int = DEFAULT_MAX_ENTRIES):
+    """turns the shared cache on or off and sets its location and size"""
+    global _cache, _enabled
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+    _enabled = enabled
+    if enabled and path is not None:
+        _cache = HashCache(path, max_entries)
+
+def get_cache() -> HashCache | None:
+    """returns the shared cache, or None if caching is disabled"""
+    global _cache
+    if not _enabled:
+        return None
+    if _cache is None:
+        _cache = HashCache(default_path())
+    return _cache
+
+@atexit.register
+def _close():
+    if _cache is not None:
+        _cache.close()
@@ -0,0 +1,118 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+hashing.py
+
+Streaming file hashing. Files are read in fixed size chunks into a single
+reusable buffer so memory use does not depend on the size of the file.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+from typing import Callable
+
+from imagectl import hashcache
+from imagectl.constants import DEFAULT_CHUNK_SIZE, DEFAULT_HASH_ALGORITHM, PARTIAL_HASH_SIZE
+from imagectl.metrics import current_metrics
+
+logger = logging.getLogger(__name__)
+
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+
+def new_hasher(algorithm: str = DEFAULT_HASH_ALGORITHM):
+    """returns a fresh hash object for the named algorithm"""
+    try:
+        return HASH_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError(f'unsupported hash algorithm: {algorithm}') from None
+
+def hash_stream(stream, hasher, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                on_head: Callable[[bytes], None] = None):
+    """feeds the binary stream into hasher one chunk at a time, passing a
+       copy of the first chunk to on_head"""
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        n = stream.readinto(buf)
+        if not n:
+            break
+        if on_head is not None:
+            on_head(bytes(view[:n]))
+            on_head = None
+        hasher.update(view[:n])
+    return hasher
+
+def algorithm_for_digest(digest: str) -> str:
+    """returns the algorithm that produces hex digests the length of digest"""
+    for name, factory in HASH_ALGORITHMS.items():
+        if len(digest) == factory().digest_size * 2:
+            return name
+    return DEFAULT_HASH_ALGORITHM
+
+def _disable_cache(error: Exception):
+    logger.warning('hash cache disabled: %s', error)
+    hashcache.configure(enabled=False)
+
+def get_hash(in_file: str, algorithm: str = DEFAULT_HASH_ALGORITHM,
+             chunk_size: int = DEFAULT_CHUNK_SIZE, use_cache: bool = True,
+             on_head: Callable[[bytes], None] = None) -> str:
+    """returns the hash of the specified file, from the shared hash cache if
+       the file has not changed since it was last hashed, on_head is given
+       the first chunk of the file only if it is read"""
+    cache = hashcache.get_cache() if use_cache else None
+    with open(in_file, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        in_hash = None
+        if cache is not None:
+            try:
+                in_hash = cache.lookup(st, algorithm)
+            except sqlite3.Error as e:
+                _disable_cache(e)
+                cache = None
+            if in_hash is not None:
+                current_metrics().add('hash_cached', 0, bytes=st.st_size)
+        if in_hash is None:
+            with current_metrics().stage('hash', st.st_size):
+                in_hash = hash_stream(f, new_hasher(algorithm), chunk_size, on_head).hexdigest()
+            if cache is not None:
+                try:
+                    cache.store(st, algorithm, in_hash)
+                except sqlite3.Error as e:
+                    _disable_cache(e)
+    logger.debug('%s hash of %s is %s', algorithm, in_file, in_hash)
+    return in_hash
+
+def get_partial_hash(in_file: str, edge: int = PARTIAL_HASH_SIZE,
+                     algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    """returns a hash of just the first and last edge bytes of the file, a
+       cheap way to tell apart most files that happen to be the same size"""
+    hasher = new_hasher(algorithm)
+    with open(in_file, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= 2 * edge:
+            return hash_stream(f, hasher).hexdigest()
+        hasher.update(f.read(edge))
+        f.seek(-edge, os.SEEK_END)
+        hasher.update(f.read(edge))
+    return hasher.hexdigest()
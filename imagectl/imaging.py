@@ -0,0 +1,50 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+imaging.py
+
+Opening images with Pillow, including HEIC files when pillow_heif is
+installed.
+
+Pillow and the HEIF opener are imported on first use, commands that never
+decode an image should not pay for them.
+"""
+from functools import cache
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+@cache
+def _register_openers():
+    try:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+    except ImportError:
+        logger.warning("pillow_heif not installed, HEIC files will not be processable")
+
+def open_image(in_file: str) -> 'Image.Image':
+    """opens an image file, which the caller must close"""
+    from PIL import Image
+    _register_openers()
+    logger.debug('opening image: %s', in_file)
+    return Image.open(in_file)
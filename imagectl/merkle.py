@@ -0,0 +1,270 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+merkle.py
+
+Rolled up digests of every directory in an index, kept in a sidecar file
+next to it. A directory's files digest covers the name, size and hash of
+each image directly in it, its tree digest covers that and the tree digest
+of each child directory. Two collections with the same tree digest for a
+directory hold the same images below it, so a comparison only descends
+into the directories whose digests differ.
+"""
+from collections import defaultdict
+import hashlib
+import json
+import logging
+import os
+from os.path import basename, dirname, join
+from typing import Iterable, Iterator, NamedTuple
+
+from imagectl.hashing import algorithm_for_digest
+from imagectl.metrics import current_metrics
+from imagectl.storage import IndexStore
+
+logger = logging.getLogger(__name__)
+
+TREE_VERSION = 1
+DIGEST_SIZE = 16
+
+# Kinds of difference between two collections
+MISSING = 'missing'
+EXTRA = 'extra'
+DIFFERENT = 'different'
+
+class DirDigest(NamedTuple):
+    """The digests of a directory, and the images and bytes below it"""
+    tree: str
+    files: str
+    count: int
+    size: int
+
+class Difference(NamedTuple):
+    """An image, or a directory ending in '/', that is missing from the
+       target, extra in the target or different between them"""
+    kind: str
+    path: str
+    count: int
+    size: int
+
+def _digest(lines: Iterable[str]) -> str:
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for line in lines:
+        hasher.update(line.encode('utf-8'))
+    return hasher.hexdigest()
+
+class Tree:
+    """The digests of every directory in an index, by path relative to the
+       base of the collection with '' for the base itself"""
+    def __init__(self, dirs: dict[str, DirDigest], algorithm: str | None = None):
+        self.dirs = dirs
+        self.algorithm = algorithm
+        self._children = defaultdict(list)
+        for path in sorted(dirs):
+            if path:
+                self._children[dirname(path)].append(path)
+
+    def get(self, path: str) -> DirDigest | None:
+        return self.dirs.get(path)
+
+    def children(self, path: str) -> list[str]:
+        """returns the paths of the directories directly in path"""
+        return self._children.get(path, [])
+
+def build_tree(entries: Iterable) -> Tree:
+    """returns the digests of every directory holding the entries, and of
+       every directory above those"""
+    files = defaultdict(list)
+    algorithms = set()
+    for entry in entries:
+        files[dirname(entry.name)].append((basename(entry.name), entry.size, entry.hash or ''))
+        if entry.hash:
+            algorithms.add(algorithm_for_digest(entry.hash))
+    paths = set(files) | {''}
+    for path in list(paths):
+        while path:
+            path = dirname(path)
+            paths.add(path)
+
+    dirs = {}
+    children = defaultdict(list)
+    for path in paths:
+        if path:
+            children[dirname(path)].append(path)
+    for path in _deepest_first(paths):
+        own = sorted(files.get(path, ()))
+        dirs[path] = _dir_digest(_files_digest(own), len(own), sum(size for _, size, _ in own),
+                                 {child: dirs[child] for child in children[path]})
+    algorithm = algorithms.pop() if len(algorithms) == 1 else ('mixed' if algorithms else None)
+    return Tree(dirs, algorithm)
+
+def _deepest_first(paths: Iterable[str]) -> list[str]:
+    # so each child is complete before its parent
+    return sorted(paths, key=lambda p: -p.count('/') if p else 1)
+
+def _files_digest(own: list[tuple[str, int, str]]) -> str:
+    return _digest(f'{name}\0{size}\0{hash}\n' for name, size, hash in own)
+
+def _dir_digest(files_digest: str, count: int, size: int,
+                subdirs: dict[str, DirDigest]) -> DirDigest:
+    """returns the digests of a directory from those of its own files and
+       of its child directories"""
+    names = sorted(subdirs)
+    tree_digest = _digest([files_digest + '\n'] + [f'{basename(child)}\0{subdirs[child].tree}\n'
+                                                   for child in names])
+    return DirDigest(tree_digest, files_digest, count + sum(d.count for d in subdirs.values()),
+                     size + sum(d.size for d in subdirs.values()))
+
+def update_tree(tree: Tree, store: IndexStore, changed: Iterable[str]) -> Tree:
+    """returns the digests of the index in store given tree, those from
+       before the images in the changed directories were updated, reading
+       only the entries of those directories"""
+    dirs = dict(tree.dirs)
+    children = defaultdict(set)
+    for path in dirs:
+        if path:
+            children[dirname(path)].add(path)
+    own = {path: sorted((basename(entry.name), entry.size, entry.hash or '')
+                        for entry in store.find_in_directory(path))
+           for path in set(changed)}
+    affected = set()
+    for path in own:
+        affected.add(path)
+        while path:
+            children[dirname(path)].add(path) # a new directory joins its parent
+            path = dirname(path)
+            affected.add(path)
+
+    algorithm = tree.algorithm
+    for path in _deepest_first(affected):
+        if path in own:
+            files = own[path]
+            files_digest, count, size = _files_digest(files), len(files), \
+                                        sum(size for _, size, _ in files)
+            hashes = {algorithm_for_digest(hash) for _, _, hash in files if hash}
+            if algorithm is None and len(hashes) == 1:
+                algorithm = hashes.pop()
+            elif hashes - {algorithm}:
+                algorithm = 'mixed'
+        elif path in tree.dirs:
+            # only a child changed, the sizes of its own files are what its
+            # totals held beyond those of its children before
+            old = tree.dirs[path]
+            files_digest = old.files
+            count = old.count - sum(tree.dirs[child].count for child in tree.children(path))
+            size = old.size - sum(tree.dirs[child].size for child in tree.children(path))
+        else:
+            files_digest, count, size = _files_digest([]), 0, 0
+        subdirs = {child: dirs[child] for child in children[path] if child in dirs}
+        if path and not count and not subdirs:
+            dirs.pop(path, None) # nothing is left below it
+            continue
+        dirs[path] = _dir_digest(files_digest, count, size, subdirs)
+    return Tree(dirs, algorithm)
+
+def tree_path(store: IndexStore) -> str:
+    return store.path + '.tree'
+
+def _fingerprint(path: str) -> list[int]:
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+def write_tree(store: IndexStore, tree: Tree = None) -> Tree:
+    """saves the digests of the index in store next to it, building them
+       unless they are given"""
+    fingerprint = _fingerprint(store.path)
+    if tree is None:
+        with current_metrics().stage('tree', count=0):
+            tree = build_tree(store.entries())
+    path = tree_path(store)
+    temp = f'{path}.partial'
+    with open(temp, 'w') as f:
+        f.write(json.dumps({'tree': TREE_VERSION, 'index': fingerprint,
+                            'algorithm': tree.algorithm}) + '\n')
+        for dir_path in sorted(tree.dirs):
+            f.write(json.dumps([dir_path, *tree.dirs[dir_path]]) + '\n')
+    os.replace(temp, path)
+    return tree
+
+def read_tree(store: IndexStore) -> Tree | None:
+    """returns the saved digests of the index in store, or None if there are
+       none or the index has changed since they were saved"""
+    try:
+        with open(tree_path(store)) as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('tree') != TREE_VERSION or header.get('index') != _fingerprint(store.path):
+                return None
+            dirs = {}
+            for line in f:
+                dir_path, *digest = json.loads(line)
+                dirs[dir_path] = DirDigest(*digest)
+            return Tree(dirs, header.get('algorithm'))
+    except FileNotFoundError:
+        return None
+
+def load_tree(store: IndexStore) -> Tree:
+    """returns the digests of the index in store, rebuilding and saving them
+       if they are missing or out of date"""
+    tree = read_tree(store)
+    if tree is None:
+        logger.info('building directory digests of %s', store.path)
+        try:
+            tree = write_tree(store)
+        except OSError as err:
+            logger.warning('cannot save directory digests: %s', err)
+            tree = build_tree(store.entries())
+    return tree
+
+def diff_trees(left: Tree, right: Tree, left_store: IndexStore, right_store: IndexStore,
+               path: str = '') -> Iterator[Difference]:
+    """yields the differences below path going from left to right, reading
+       entries only for directories whose own files differ"""
+    metrics = current_metrics()
+    pending = [path]
+    while pending:
+        path = pending.pop()
+        ours, theirs = left.get(path), right.get(path)
+        if ours is None and theirs is None:
+            continue
+        if theirs is None:
+            yield Difference(MISSING, join(path, ''), ours.count, ours.size)
+            continue
+        if ours is None:
+            yield Difference(EXTRA, join(path, ''), theirs.count, theirs.size)
+            continue
+        if ours.tree == theirs.tree:
+            continue
+        if ours.files != theirs.files:
+            metrics.add('compare', 0) # a directory whose entries are read
+            yield from _diff_files(left_store.find_in_directory(path),
+                                   right_store.find_in_directory(path))
+        # reversed so the directories come off the stack in name order
+        pending.extend(sorted(set(left.children(path)) | set(right.children(path)), reverse=True))
+
+def _diff_files(left: Iterable, right: Iterable) -> Iterator[Difference]:
+    ours = {entry.name: entry for entry in left}
+    theirs = {entry.name: entry for entry in right}
+    for name in sorted(ours.keys() | theirs.keys()):
+        old, new = ours.get(name), theirs.get(name)
+        if new is None:
+            yield Difference(MISSING, name, 1, old.size)
+        elif old is None:
+            yield Difference(EXTRA, name, 1, new.size)
+        elif old.size != new.size or (old.hash or '') != (new.hash or ''):
+            yield Difference(DIFFERENT, name, 1, new.size)
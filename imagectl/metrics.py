@@ -0,0 +1,216 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+metrics.py
+
+Counters and latency histograms of the files, bytes and time spent in each
+stage of a command, shared by every command through current_metrics(), with
+a reporter for progress while a command runs and JSON or Prometheus output
+when it finishes.
+"""
+from contextlib import contextmanager
+from datetime import timedelta
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets, 100us to ~26s
+BUCKETS = tuple(round(0.0001 * 4 ** i, 4) for i in range(10))
+# Seconds between progress reports when enabled without an interval
+DEFAULT_PROGRESS_INTERVAL = 10.0
+
+class Stage:
+    """Totals for one stage, time is summed across every thread"""
+    __slots__ = ('count', 'bytes', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        # the last bucket counts anything slower than the largest bound
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds: float, count: int, bytes: int):
+        self.count += count
+        self.bytes += bytes
+        self.seconds += seconds
+        if count:
+            self.buckets[next((i for i, bound in enumerate(BUCKETS) if seconds <= bound),
+                              len(BUCKETS))] += 1
+
+    def rate(self) -> float:
+        """files per second of time spent in this stage"""
+        return self.count / self.seconds if self.seconds else 0.0
+
+    def percentile(self, fraction: float) -> float:
+        """returns the bucket bound below which fraction of the files took"""
+        wanted = fraction * sum(self.buckets)
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.buckets):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'bytes': self.bytes, 'seconds': self.seconds,
+                'buckets': {str(bound): count for bound, count
+                            in zip(BUCKETS + ('+Inf',), self.buckets)}}
+
+    def __str__(self) -> str:
+        return f'{self.count} files, {self.bytes / 1e6:.1f} MB in {self.seconds:.2f}s ' \
+               f'({self.rate():.1f} files/s, {self.bytes / 1e6 / (self.seconds or 1):.1f} MB/s, ' \
+               f'p50 <{self.percentile(0.5) * 1000:g}ms, p99 <{self.percentile(0.99) * 1000:g}ms)'
+
+class Metrics:
+    """Thread safe per stage counters"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: dict[str, Stage] = {}
+        # files a command has finished with, and how many it expects to
+        self.done = 0
+        self.total = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, count: int = 1, bytes: int = 0):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage()
+            stage.observe(seconds, count, bytes)
+
+    @contextmanager
+    def stage(self, name: str, bytes: int = 0, count: int = 1):
+        """times the enclosed block as count files processed by the named stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, count, bytes)
+
+    def expect(self, total: int):
+        """sets the number of files the command will process, for the ETA"""
+        self.total = total
+
+    def progress(self, count: int = 1):
+        """records count more files finished with"""
+        with self._lock:
+            self.done += count
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> list[str]:
+        """returns a line per stage followed by the elapsed time"""
+        lines = [f'{name}: {stage}' for name, stage in self.stages.items()]
+        lines.append(f'elapsed: {self.elapsed():.2f}s')
+        return lines
+
+    def to_json(self) -> str:
+        with self._lock:
+            return json.dumps({'elapsed': self.elapsed(), 'done': self.done,
+                               'total': self.total,
+                               'stages': {name: stage.to_dict()
+                                          for name, stage in self.stages.items()}},
+                              indent=2)
+
+    def to_prometheus(self, command: str) -> str:
+        """returns the metrics in the Prometheus text format, for the node
+           exporter's textfile collector"""
+        labels = f'command="{command}"'
+        lines = ['# TYPE imagectl_elapsed_seconds gauge',
+                 f'imagectl_elapsed_seconds{{{labels}}} {self.elapsed()}',
+                 '# TYPE imagectl_files_done gauge',
+                 f'imagectl_files_done{{{labels}}} {self.done}',
+                 '# TYPE imagectl_stage_bytes_total counter']
+        with self._lock:
+            # every sample of a metric must follow its TYPE line together
+            for name, stage in self.stages.items():
+                lines.append(f'imagectl_stage_bytes_total{{{labels},stage="{name}"}} {stage.bytes}')
+            lines.append('# TYPE imagectl_stage_seconds histogram')
+            for name, stage in self.stages.items():
+                stage_labels = f'{labels},stage="{name}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), stage.buckets):
+                    cumulative += count
+                    lines.append(f'imagectl_stage_seconds_bucket{{{stage_labels},le="{bound}"}} {cumulative}')
+                lines.append(f'imagectl_stage_seconds_sum{{{stage_labels}}} {stage.seconds}')
+                lines.append(f'imagectl_stage_seconds_count{{{stage_labels}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, command: str):
+        """writes the metrics to path, as Prometheus text if it ends .prom
+           or else JSON, replacing it atomically for collectors reading it"""
+        content = self.to_prometheus(command) if path.endswith('.prom') else self.to_json()
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'w') as f:
+            f.write(content)
+        os.replace(temp, path)
+
+_current = Metrics()
+
+def current_metrics() -> Metrics:
+    """returns the metrics of the command running"""
+    return _current
+
+def reset_metrics() -> Metrics:
+    """starts new metrics for a command, returning them"""
+    global _current
+    _current = Metrics()
+    return _current
+
+class ProgressReporter:
+    """logs the rate of progress, and the time left when the total is known,
+       every interval seconds while a command runs"""
+    def __init__(self, command: str, interval: float | None):
+        self.command = command
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def report(self):
+        metrics = current_metrics()
+        elapsed = metrics.elapsed()
+        rate = metrics.done / elapsed if elapsed else 0.0
+        if metrics.total:
+            left = timedelta(seconds=round((metrics.total - metrics.done) / rate)) if rate else '?'
+            logger.warning('%s: %d/%d files (%.1f%%), %.1f files/s, eta %s', self.command,
+                           metrics.done, metrics.total, 100 * metrics.done / metrics.total,
+                           rate, left)
+        else:
+            logger.warning('%s: %d files, %.1f files/s', self.command, metrics.done, rate)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def __enter__(self):
+        if self.interval:
+            self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
@@ -16,18 +16,33 @@
 # Command line client for managing an image library.
 #
 ###############################################################################
-from datetime import datetime
-import hashlib
+from datetime import datetime, timedelta
+import heapq
 from hmac import compare_digest
+from itertools import islice
 import logging
-from os.path import join, getctime, getmtime, getsize
+import os
+from os.path import join
+import tempfile
+from typing import Any, Callable, Iterable, Iterator
 from urllib.parse import quote, unquote
 
-from imagectl.__main__ import get_hash
-from pydantic import BaseModel, model_serializer
+from imagectl.constants import DEFAULT_HASH_ALGORITHM, TOOL
+from imagectl.exif import ImageMetadata, read_metadata
+from imagectl.hashing import algorithm_for_digest, get_hash
+from pydantic import BaseModel, ValidationError, model_serializer
 
 logger = logging.getLogger(__name__)
 
+# Lines sorted in memory at a time, larger indexes are sorted in runs of
+# this many that are merged from temporary files
+SORT_RUN_SIZE = 500_000
+
+# Metadata of an image recorded in the index
+METADATA_FIELDS = ('taken', 'width', 'height', 'model', 'orientation')
+# Columns after the hash, in order, each may be empty or missing
+OPTIONAL_FIELDS = ('phash', *METADATA_FIELDS)
+
 class IndexEntry(BaseModel):
     """An index entry"""
     name: str
@@ -35,31 +50,172 @@ class IndexEntry(BaseModel):
     modified: str
     size: int
     hash: str = None
+    phash: str | None = None
+    # metadata read along with the hash
+    taken: str | None = None
+    width: int | None = None
+    height: int | None = None
+    model: str | None = None
+    orientation: int | None = None
 
     @classmethod
     def from_str(cls, s: str) -> "IndexEntry":
-        fields = s.split(',')
+        fields = s.rstrip('\n').split(',')
+        # optional trailing columns, missing or empty when not recorded
+        extra = [field.strip() or None for field in fields[5:5 + len(OPTIONAL_FIELDS)]]
+        extra += [None] * (len(OPTIONAL_FIELDS) - len(extra))
+        phash, taken, width, height, model, orientation = extra
         return IndexEntry(name=unquote(fields[0]),
                           created=fields[1],
                           modified=fields[2], size=fields[3],
-                          hash='' if fields[4] is None else fields[4])
+                          hash='' if fields[4] is None else fields[4].strip(),
+                          phash=phash, taken=taken, width=width, height=height,
+                          model=None if model is None else unquote(model),
+                          orientation=orientation)
+
+    @classmethod
+    def from_stat(cls, name: str, st) -> "IndexEntry":
+        """creates an entry, without hash, from the result of os.stat"""
+        return IndexEntry(name=name,
+                          created=datetime.fromtimestamp(st.st_ctime).isoformat(),
+                          modified=datetime.fromtimestamp(st.st_mtime).isoformat(),
+                          size=st.st_size)
+
+    def calc_hash(self, qual_name: str, algorithm: str = DEFAULT_HASH_ALGORITHM,
+                  metadata: bool = False):
+        """sets the hash, and the metadata if asked, reading the metadata
+           from the first chunk hashed"""
+        head = None
+        def keep_head(chunk: bytes):
+            nonlocal head
+            head = chunk
+        self.hash=get_hash(qual_name, algorithm, on_head=keep_head if metadata else None)
+        if metadata:
+            self.set_metadata(read_metadata(qual_name, head))
 
-    def calc_hash(self, qual_name: str):
-        self.hash=get_hash(qual_name)
+    def set_metadata(self, metadata: ImageMetadata):
+        self.taken, self.width, self.height, self.model, self.orientation = metadata
+
+    def has_metadata(self) -> bool:
+        """true if any metadata has been recorded"""
+        return any(getattr(self, field) is not None for field in METADATA_FIELDS)
+
+    def copy_content(self, other) -> "IndexEntry":
+        """sets the hashes and metadata to those of other, an entry for a
+           copy of the same file, returning self"""
+        self.hash = other.hash
+        for field in OPTIONAL_FIELDS:
+            setattr(self, field, getattr(other, field))
+        return self
+
+    def same_stat(self, other: "IndexEntry") -> bool:
+        """true if other has the same size, created and modified times"""
+        return (self.size == other.size \
+                and self.created == other.created \
+                and self.modified == other.modified)
+
+    def stat_matches(self, st: os.stat_result) -> bool:
+        """true if the result of os.stat has the indexed size and times"""
+        # compared as integer microseconds, allowing for the rounding of
+        # float timestamps when the index was written
+        return (self.size == st.st_size \
+                and same_time(datetime.fromisoformat(self.modified), st.st_mtime_ns) \
+                and same_time(datetime.fromisoformat(self.created), st.st_ctime_ns))
 
     def matches(self, qual_name: str) -> bool:
-        return (self.size == getsize(qual_name) \
-                and self.created == datetime.fromtimestamp(getctime(qual_name)).isoformat() \
-                and self.modified == datetime.fromtimestamp(getmtime(qual_name)).isoformat())
+        return self.stat_matches(os.stat(qual_name))
 
-    def hash_matches(self, qual_name: str) -> bool:
-        digest = get_hash(qual_name)
+    def hash_matches(self, qual_name: str, use_cache: bool = True) -> bool:
+        digest = get_hash(qual_name, algorithm_for_digest(self.hash.strip()),
+                          use_cache=use_cache)
         logger.debug('comparing file hash: %s with index: %s',
                         digest, self.hash)
         return compare_digest(self.hash.strip(), digest.strip())
 
     @model_serializer
     def ser_model(self) -> str:
+        # optional trailing columns are only written up to the last one set
+        extra = [getattr(self, field) for field in OPTIONAL_FIELDS]
+        while extra and extra[-1] is None:
+            extra.pop()
+        if self.model is not None and len(extra) > OPTIONAL_FIELDS.index('model'):
+            extra[OPTIONAL_FIELDS.index('model')] = quote(self.model, safe=' ')
+        trailing = ''.join(',' + ('' if value is None else str(value)) for value in extra)
         return f'{quote(self.name)},{self.created},'\
                 f'{self.modified},{self.size},'\
-                f'{"" if self.hash is None else self.hash}\n'
+                f'{"" if self.hash is None else self.hash}{trailing}\n'
+
+def iso_to_us(iso: str) -> int:
+    """returns an index timestamp as microseconds since the epoch"""
+    return round(datetime.fromisoformat(iso).timestamp() * 1_000_000)
+
+def wall_clock(ns: int) -> datetime:
+    """returns nanoseconds since the epoch as local time without a zone, as
+       the index records times"""
+    seconds, rest = divmod(ns, 1_000_000_000)
+    return datetime.fromtimestamp(seconds) + timedelta(microseconds=rest // 1000)
+
+def same_time(indexed: datetime, ns: int) -> bool:
+    """true if a time from the index is within a microsecond of a stat time.
+       Both are compared as local time, a time in the hour repeated when
+       daylight saving ends would otherwise match only one of the two."""
+    # allowing for the rounding of float timestamps when the index was written
+    return abs(indexed - wall_clock(ns)) <= timedelta(microseconds=1)
+
+def index_path(base_dir: str) -> str:
+    """returns the path of the index file for an image collection"""
+    return join(base_dir, f'.{TOOL.get("name")}')
+
+def read_index(path: str) -> Iterator[IndexEntry]:
+    """yields the entries of an index file, skipping any it cannot parse"""
+    with open(path, 'r') as index:
+        yield from parse_index(index)
+
+def parse_index(lines: Iterable[str]) -> Iterator[IndexEntry]:
+    """yields the entries of the lines of an index file, skipping any it
+       cannot parse"""
+    for line in lines:
+        if line.startswith('NAME,'):
+            continue # header
+        try:
+            yield IndexEntry.from_str(line)
+        except ValidationError:
+            logger.error('unable to parse %s', line)
+
+def line_name(line: str) -> str:
+    """returns the name of the entry on a line of an index file"""
+    name = line[:line.find(',')]
+    return unquote(name) if '%' in name else name
+
+def _spill(lines: list[str]):
+    run = tempfile.TemporaryFile('w+')
+    run.writelines(lines)
+    run.seek(0)
+    return run
+
+def sort_lines(lines: Iterable[str], key: Callable[[str], Any],
+               run_size: int = SORT_RUN_SIZE) -> Iterator[str]:
+    """yields lines, each ending in a newline, sorted by key, holding no more
+       than run_size in memory and merging sorted runs of the rest from disk"""
+    runs, last = [], []
+    lines = iter(lines)
+    try:
+        while chunk := list(islice(lines, run_size)):
+            if last:
+                runs.append(_spill(last))
+            last = sorted(chunk, key=key)
+        if runs:
+            yield from heapq.merge(*runs, last, key=key)
+        else:
+            yield from last
+    finally:
+        for run in runs:
+            run.close()
+
+def read_index_sorted(path: str, run_size: int = SORT_RUN_SIZE) -> Iterator[str]:
+    """yields the entry lines of an index file in name order, holding no more
+       than run_size lines in memory however large the index"""
+    with open(path, 'r') as index:
+        yield from sort_lines((line if line.endswith('\n') else line + '\n'
+                               for line in index if line.strip() and not line.startswith('NAME,')),
+                              line_name, run_size)
@@ -0,0 +1,193 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+perceptual.py
+
+Perceptual hashes that stay close when an image is re-encoded, resized or
+converted, and a BK-tree to find near matches by Hamming distance without
+comparing every pair of images.
+"""
+import importlib.util
+import logging
+from typing import TYPE_CHECKING, Any, Iterable, Iterator
+
+from imagectl.imaging import open_image
+from imagectl.metrics import current_metrics
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Width and height of the grid each hash is calculated from, 64 bits
+HASH_SIZE = 8
+# Largest Hamming distance considered a near duplicate by default
+DEFAULT_DISTANCE = 10
+DEFAULT_PERCEPTUAL_ALGORITHM = 'dhash'
+
+def _bits_to_int(bits: Iterable[bool]) -> int:
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bool(bit)
+    return value
+
+def _grey(image: 'Image.Image', width: int, height: int) -> 'Image.Image':
+    """returns a greyscale thumbnail, decoding as little of the image as
+       the format allows"""
+    from PIL import Image
+    # JPEG decodes directly at 1/2, 1/4 or 1/8 scale and resize reduces
+    # other formats by whole factors before resampling
+    image.draft('L', (width * 4, height * 4))
+    return image.convert('L').resize((width, height), Image.Resampling.LANCZOS,
+                                     reducing_gap=3.0)
+
+def ahash(image: 'Image.Image') -> int:
+    """average hash, one bit per pixel brighter than the mean"""
+    pixels = list(_grey(image, HASH_SIZE, HASH_SIZE).getdata())
+    mean = sum(pixels) / len(pixels)
+    return _bits_to_int(p > mean for p in pixels)
+
+def dhash(image: 'Image.Image') -> int:
+    """difference hash, one bit per pixel brighter than its right neighbour"""
+    pixels = list(_grey(image, HASH_SIZE + 1, HASH_SIZE).getdata())
+    width = HASH_SIZE + 1
+    return _bits_to_int(pixels[row * width + col] > pixels[row * width + col + 1]
+                        for row in range(HASH_SIZE) for col in range(HASH_SIZE))
+
+def phash(image: 'Image.Image') -> int:
+    """DCT hash, one bit per low frequency coefficient above the median"""
+    try:
+        import numpy
+    except ImportError as err:
+        raise ValueError("numpy must be installed to calculate phash") from err
+    size = HASH_SIZE * 4
+    pixels = numpy.asarray(_grey(image, size, size), dtype=numpy.float64)
+    k = numpy.arange(size)
+    dct = numpy.cos(numpy.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size))
+    low = (dct @ pixels @ dct.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    median = numpy.median(low[1:]) # ignore the DC term, overall brightness
+    return _bits_to_int(low > median)
+
+PERCEPTUAL_ALGORITHMS = {
+    'ahash': ahash,
+    'dhash': dhash,
+    'phash': phash,
+}
+
+def check_algorithm(algorithm: str):
+    """raises ValueError unless algorithm is supported and what it needs is
+       installed, so a command fails once rather than for every image"""
+    if algorithm not in PERCEPTUAL_ALGORITHMS:
+        raise ValueError(f'unsupported perceptual hash algorithm: {algorithm}')
+    if algorithm == 'phash' and importlib.util.find_spec('numpy') is None:
+        raise ValueError("numpy must be installed to calculate phash, "
+                         "install imagectl with the phash extra")
+
+def perceptual_hash(in_file: str, algorithm: str = DEFAULT_PERCEPTUAL_ALGORITHM) -> str | None:
+    """returns the perceptual hash of an image as 'algorithm:hex', or None if
+       the image cannot be decoded"""
+    from PIL import Image
+    try:
+        fn = PERCEPTUAL_ALGORITHMS[algorithm]
+    except KeyError:
+        raise ValueError(f'unsupported perceptual hash algorithm: {algorithm}') from None
+    try:
+        with current_metrics().stage('perceptual'), open_image(in_file) as image:
+            value = fn(image)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning('cannot calculate %s of %s: %s', algorithm, in_file, e)
+        return None
+    return f'{algorithm}:{value:0{HASH_SIZE * HASH_SIZE // 4}x}'
+
+def parse_perceptual_hash(value: str) -> tuple[str, int]:
+    """returns the algorithm and integer value of a stored perceptual hash"""
+    algorithm, _, digits = value.partition(':')
+    return algorithm, int(digits, 16)
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+class BKTree:
+    """A metric tree of hashes under Hamming distance. Only subtrees whose
+       edge distance is within the search radius of the query are visited."""
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, item: Any):
+        self.size += 1
+        node = [value, [item], {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            if distance == 0:
+                current[1].append(item)
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value: int, max_distance: int) -> Iterator[tuple[int, Any]]:
+        """yields (distance, item) for every item within max_distance of value"""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                for item in items:
+                    yield distance, item
+            for edge in range(max(1, distance - max_distance), distance + max_distance + 1):
+                child = children.get(edge)
+                if child is not None:
+                    stack.append(child)
+
+def similar_groups(hashes: Iterable[tuple[Any, int]],
+                   max_distance: int = DEFAULT_DISTANCE) -> list[list[Any]]:
+    """clusters items whose hashes are within max_distance of one another,
+       returning only clusters of more than one item"""
+    tree = BKTree()
+    values = []
+    for item, value in hashes:
+        tree.add(value, item)
+        values.append((item, value))
+
+    parent = {item: item for item, _ in values}
+    def find(item):
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    for item, value in values:
+        for _, other in tree.search(value, max_distance):
+            root, other_root = find(item), find(other)
+            if root != other_root:
+                parent[max(root, other_root)] = min(root, other_root)
+
+    groups = {}
+    for item, _ in values:
+        groups.setdefault(find(item), []).append(item)
+    return sorted(sorted(group) for group in groups.values() if len(group) > 1)
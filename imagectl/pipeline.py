@@ -0,0 +1,51 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+pipeline.py
+
+Helpers to run per-file work on a pool of threads while keeping results in
+the order the files were found.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# Number of items queued per worker before the producer waits
+QUEUE_DEPTH = 4
+
+def ordered_map(fn: Callable[..., R], items: Iterable[T], jobs: int = 1,
+                name: str = 'worker') -> Iterator[R]:
+    """yields fn(*item) for each item, run on up to jobs threads, in input
+       order; a bounded queue stops the producer running ahead"""
+    if jobs <= 1:
+        for item in items:
+            yield fn(*item)
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix=name) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, *item))
+            if len(pending) >= jobs * QUEUE_DEPTH:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,238 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+plan.py
+
+Plans of file operations that can be written out for review and applied
+later. A plan is a JSON lines file, a header followed by one action per
+line. Applying a plan records each action finished in a journal next to it
+so an interrupted run picks up where it stopped.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import logging
+import os
+from os.path import dirname, exists
+import threading
+from typing import Iterable, Iterator, Literal
+
+from pydantic import BaseModel
+
+from imagectl.hashing import algorithm_for_digest, get_hash
+from imagectl.metrics import current_metrics
+from imagectl.transfer import copy_file, move_file
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+# Actions journaled between each sync of the journal to disk
+JOURNAL_SYNC_INTERVAL = 100
+
+DELETE = 'delete'
+MOVE = 'move'
+RENAME = 'rename'
+COPY = 'copy'
+
+# Outcomes of applying an action
+APPLIED = 'applied'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+class Action(BaseModel):
+    """A file operation, delete removes source as a copy of keep, move and
+       rename move source to dest, rename when the file name changes, and
+       copy copies source over dest"""
+    op: Literal['delete', 'move', 'rename', 'copy']
+    source: str
+    size: int
+    hash: str | None = None
+    keep: str | None = None
+    dest: str | None = None
+
+def write_plan(path: str, actions: Iterable[Action], **header) -> int:
+    """writes actions to a plan file, returning the number written"""
+    count = 0
+    temp = f'{path}.partial'
+    with open(temp, 'w') as f:
+        f.write(json.dumps({'plan': PLAN_VERSION, 'created': datetime.now().isoformat(),
+                            **header}) + '\n')
+        for action in actions:
+            f.write(action.model_dump_json(exclude_none=True) + '\n')
+            count += 1
+    os.replace(temp, path)
+    return count
+
+def read_plan(path: str) -> tuple[dict, list[Action]]:
+    """returns the header and actions of a plan file"""
+    with open(path) as f:
+        header = json.loads(f.readline() or '{}')
+        if header.get('plan') != PLAN_VERSION:
+            raise ValueError(f'{path} is not a plan this version can apply')
+        return header, [Action.model_validate_json(line) for line in f if line.strip()]
+
+def journal_path(plan_path: str) -> str:
+    return plan_path + '.journal'
+
+def read_journal(path: str) -> set[int]:
+    """returns the numbers of the actions already applied or skipped"""
+    finished = set()
+    if exists(path):
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and line.endswith('\n'): # ignore a torn last line
+                    finished.add(int(fields[0]))
+    return finished
+
+class Journal:
+    """Appends the outcome of each action, synced every so often"""
+    def __init__(self, path: str | None):
+        self.file = None if path is None else open(path, 'a')
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def record(self, n: int, outcome: str):
+        if self.file is None:
+            return
+        with self._lock:
+            self.file.write(f'{n} {outcome}\n')
+            self.count += 1
+            if self.count % JOURNAL_SYNC_INTERVAL == 0:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+def same_content(path: str, size: int, hash: str) -> bool:
+    """true if path holds exactly the content planned, reading it in full
+       rather than trusting the hash cache"""
+    try:
+        if os.path.getsize(path) != size:
+            return False
+        return get_hash(path, algorithm_for_digest(hash), use_cache=False) == hash
+    except FileNotFoundError:
+        return False
+
+def apply_action(action: Action, link_mode: str = 'auto') -> str:
+    """applies one action, returning its outcome, after checking the files
+       are still as planned"""
+    if action.op == DELETE:
+        # never delete a file unless it and the copy kept are both verified
+        if action.hash is None or action.keep is None:
+            logger.error('cannot delete %s without a verified copy to keep', action.source)
+            return SKIPPED
+        if not same_content(action.source, action.size, action.hash):
+            logger.warning('%s has changed since the plan, not deleted', action.source)
+            return SKIPPED
+        if not same_content(action.keep, action.size, action.hash):
+            logger.warning('%s has changed since the plan, %s not deleted',
+                           action.keep, action.source)
+            return SKIPPED
+        os.remove(action.source)
+        return APPLIED
+
+    if action.op == COPY:
+        return copy_action(action, link_mode)
+
+    if exists(action.dest):
+        logger.warning('%s already exists, %s not moved', action.dest, action.source)
+        return SKIPPED
+    try:
+        if os.path.getsize(action.source) != action.size:
+            logger.warning('%s has changed since the plan, not moved', action.source)
+            return SKIPPED
+    except FileNotFoundError:
+        logger.warning('%s is missing, not moved', action.source)
+        return SKIPPED
+    os.makedirs(dirname(action.dest), exist_ok=True)
+    move_file(action.source, action.dest, link_mode)
+    return APPLIED
+
+def copy_action(action: Action, link_mode: str = 'auto') -> str:
+    """copies source over dest, unless dest already has the content planned,
+       replacing dest only once the copy is complete"""
+    if action.hash is not None and same_content(action.dest, action.size, action.hash):
+        return SKIPPED # copied by an earlier run
+    try:
+        if os.path.getsize(action.source) != action.size:
+            logger.warning('%s has changed since the plan, not copied', action.source)
+            return SKIPPED
+    except FileNotFoundError:
+        logger.warning('%s is missing, not copied', action.source)
+        return SKIPPED
+    os.makedirs(dirname(action.dest), exist_ok=True)
+    partial = f'{action.dest}.partial'
+    copy_file(action.source, partial, link_mode)
+    os.replace(partial, action.dest)
+    return APPLIED
+
+def by_directory(actions: Iterable[tuple[int, Action]]) -> Iterator[list[tuple[int, Action]]]:
+    """yields the actions grouped by the directory of their source, in name
+       order within each directory"""
+    groups = defaultdict(list)
+    for n, action in actions:
+        groups[dirname(action.source)].append((n, action))
+    for directory in sorted(groups):
+        yield sorted(groups[directory], key=lambda item: item[1].source)
+
+def apply_plan(actions: list[Action], jobs: int = 1, link_mode: str = 'auto',
+               journal: str = None) -> dict[str, int]:
+    """applies actions, moves and copies and then deletes, a directory at a
+       time on up to jobs threads, skipping those already in the journal and
+       recording the rest, returns the number of actions with each outcome"""
+    finished = read_journal(journal) if journal is not None else set()
+    if finished:
+        logger.warning('resuming, %d of %d actions already applied', len(finished), len(actions))
+    outcomes = {APPLIED: 0, SKIPPED: 0, FAILED: 0}
+    lock = threading.Lock()
+    metrics = current_metrics()
+    metrics.expect(len(actions) - len(finished))
+    log = Journal(journal)
+
+    def apply_group(group: list[tuple[int, Action]]):
+        for n, action in group:
+            try:
+                outcome = apply_action(action, link_mode)
+            except OSError as err:
+                logger.error('cannot %s %s: %s', action.op, action.source, err)
+                outcome = FAILED
+            if outcome != FAILED:
+                log.record(n, outcome) # failures are retried on resume
+            metrics.progress()
+            with lock:
+                outcomes[outcome] += 1
+
+    pending = [(n, action) for n, action in enumerate(actions) if n not in finished]
+    try:
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='apply') as pool:
+            # moves go first so a copy to keep moved into place is there to
+            # verify before the other copies are deleted
+            for phase in ([item for item in pending if item[1].op != DELETE],
+                          [item for item in pending if item[1].op == DELETE]):
+                for future in [pool.submit(apply_group, group) for group in by_directory(phase)]:
+                    future.result()
+    finally:
+        log.close()
+    return outcomes
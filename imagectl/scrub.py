@@ -0,0 +1,132 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+scrub.py
+
+Decoding images to prove they are intact, not just unchanged since they
+were indexed. Decoding is CPU bound so it runs on a pool of processes, and
+the hashes of images that decoded cleanly are remembered so the same
+content is never decoded twice.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import logging
+import os
+import sqlite3
+import time
+from typing import Iterable, Iterator, TypeVar
+
+from imagectl import hashcache
+from imagectl.pipeline import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Number of results between commits of the decoded cache
+COMMIT_INTERVAL = 1000
+
+def default_path() -> str:
+    """returns the decoded cache location, alongside the hash cache"""
+    return os.path.join(os.path.dirname(hashcache.default_path()), 'decoded.db')
+
+class DecodedCache:
+    """Hashes of the images that have decoded cleanly, stored in SQLite"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS decoded (
+            digest TEXT PRIMARY KEY,
+            checked INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or default_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+        self._writes = 0
+
+    def __contains__(self, digest: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM decoded WHERE digest = ?",
+                                 (digest,)).fetchone() is not None
+
+    def add(self, digest: str):
+        self.conn.execute("INSERT OR REPLACE INTO decoded VALUES (?, ?)",
+                          (digest, int(time.time())))
+        self._writes += 1
+        if self._writes >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _init_worker():
+    from PIL import Image
+    # these are our own images, a large panorama is not a decompression bomb
+    Image.MAX_IMAGE_PIXELS = None
+
+def decode(qual_name: str) -> tuple[str | None, float]:
+    """returns why the image cannot be decoded, or None if it can, and the
+       seconds taken"""
+    from imagectl.imaging import open_image
+    start = time.perf_counter()
+    try:
+        # verify checks the structure, such as PNG chunk checksums, but
+        # leaves the image unusable so it is opened again to decode it
+        with open_image(qual_name) as img:
+            img.verify()
+        with open_image(qual_name) as img:
+            if img.format == 'JPEG':
+                # scaling in the DCT still entropy decodes every block, so
+                # proves the whole stream is intact for an eighth of the work
+                img.draft(img.mode, (max(1, img.width // 8), max(1, img.height // 8)))
+            img.load()
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return error, time.perf_counter() - start
+
+def decode_all(items: Iterable[tuple[str, T]], jobs: int | None = None
+               ) -> Iterator[tuple[T, str | None, float]]:
+    """yields the item, the error if any and the seconds taken to decode
+       each qualified name as each completes, on up to jobs processes"""
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as pool:
+        pending = {}
+        for qual_name, item in items:
+            pending[pool.submit(decode, qual_name)] = item
+            if len(pending) >= jobs * QUEUE_DEPTH:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), *future.result()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), *future.result()
@@ -0,0 +1,315 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+server.py
+
+Indexes held in memory to answer queries from other programs over a Unix
+domain socket, or a TCP port on localhost. Each request and response is a
+line of JSON, so a client can send any number down one connection:
+
+    {"op": "has", "hash": "..."}           -> {"found": true}
+    {"op": "lookup", "hash": "..."}        -> {"matches": [{"collection", "name", "size", "hash"}]}
+    {"op": "name", "name": "..."}          -> {"matches": [...]}, "collection" narrows it to one
+    {"op": "file", "path": "..."}          -> {"matches": [...]}, hashing the file only if
+                                              an indexed image has its size
+    {"op": "batch", "requests": [{...}]}   -> {"results": [{...}]}
+    {"op": "stats"}                        -> {"collections": [{"collection", "entries", "loaded"}]}
+
+Anything that cannot be answered gets {"error": "..."}.
+"""
+from collections import Counter
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+from typing import Iterator
+
+from imagectl import hashcache
+from imagectl.hashing import algorithm_for_digest, get_hash
+from imagectl.storage import open_store
+from imagectl.sync import Row, rows
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for a changed index
+DEFAULT_RELOAD_INTERVAL = 5.0
+
+def default_socket() -> str:
+    """returns the socket location under $XDG_RUNTIME_DIR, or alongside the
+       hash cache where there is none"""
+    base = os.environ.get('XDG_RUNTIME_DIR') or os.path.dirname(hashcache.default_path())
+    return os.path.join(base, 'imagectl.sock')
+
+def _pack(size: int, hash: str) -> bytes:
+    # one bytes object per name rather than a tuple of an int and a string
+    # keeps a million entries in well under half the memory
+    return size.to_bytes(8, 'little') + bytes.fromhex(hash)
+
+def _unpack(value: bytes) -> tuple[int, str]:
+    return int.from_bytes(value[:8], 'little'), value[8:].hex()
+
+class Library:
+    """The names, sizes and hashes of one indexed collection, reloaded by
+       applying only what changed when its index is rewritten"""
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        self.names: dict[str, bytes] = {}
+        self.hashes: dict[bytes, str | tuple[str, ...]] = {}
+        self.sizes: Counter[int] = Counter()
+        self.algorithm: str | None = None
+        self.loaded: float | None = None
+        self._fingerprint = None
+        self._lock = threading.RLock()
+
+    def reload(self) -> bool:
+        """brings the maps up to date with the index, returning False if it
+           has not changed since the last time"""
+        store = open_store(self.base_dir)
+        if not store.exists():
+            raise ValueError(f"No index found at {store.path}")
+        st = os.stat(store.path)
+        fingerprint = (store.path, st.st_ino, st.st_size, st.st_mtime_ns)
+        if fingerprint == self._fingerprint:
+            return False
+        with store:
+            changed, removed = self.apply(rows(store))
+        self._fingerprint = fingerprint
+        self.loaded = time.time()
+        logger.info('%s: %d entries, %d added or changed, %d removed',
+                    self.base_dir, len(self.names), changed, removed)
+        return True
+
+    def apply(self, entries: Iterator[Row]) -> tuple[int, int]:
+        """replaces the content of the maps with entries, touching only the
+           names that changed, and returns the number changed and removed"""
+        seen = set()
+        changed = 0
+        for name, size, hash in entries:
+            seen.add(name)
+            value = _pack(size, hash)
+            with self._lock:
+                old = self.names.get(name)
+                if old == value:
+                    continue
+                if old is not None:
+                    self._remove(name, old)
+                self._add(name, value)
+            if hash and self.algorithm is None:
+                self.algorithm = algorithm_for_digest(hash)
+            changed += 1
+        gone = self.names.keys() - seen
+        with self._lock:
+            for name in gone:
+                self._remove(name, self.names[name])
+        return changed, len(gone)
+
+    def _add(self, name: str, value: bytes):
+        self.names[name] = value
+        self.sizes[int.from_bytes(value[:8], 'little')] += 1
+        digest = value[8:]
+        if digest:
+            names = self.hashes.get(digest)
+            self.hashes[digest] = name if names is None else \
+                                  (*((names,) if isinstance(names, str) else names), name)
+
+    def _remove(self, name: str, value: bytes):
+        del self.names[name]
+        size = int.from_bytes(value[:8], 'little')
+        self.sizes[size] -= 1
+        if not self.sizes[size]:
+            del self.sizes[size]
+        digest = value[8:]
+        names = self.hashes.get(digest)
+        if names is None:
+            return
+        others = () if isinstance(names, str) else tuple(n for n in names if n != name)
+        if not others:
+            del self.hashes[digest]
+        else:
+            self.hashes[digest] = others[0] if len(others) == 1 else others
+
+    def match(self, name: str) -> dict:
+        size, hash = _unpack(self.names[name])
+        return {'collection': self.base_dir, 'name': name, 'size': size, 'hash': hash}
+
+    def find_by_hash(self, hash: str) -> list[dict]:
+        with self._lock:
+            names = self.hashes.get(bytes.fromhex(hash))
+            if names is None:
+                return []
+            return [self.match(name) for name in ((names,) if isinstance(names, str) else names)]
+
+    def find_by_name(self, name: str) -> list[dict]:
+        with self._lock:
+            return [self.match(name)] if name in self.names else []
+
+class IndexServer:
+    """Answers queries against the libraries"""
+    def __init__(self, libraries: list[Library]):
+        self.libraries = libraries
+
+    def handle(self, request: dict) -> dict:
+        """returns the response to one request"""
+        try:
+            op = request['op']
+        except (KeyError, TypeError):
+            return {'error': 'request must be an object with an op'}
+        handler = getattr(self, f'op_{op}', None) if isinstance(op, str) else None
+        if handler is None:
+            return {'error': f'unknown op {op!r}'}
+        try:
+            return handler(request)
+        except KeyError as e:
+            return {'error': f'{op} needs {e.args[0]}'}
+        except (ValueError, TypeError, OSError) as e:
+            return {'error': str(e)}
+
+    def op_has(self, request: dict) -> dict:
+        hash = bytes.fromhex(request['hash'])
+        return {'found': any(hash in library.hashes for library in self.libraries)}
+
+    def op_lookup(self, request: dict) -> dict:
+        return {'matches': [match for library in self.libraries
+                            for match in library.find_by_hash(request['hash'])]}
+
+    def op_name(self, request: dict) -> dict:
+        collection = request.get('collection')
+        return {'matches': [match for library in self.libraries
+                            if collection in (None, library.base_dir)
+                            for match in library.find_by_name(request['name'])]}
+
+    def op_file(self, request: dict) -> dict:
+        path = request['path']
+        size = os.stat(path).st_size
+        matches = []
+        hashes = {} # by algorithm, each read at most once
+        for library in self.libraries:
+            if size not in library.sizes or library.algorithm is None:
+                continue # no image that size, so no need to read the file
+            if library.algorithm not in hashes:
+                hashes[library.algorithm] = get_hash(path, library.algorithm)
+            matches.extend(match for match in library.find_by_hash(hashes[library.algorithm])
+                           if match['size'] == size)
+        return {'matches': matches}
+
+    def op_batch(self, request: dict) -> dict:
+        requests = request['requests']
+        if not isinstance(requests, list):
+            raise ValueError('requests must be a list')
+        return {'results': [self.handle(r) for r in requests]}
+
+    def op_stats(self, request: dict) -> dict:
+        return {'collections': [{'collection': library.base_dir, 'entries': len(library.names),
+                                 'loaded': library.loaded} for library in self.libraries]}
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.index.handle(json.loads(line))
+            except ValueError as e:
+                response = {'error': f'invalid JSON: {e}'}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        super().server_bind()
+        st = os.lstat(self.server_address)
+        self.socket_id = (st.st_dev, st.st_ino)
+
+class _TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_server(index: IndexServer, address: str | int) -> socketserver.BaseServer:
+    """returns a server for index listening on a Unix socket at address, or
+       on that TCP port of localhost if address is a number"""
+    if isinstance(address, int):
+        server = _TcpServer(('127.0.0.1', address), _Handler)
+    else:
+        if os.path.lexists(address):
+            if not stat.S_ISSOCK(os.lstat(address).st_mode):
+                raise ValueError(f"{address} exists and is not a socket")
+            try:
+                with socket.socket(socket.AF_UNIX) as s:
+                    s.connect(address)
+                raise ValueError(f"Another server is listening at {address}")
+            except ConnectionRefusedError:
+                os.remove(address) # left by a server that did not stop cleanly
+        os.makedirs(os.path.dirname(os.path.abspath(address)), exist_ok=True)
+        server = _UnixServer(address, _Handler)
+    server.index = index
+    return server
+
+def remove_socket(server: socketserver.BaseServer):
+    """removes the socket file of a Unix server, if it is still the one the
+       server created"""
+    if not isinstance(server, _UnixServer):
+        return
+    try:
+        st = os.lstat(server.server_address)
+    except FileNotFoundError:
+        return
+    if stat.S_ISSOCK(st.st_mode) and (st.st_dev, st.st_ino) == server.socket_id:
+        os.remove(server.server_address)
+
+def reload_forever(libraries: list[Library], interval: float, stop: threading.Event):
+    """reloads each library whose index has changed every interval seconds
+       until stop is set"""
+    while not stop.wait(interval):
+        for library in libraries:
+            try:
+                library.reload()
+            except (OSError, ValueError) as e:
+                logger.error('cannot reload %s: %s', library.base_dir, e)
+
+class Client:
+    """A connection to a server, for scripts to send queries down"""
+    def __init__(self, address: str | int = None):
+        address = default_socket() if address is None else address
+        if isinstance(address, int):
+            self.sock = socket.create_connection(('127.0.0.1', address))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX)
+            self.sock.connect(address)
+        self.file = self.sock.makefile('rwb')
+
+    def query(self, op: str, **params) -> dict:
+        """returns the response to one request"""
+        self.file.write(json.dumps({'op': op, **params}).encode('utf-8') + b'\n')
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,514 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+storage.py
+
+Pluggable storage for the index of an image collection. The original CSV
+file remains the default, an SQLite database may be used instead for large
+collections where lookups by hash, size or name must not scan every entry.
+"""
+import abc
+from collections import defaultdict
+from itertools import islice
+import logging
+import os
+import sqlite3
+import threading
+from typing import Iterable, Iterator
+
+from imagectl.binindex import BinaryIndex, write_binary_index
+from imagectl.metrics import current_metrics
+from imagectl.models import IndexEntry, index_path, parse_index, read_index, read_index_sorted
+
+logger = logging.getLogger(__name__)
+
+# Number of rows written per executemany call
+BATCH_SIZE = 1000
+# Number of entries written between flushing a partial index to disk
+FLUSH_INTERVAL = 1000
+
+class IndexWriter(abc.ABC):
+    """Writes a new index one entry at a time. The new index replaces the
+       old one only when the writer exits without an exception, otherwise
+       the entries written so far are kept so the run can be resumed."""
+    def __init__(self):
+        self.done: set[str] = set() # names written by the run being resumed
+        self.count = 0
+
+    @abc.abstractmethod
+    def add(self, entry: IndexEntry):
+        """appends an entry to the new index"""
+
+    @abc.abstractmethod
+    def commit(self):
+        """replaces the index with the entries written"""
+
+    @abc.abstractmethod
+    def abort(self):
+        """saves the entries written so far for a later run to resume"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            with current_metrics().stage('index_write', count=0):
+                self.commit()
+        else:
+            self.abort()
+
+class _BufferedWriter(IndexWriter):
+    """Collects entries in memory for stores that can only be written whole"""
+    def __init__(self, store: "IndexStore"):
+        super().__init__()
+        self.store = store
+        self.entries = []
+
+    def add(self, entry: IndexEntry):
+        self.entries.append(entry)
+        self.count += 1
+
+    def commit(self):
+        self.store.write(self.entries)
+
+    def abort(self):
+        pass
+
+class CsvIndexWriter(IndexWriter):
+    """Appends to a partial CSV file, flushed and synced every
+       FLUSH_INTERVAL entries and renamed over path on commit. Only the
+       writer of an index run may be resumed, others write to a name of
+       their own so they never disturb its partial file."""
+    def __init__(self, path: str, header: str, resume: bool = False, on_commit=None,
+                 resumable: bool = True):
+        super().__init__()
+        self.path = path
+        self.on_commit = on_commit
+        self.resumable = resumable
+        self.partial = path + '.partial' if resumable \
+                       else f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        if resume and os.path.exists(self.partial):
+            self._truncate_incomplete()
+            self.done = {entry.name for entry in read_index(self.partial)}
+            self.out = open(self.partial, 'a')
+            logger.info('resuming %s with %d entries', self.partial, len(self.done))
+        else:
+            self.out = open(self.partial, 'w')
+            self.out.write(header)
+
+    def _truncate_incomplete(self):
+        """drops a last line cut short when the previous run stopped"""
+        with open(self.partial, 'rb+') as f:
+            data_end = f.seek(0, os.SEEK_END)
+            f.seek(max(0, data_end - 64 * 1024))
+            tail = f.read()
+            complete = tail.rfind(b'\n') + 1
+            f.truncate(data_end - len(tail) + complete)
+
+    def add(self, entry: IndexEntry):
+        self.out.write(entry.model_dump())
+        self.count += 1
+        if self.count % FLUSH_INTERVAL == 0:
+            self._sync()
+
+    def _sync(self):
+        self.out.flush()
+        os.fsync(self.out.fileno())
+
+    def commit(self):
+        self._sync()
+        self.out.close()
+        os.replace(self.partial, self.path)
+        if self.on_commit is not None:
+            self.on_commit()
+
+    def abort(self):
+        self._sync()
+        self.out.close()
+        if not self.resumable:
+            os.remove(self.partial)
+            return
+        logger.warning('partial index saved to %s, run again with --resume to continue',
+                       self.partial)
+
+class IndexStore(abc.ABC):
+    """Storage for the entries of a single collection's index"""
+    SUFFIX = ''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @classmethod
+    def for_collection(cls, base_dir: str) -> "IndexStore":
+        """returns a store for the index of the collection in base_dir"""
+        return cls(index_path(base_dir) + cls.SUFFIX)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    @abc.abstractmethod
+    def entries(self) -> Iterator[IndexEntry]:
+        """yields every entry in the order it was written"""
+
+    @abc.abstractmethod
+    def write(self, entries: Iterable[IndexEntry]):
+        """replaces the contents of the index with entries"""
+
+    def writer(self, resume: bool = False) -> IndexWriter:
+        """returns a writer to replace the index one entry at a time"""
+        return _BufferedWriter(self)
+
+    def upsert(self, entries: Iterable[IndexEntry]):
+        """adds entries to the index, replacing any with the same name"""
+        merged = {entry.name: entry for entry in self.entries()}
+        merged.update((entry.name, entry) for entry in entries)
+        self.write(merged.values())
+
+    def remove(self, names: Iterable[str]):
+        """removes the named entries from the index"""
+        names = set(names)
+        self.write([entry for entry in self.entries() if entry.name not in names])
+
+    def get(self, name: str) -> IndexEntry | None:
+        """returns the entry for name or None if there is not one"""
+        return next((entry for entry in self.entries() if entry.name == name), None)
+
+    def find_by_hash(self, hash: str) -> Iterator[IndexEntry]:
+        """yields the entries with the specified hash"""
+        return (entry for entry in self.entries() if entry.hash == hash)
+
+    def find_by_size(self, size: int) -> Iterator[IndexEntry]:
+        """yields the entries with the specified size"""
+        return (entry for entry in self.entries() if entry.size == size)
+
+    def entries_by_name(self) -> Iterator[IndexEntry]:
+        """yields every entry in name order"""
+        return iter(sorted(self.entries(), key=lambda entry: entry.name))
+
+    def find_in_directory(self, directory: str) -> Iterator[IndexEntry]:
+        """yields the entries directly in directory, relative to the base
+           of the collection with '' for the base itself"""
+        return (entry for entry in self.entries() if os.path.dirname(entry.name) == directory)
+
+    def count(self) -> int:
+        return sum(1 for _ in self.entries())
+
+    def close(self):
+        """releases any resources held by the store"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class CsvIndexStore(IndexStore):
+    """The original comma separated index file"""
+    HEADER = "NAME,CREATED,MODIFIED,SIZE,HASH,PHASH,TAKEN,WIDTH,HEIGHT,MODEL,ORIENTATION\n"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._by_name = None
+        self._by_directory = None
+        self._lock = threading.Lock()
+
+    def entries(self) -> Iterator[IndexEntry]:
+        return read_index(self.path)
+
+    def entries_by_name(self) -> Iterator[IndexEntry]:
+        return parse_index(read_index_sorted(self.path))
+
+    def write(self, entries: Iterable[IndexEntry]):
+        with CsvIndexWriter(self.path, self.HEADER, on_commit=self._invalidate,
+                            resumable=False) as writer:
+            for entry in entries:
+                writer.add(entry)
+
+    def writer(self, resume: bool = False) -> IndexWriter:
+        return CsvIndexWriter(self.path, self.HEADER, resume, self._invalidate)
+
+    def _invalidate(self):
+        self._by_name = None
+        self._by_directory = None
+
+    def get(self, name: str) -> IndexEntry | None:
+        # a CSV index cannot be searched without reading it, so the first
+        # lookup loads a map of the whole file
+        with self._lock:
+            if self._by_name is None:
+                self._by_name = {entry.name: entry for entry in self.entries()}
+        return self._by_name.get(name)
+
+    def find_in_directory(self, directory: str) -> Iterator[IndexEntry]:
+        with self._lock:
+            if self._by_directory is None:
+                self._by_directory = defaultdict(list)
+                for entry in self.entries():
+                    self._by_directory[os.path.dirname(entry.name)].append(entry)
+        return iter(self._by_directory.get(directory, ()))
+
+class SqliteIndexStore(IndexStore):
+    """An index held in an SQLite database with lookups by name, hash and size"""
+    SUFFIX = '.db'
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            name TEXT PRIMARY KEY,
+            created TEXT NOT NULL,
+            modified TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            hash TEXT
+        );
+        CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash);
+        CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+    """
+    # optional columns added after the original schema, with their types
+    OPTIONAL_COLUMNS = {
+        'phash': 'TEXT',
+        'taken': 'TEXT',
+        'width': 'INTEGER',
+        'height': 'INTEGER',
+        'model': 'TEXT',
+        'orientation': 'INTEGER',
+    }
+    FIELDS = ['name', 'created', 'modified', 'size', 'hash', *OPTIONAL_COLUMNS]
+    COLUMNS = ', '.join(FIELDS)
+    UPSERT = f"INSERT INTO entries ({COLUMNS}) VALUES ({', '.join('?' * len(FIELDS))}) " \
+             "ON CONFLICT(name) DO UPDATE SET " \
+             + ', '.join(f'{f}=excluded.{f}' for f in FIELDS[1:])
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(self.SCHEMA)
+            self._migrate()
+        return self._conn
+
+    def _migrate(self):
+        """adds any optional columns missing from an older database"""
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(entries)")}
+        with self._conn:
+            for column, type in self.OPTIONAL_COLUMNS.items():
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE entries ADD COLUMN {column} {type}")
+
+    @classmethod
+    def _to_row(cls, entry: IndexEntry) -> tuple:
+        return tuple(getattr(entry, field) for field in cls.FIELDS)
+
+    @classmethod
+    def _to_entry(cls, row: tuple) -> IndexEntry:
+        return IndexEntry(**dict(zip(cls.FIELDS, row)))
+
+    def _query(self, where: str = '', params: tuple = (), order: str = 'rowid') -> Iterator[IndexEntry]:
+        cursor = self.conn.execute(
+            f"SELECT {self.COLUMNS} FROM entries {where} ORDER BY {order}", params)
+        while rows := cursor.fetchmany(BATCH_SIZE):
+            for row in rows:
+                yield self._to_entry(row)
+
+    def _insert(self, entries: Iterable[IndexEntry]):
+        rows = map(self._to_row, entries)
+        while batch := list(islice(rows, BATCH_SIZE)):
+            self.conn.executemany(self.UPSERT, batch)
+
+    def entries(self) -> Iterator[IndexEntry]:
+        return self._query()
+
+    def entries_by_name(self) -> Iterator[IndexEntry]:
+        return self._query(order='name')
+
+    def write(self, entries: Iterable[IndexEntry]):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM entries")
+            self._insert(entries)
+
+    def writer(self, resume: bool = False) -> IndexWriter:
+        return SqliteIndexWriter(self, resume)
+
+    def upsert(self, entries: Iterable[IndexEntry]):
+        with self._lock, self.conn:
+            self._insert(entries)
+
+    def remove(self, names: Iterable[str]):
+        names = iter(names)
+        with self._lock, self.conn:
+            while batch := [(name,) for name in islice(names, BATCH_SIZE)]:
+                self.conn.executemany("DELETE FROM entries WHERE name = ?", batch)
+
+    def get(self, name: str) -> IndexEntry | None:
+        with self._lock:
+            return next(self._query("WHERE name = ?", (name,)), None)
+
+    def find_by_hash(self, hash: str) -> Iterator[IndexEntry]:
+        return self._query("WHERE hash = ?", (hash,))
+
+    def find_by_size(self, size: int) -> Iterator[IndexEntry]:
+        return self._query("WHERE size = ?", (size,))
+
+    def find_in_directory(self, directory: str) -> Iterator[IndexEntry]:
+        if not directory:
+            return (entry for entry in self._query() if '/' not in entry.name)
+        # names below directory sort between "directory/" and "directory0"
+        prefix = directory + '/'
+        return (entry for entry in self._query("WHERE name >= ? AND name < ?",
+                                               (prefix, directory + '0'))
+                if '/' not in entry.name[len(prefix):])
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class BinaryIndexStore(IndexStore):
+    """A memory mapped binary index, see imagectl.binindex"""
+    SUFFIX = '.bin'
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._index = None
+
+    @property
+    def index(self) -> BinaryIndex:
+        if self._index is None:
+            self._index = BinaryIndex(self.path)
+        return self._index
+
+    def entries(self) -> Iterator[IndexEntry]:
+        return iter(self.index)
+
+    def entries_by_name(self) -> Iterator[IndexEntry]:
+        return iter(self.index) # records are stored in name order
+
+    def write(self, entries: Iterable[IndexEntry]):
+        write_binary_index(self.path, entries)
+        self.close() # remap the replacement file on next access
+
+    def writer(self, resume: bool = False) -> IndexWriter:
+        return BinaryIndexWriter(self, resume)
+
+    def get(self, name: str) -> IndexEntry | None:
+        return self.index.get(name)
+
+    def find_in_directory(self, directory: str) -> Iterator[IndexEntry]:
+        prefix = directory + '/' if directory else ''
+        return (entry for entry in self.index.with_prefix(prefix)
+                if '/' not in entry.name[len(prefix):])
+
+    def count(self) -> int:
+        return len(self.index)
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+class SqliteIndexWriter(IndexWriter):
+    """Writes entries to a pending table, committed in batches, which
+       replaces the entries table on commit"""
+    def __init__(self, store: SqliteIndexStore, resume: bool = False):
+        super().__init__()
+        self.store = store
+        self.rows = []
+        conn = store.conn
+        with store._lock, conn:
+            if not resume:
+                conn.execute("DROP TABLE IF EXISTS pending")
+            conn.execute("CREATE TABLE IF NOT EXISTS pending AS SELECT * FROM entries WHERE 0")
+            self.done = {row[0] for row in conn.execute("SELECT name FROM pending")}
+        if self.done:
+            logger.info('resuming %s with %d entries', store.path, len(self.done))
+
+    def add(self, entry: IndexEntry):
+        self.rows.append(self.store._to_row(entry))
+        self.count += 1
+        if len(self.rows) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        with self.store._lock, self.store.conn:
+            self.store.conn.executemany(
+                f"INSERT INTO pending ({self.store.COLUMNS}) "
+                f"VALUES ({', '.join('?' * len(self.store.FIELDS))})", self.rows)
+        self.rows = []
+
+    def commit(self):
+        self._flush()
+        columns = self.store.COLUMNS
+        with self.store._lock, self.store.conn:
+            self.store.conn.execute("DELETE FROM entries")
+            self.store.conn.execute(f"INSERT INTO entries ({columns}) "
+                                    f"SELECT {columns} FROM pending ORDER BY rowid")
+            self.store.conn.execute("DROP TABLE pending")
+
+    def abort(self):
+        self._flush()
+        logger.warning('partial index saved in %s, run again with --resume to continue',
+                       self.store.path)
+
+class BinaryIndexWriter(CsvIndexWriter):
+    """Streams to a partial CSV file which is converted to the binary
+       format, sorted by name, on commit"""
+    def __init__(self, store: BinaryIndexStore, resume: bool = False):
+        super().__init__(store.path, CsvIndexStore.HEADER, resume)
+        self.store = store
+
+    def commit(self):
+        self._sync()
+        self.out.close()
+        self.store.write(read_index(self.partial))
+        os.remove(self.partial)
+
+BACKENDS = {
+    'csv': CsvIndexStore,
+    'sqlite': SqliteIndexStore,
+    'binary': BinaryIndexStore,
+}
+
+def open_store(base_dir: str, backend: str = None) -> IndexStore:
+    """returns the index store of a collection, if no backend is specified
+       the most recently written existing index is used, or CSV if none"""
+    if backend is not None:
+        try:
+            return BACKENDS[backend].for_collection(base_dir)
+        except KeyError:
+            raise ValueError(f'unsupported index backend: {backend}') from None
+    stores = [clazz.for_collection(base_dir) for clazz in BACKENDS.values()]
+    existing = [store for store in stores if store.exists()]
+    if not existing:
+        return stores[0]
+    return max(existing, key=lambda store: os.path.getmtime(store.path))
+
+def open_index(path: str) -> IndexStore:
+    """returns the store for a collection directory or for an index file,
+       such as one copied from another machine, by its suffix"""
+    if os.path.isdir(path):
+        return open_store(path)
+    for clazz in reversed(BACKENDS.values()):
+        if clazz.SUFFIX and path.endswith(clazz.SUFFIX):
+            return clazz(path)
+    return CsvIndexStore(path)
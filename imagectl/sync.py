@@ -0,0 +1,152 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+sync.py
+
+The differences between two indexes, found from the indexes alone. Both
+are read in name order, sorting a CSV index in runs on disk, and merged in
+a single pass. The entries in one index and not the other are spilled to
+disk and matched by content once the merge is done, so renames are found
+without holding either side in memory.
+"""
+import logging
+import tempfile
+from typing import Iterable, Iterator, NamedTuple, TextIO
+from urllib.parse import quote, unquote
+
+from imagectl.models import SORT_RUN_SIZE, line_name, read_index_sorted, sort_lines
+from imagectl.storage import CsvIndexStore, IndexStore
+
+logger = logging.getLogger(__name__)
+
+# Kinds of change in the source that the target does not have yet
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+RENAMED = 'renamed'
+UNCHANGED = 'unchanged'
+
+# The name, size and hash of an index entry, a plain tuple as millions are
+# made in a run
+Row = tuple[str, int, str]
+
+class Change(NamedTuple):
+    """How an image in the source differs from the target, old_name is the
+       name the target has a renamed image under"""
+    kind: str
+    name: str
+    size: int
+    hash: str
+    old_name: str | None = None
+
+def _parse_row(line: str) -> Row:
+    fields = line.split(',')
+    return line_name(line), int(fields[3]), fields[4].strip()
+
+def rows_by_name(store: IndexStore) -> Iterator[Row]:
+    """yields the name, size and hash of every entry of store in name order"""
+    if isinstance(store, CsvIndexStore):
+        # parsing only the fields compared is several times faster than
+        # building whole entries
+        return map(_parse_row, read_index_sorted(store.path))
+    return ((entry.name, entry.size, entry.hash or '') for entry in store.entries_by_name())
+
+def rows(store: IndexStore) -> Iterator[Row]:
+    """yields the name, size and hash of every entry of store in index order"""
+    if isinstance(store, CsvIndexStore):
+        with open(store.path, 'r') as index:
+            for line in index:
+                if line.strip() and not line.startswith('NAME,'):
+                    yield _parse_row(line)
+        return
+    yield from ((entry.name, entry.size, entry.hash or '') for entry in store.entries())
+
+def _same_content(source: Row, target: Row) -> bool:
+    name, size, hash = source
+    _, target_size, target_hash = target
+    if hash and target_hash and len(hash) != len(target_hash):
+        raise ValueError(f'{name} is hashed with different algorithms in each index, '
+                         'reindex one with -a')
+    return size == target_size and bool(hash) and hash == target_hash
+
+def _content_key(line: str) -> tuple[int, str]:
+    size, hash, _ = line.split(',', 2)
+    return int(size), hash
+
+def _spilled_row(line: str) -> Row:
+    size, hash, name = line.rstrip('\n').split(',', 2)
+    return unquote(name), int(size), hash
+
+def _by_content(spill: TextIO, run_size: int) -> Iterator[Row]:
+    """yields the rows spilled to a file in size and hash order, those with
+       the same content in the order they were spilled"""
+    spill.seek(0)
+    return map(_spilled_row, sort_lines(spill, _content_key, run_size))
+
+def diff_rows(source: Iterable[Row], target: Iterable[Row],
+              run_size: int = SORT_RUN_SIZE) -> Iterator[Change]:
+    """yields the change to every name in either source or target, both in
+       name order, renames and the rest of those only in one come last in
+       size and hash order"""
+    # entries only in one index are spilled to disk, there may be as many
+    # as there are in that index if the other is new
+    added = tempfile.TemporaryFile('w+')
+    removed = tempfile.TemporaryFile('w+')
+    try:
+        sources, targets = iter(source), iter(target)
+        ours, theirs = next(sources, None), next(targets, None)
+        while ours is not None or theirs is not None:
+            if theirs is None or (ours is not None and ours[0] < theirs[0]):
+                name, size, hash = ours
+                added.write(f'{size},{hash},{quote(name)}\n')
+                ours = next(sources, None)
+            elif ours is None or theirs[0] < ours[0]:
+                name, size, hash = theirs
+                removed.write(f'{size},{hash},{quote(name)}\n')
+                theirs = next(targets, None)
+            else:
+                kind = UNCHANGED if _same_content(ours, theirs) else MODIFIED
+                yield Change(kind, *ours)
+                ours, theirs = next(sources, None), next(targets, None)
+
+        # an image only in the source with the content of one only in the
+        # target was renamed, found by merging both sorted by content
+        sources, targets = _by_content(added, run_size), _by_content(removed, run_size)
+        ours, theirs = next(sources, None), next(targets, None)
+        while ours is not None or theirs is not None:
+            # images without a hash cannot be matched
+            if theirs is None or (ours is not None and (ours[1:] < theirs[1:] or
+                                                        (ours[1:] == theirs[1:] and not ours[2]))):
+                yield Change(ADDED, *ours)
+                ours = next(sources, None)
+            elif ours is None or theirs[1:] < ours[1:]:
+                yield Change(REMOVED, *theirs)
+                theirs = next(targets, None)
+            else:
+                yield Change(RENAMED, *ours, theirs[0])
+                ours, theirs = next(sources, None), next(targets, None)
+    finally:
+        added.close()
+        removed.close()
+
+def diff_indexes(source: IndexStore, target: IndexStore) -> Iterator[Change]:
+    """yields the change to every image in either index, as the target
+       would need to be changed to match the source, without touching
+       either library"""
+    return diff_rows(rows_by_name(source), rows_by_name(target))
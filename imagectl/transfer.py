@@ -0,0 +1,131 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+transfer.py
+
+Copying and moving files with the cheapest mechanism the filesystem
+supports: a copy-on-write clone (reflink), an in-kernel copy, a hard link
+or, as a last resort, reading and writing the bytes.
+"""
+import errno
+import logging
+import os
+import shutil
+import threading
+
+from imagectl.metrics import current_metrics
+
+logger = logging.getLogger(__name__)
+
+# from linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning a strategy is not available for this pair of files
+UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+               errno.ENOSYS, errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+def reflink(src: str, dst: str):
+    """clones src, sharing its blocks until either file is modified (btrfs, XFS)"""
+    import fcntl # not available on Windows
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def copy_range(src: str, dst: str):
+    """copies src without passing the bytes through user space"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        copy = getattr(os, 'copy_file_range', None)
+        if copy is None:
+            raise OSError(errno.ENOSYS, 'copy_file_range not available')
+        while remaining > 0:
+            n = copy(fsrc.fileno(), fdst.fileno(), remaining)
+            if n == 0:
+                break
+            remaining -= n
+
+def hardlink(src: str, dst: str):
+    """links dst to the same inode as src, no data is copied"""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp = f'{dst}.{os.getpid()}.link'
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+def copy(src: str, dst: str):
+    """copies the bytes of src"""
+    shutil.copyfile(src, dst)
+
+STRATEGIES = {
+    'reflink': reflink,
+    'copy_range': copy_range,
+    'hardlink': hardlink,
+    'copy': copy,
+}
+# hard links are never chosen automatically as a change to either name
+# would change both
+AUTO = ['reflink', 'copy_range', 'copy']
+LINK_MODES = ['auto', *STRATEGIES]
+
+def copy_file(src: str, dst: str, mode: str = 'auto') -> str:
+    """copies src to dst, with its metadata, using the cheapest strategy that
+       works when mode is auto, returns the strategy used"""
+    with current_metrics().stage('copy', os.path.getsize(src)):
+        return _copy_file(src, dst, mode)
+
+def _copy_file(src: str, dst: str, mode: str) -> str:
+    if mode != 'auto' and mode not in STRATEGIES:
+        raise ValueError(f'unsupported link mode: {mode}')
+    if mode != 'hardlink' and os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f'{src} and {dst} are the same file')
+    for name in AUTO if mode == 'auto' else [mode]:
+        if name == 'hardlink':
+            STRATEGIES[name](src, dst) # replaces dst atomically itself
+            logger.debug('%s from %s to %s', name, src, dst)
+            return name
+        # copy to a temporary name so a file already at dst is replaced
+        # only by a complete copy, never truncated or removed
+        tmp = f'{dst}.{os.getpid()}.{threading.get_ident()}.copy'
+        try:
+            STRATEGIES[name](src, tmp)
+            shutil.copystat(src, tmp)
+            os.replace(tmp, dst)
+        except OSError as e:
+            if os.path.exists(tmp):
+                os.remove(tmp) # do not leave a partial copy behind
+            if mode != 'auto' or e.errno not in UNSUPPORTED:
+                raise
+            logger.debug('cannot %s %s to %s: %s', name, src, dst, e)
+            continue
+        logger.debug('%s from %s to %s', name, src, dst)
+        return name
+    raise OSError(errno.ENOTSUP, f'no way to copy {src} to {dst}')
+
+def move_file(src: str, dst: str, mode: str = 'auto') -> str:
+    """moves src to dst, renaming on the same filesystem or otherwise copying
+       with copy_file and removing src, returns the strategy used"""
+    with current_metrics().stage('move', os.path.getsize(src)):
+        try:
+            os.rename(src, dst)
+            return 'rename'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        strategy = _copy_file(src, dst, 'copy' if mode == 'hardlink' else mode)
+        os.remove(src)
+        return strategy
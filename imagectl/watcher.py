@@ -0,0 +1,276 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+# Command line client for managing an image library.
+#
+###############################################################################
+"""
+watcher.py
+
+Reports the images added, changed or removed below a directory in batches,
+using inotify where the kernel provides it and comparing periodic scans of
+the directory where it does not.
+"""
+import abc
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from os.path import join
+import select
+import struct
+import time
+from typing import Iterator
+
+from imagectl.constants import valid_extensions
+
+logger = logging.getLogger(__name__)
+
+# Seconds without events before a batch is reported
+DEFAULT_DEBOUNCE = 1.0
+# Most seconds a batch is held back while events keep arriving
+MAX_BATCH_DELAY = 10.0
+# Least seconds between batches for an index rewritten whole on each update
+DEFAULT_REWRITE_INTERVAL = 30.0
+# Seconds between scans when inotify is not available
+DEFAULT_POLL_INTERVAL = 30.0
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE)
+EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+# Files moved out of the tree leave a cookie that is never paired
+MAX_PENDING_MOVES = 10000
+
+def is_image(name: str) -> bool:
+    """true if name is a file type the library holds, hidden files are not"""
+    return name[:1] != '.' and os.path.splitext(name)[1].lower() in valid_extensions
+
+class Changes:
+    """paths, relative to the watched directory, affected since the last batch"""
+    def __init__(self):
+        # images created, written or removed, whichever they are now
+        self.files = set()
+        # directories that appeared, every image inside needs indexing
+        self.dirs = set()
+        # directories that went away along with every image inside
+        self.removed_dirs = set()
+        # images renamed within the directory, new name to old name
+        self.renamed = {}
+        # events were lost, only a full scan can catch up
+        self.rescan = False
+
+    def __bool__(self):
+        return bool(self.files or self.dirs or self.removed_dirs or self.rescan)
+
+class Watcher(abc.ABC):
+    """source of changes below a directory"""
+    def __init__(self, base: str):
+        self.base = base
+
+    @abc.abstractmethod
+    def poll(self, changes: Changes, timeout: float | None) -> bool:
+        """waits up to timeout seconds, forever if None, adding anything that
+           happens to changes, returns true if there was any activity"""
+
+    def batches(self, debounce: float = DEFAULT_DEBOUNCE, max_delay: float = MAX_BATCH_DELAY,
+                interval: float = 0) -> Iterator[Changes]:
+        """yields changes once debounce seconds pass without activity, or
+           max_delay after the first, so a file is not seen half written, and
+           no sooner than interval seconds after the previous batch"""
+        changes, first, last = Changes(), None, None
+        previous = -interval
+        while True:
+            timeout = None
+            if first is not None:
+                due = max(min(last + debounce, first + max_delay), previous + interval)
+                timeout = max(0, due - time.monotonic())
+                if timeout == 0:
+                    if changes:
+                        yield changes
+                        previous = time.monotonic()
+                    changes, first, last = Changes(), None, None
+                    continue
+            if self.poll(changes, timeout):
+                last = time.monotonic()
+                first = first or last
+
+    def close(self):
+        """releases any resources held by the watcher"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class InotifyWatcher(Watcher):
+    """watches every directory below base through the kernel's inotify API"""
+    def __init__(self, base: str):
+        super().__init__(base)
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init = self.libc.inotify_init1
+        except (AttributeError, OSError) as err:
+            raise OSError(errno.ENOSYS, 'inotify is not available') from err
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'cannot initialise inotify')
+        self.wds = {}
+        # directory moves are reported as a pair of events sharing a cookie
+        self.moves = {}
+        try:
+            self._watch_tree('')
+        except OSError:
+            self.close() # usually the limit on watches, see fs.inotify.max_user_watches
+            raise
+
+    def _watch(self, rel_dir: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(join(self.base, rel_dir)),
+                                         WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return # gone before it could be watched
+            raise OSError(err, f'cannot watch {join(self.base, rel_dir)}: {os.strerror(err)}')
+        self.wds[wd] = rel_dir
+
+    def _watch_tree(self, rel_dir: str):
+        self._watch(rel_dir)
+        for root, dirs, _ in os.walk(join(self.base, rel_dir)):
+            for name in dirs:
+                self._watch(os.path.relpath(join(root, name), self.base))
+
+    def _unwatch_tree(self, rel_dir: str):
+        prefix = join(rel_dir, '')
+        for wd, path in list(self.wds.items()):
+            if path == rel_dir or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.wds[wd]
+
+    def poll(self, changes: Changes, timeout: float | None) -> bool:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            buf = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT.unpack_from(buf, offset)
+            name = os.fsdecode(buf[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0'))
+            offset += EVENT.size + length
+            self._handle(changes, wd, mask, cookie, name)
+        return True
+
+    def _handle(self, changes: Changes, wd: int, mask: int, cookie: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('inotify queue overflowed, rescanning %s', self.base)
+            changes.rescan = True
+            return
+        if mask & IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+        if wd not in self.wds or not name:
+            return
+        path = join(self.wds[wd], name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._watch_tree(path)
+                except OSError as err:
+                    logger.warning('%s, later changes will be missed', err)
+                changes.dirs.add(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._unwatch_tree(path)
+                changes.removed_dirs.add(path)
+        elif is_image(name):
+            if mask & IN_MOVED_FROM:
+                if len(self.moves) > MAX_PENDING_MOVES:
+                    self.moves.clear()
+                self.moves[cookie] = path
+                changes.files.add(path)
+            elif mask & IN_MOVED_TO:
+                old = self.moves.pop(cookie, None)
+                if old is not None:
+                    changes.renamed[path] = old
+                changes.files.add(path)
+            elif mask & (IN_CLOSE_WRITE | IN_CREATE | IN_DELETE):
+                changes.files.add(path)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class PollingWatcher(Watcher):
+    """compares the size, modified time and inode of every image each interval"""
+    def __init__(self, base: str, interval: float = DEFAULT_POLL_INTERVAL):
+        super().__init__(base)
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self) -> dict[str, tuple[int, int, int]]:
+        snapshot = {}
+        for root, _, files in os.walk(self.base):
+            for name in files:
+                if not is_image(name):
+                    continue
+                qual_name = join(root, name)
+                try:
+                    st = os.stat(qual_name)
+                except FileNotFoundError:
+                    continue
+                snapshot[qual_name[len(self.base) + 1:]] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return snapshot
+
+    def poll(self, changes: Changes, timeout: float | None) -> bool:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        current = self._scan()
+        changed = {name for name, st in current.items() if self.snapshot.get(name) != st}
+        gone = self.snapshot.keys() - current.keys()
+        # a file keeps its inode when renamed, letting its hash be reused
+        inodes = {self.snapshot[name][2]: name for name in gone}
+        for name in changed:
+            old = inodes.get(current[name][2])
+            if old is not None:
+                changes.renamed[name] = old
+        changes.files.update(changed, gone)
+        self.snapshot = current
+        return bool(changed or gone)
+
+def open_watcher(base: str, poll_interval: float = None) -> Watcher:
+    """returns an inotify watcher, or a polling one if an interval is
+       specified or inotify cannot be used"""
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(base)
+        except OSError as err:
+            logger.warning('%s, polling %s every %ss instead',
+                           err, base, DEFAULT_POLL_INTERVAL)
+            poll_interval = DEFAULT_POLL_INTERVAL
+    return PollingWatcher(base, poll_interval)
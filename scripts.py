@@ -11,3 +11,26 @@ def tests():
     subprocess.run(
         ['coverage', 'report']
     )
+
+def startup():
+    """ Report the modules imported, and how long they take, starting each command """
+    import sys
+    from imagectl.cmds import COMMANDS
+    for args in [['--help']] + [[cmd, '--help'] for cmd in sorted(COMMANDS)]:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'imagectl'] + args,
+                                capture_output=True, text=True)
+        times = []
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, module = line.split('|')
+                if cumulative.strip().isdigit() and not module.startswith('  '):
+                    times.append((int(cumulative), module.strip()))
+        times.sort(reverse=True)
+        total = sum(t for t, _ in times) / 1000
+        heaviest = ', '.join(f'{name} {t / 1000:.1f}ms' for t, name in times[:3])
+        print(f"{' '.join(args):18} {total:6.1f}ms  {heaviest}")
+
+def benchmark():
+    """ Benchmark every command against a generated library, see benchmarks/run.py """
+    from benchmarks.run import main
+    main()
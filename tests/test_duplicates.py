@@ -0,0 +1,97 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import argparse
+import os
+import shutil
+
+from PIL import Image
+import pytest
+
+from imagectl.cmds.index import index_files, walk_library
+from imagectl.cmds.similar import SimilarCommand
+from imagectl.duplicates import Candidate, find_duplicates
+from imagectl.perceptual import (DEFAULT_DISTANCE, BKTree, check_algorithm, hamming,
+                                 parse_perceptual_hash, perceptual_hash, similar_groups)
+from imagectl.storage import BinaryIndexStore, CsvIndexStore, SqliteIndexStore, open_store
+
+def candidate(tmp_path, collection, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return Candidate(collection, name, str(path), len(content))
+
+def test_find_duplicates_regardless_of_name(tmp_path):
+    body = bytes(range(256)) * 100
+    middle_differs = body[:12800] + b'x' + body[12801:]
+    files = [
+        candidate(tmp_path, 1, "b.jpg", body),
+        candidate(tmp_path, 0, "a.jpg", body),
+        candidate(tmp_path, 1, "c.jpg", body),
+        candidate(tmp_path, 1, "d.jpg", middle_differs),
+        candidate(tmp_path, 1, "e.jpg", body[:-1]),
+    ]
+    groups = find_duplicates(files)
+    assert [[f.name for f in group] for group in groups] == [["a.jpg", "b.jpg", "c.jpg"]]
+
+def test_find_duplicates_none(tmp_path):
+    files = [candidate(tmp_path, 0, "a.jpg", b'a'), candidate(tmp_path, 0, "b.jpg", b'b')]
+    assert find_duplicates(files) == []
+
+def test_bk_tree_search():
+    tree = BKTree()
+    for value in (0b0000, 0b0001, 0b0111, 0b1111):
+        tree.add(value, bin(value))
+    assert sorted(item for _, item in tree.search(0b0000, 1)) == ['0b0', '0b1']
+    assert sorted(item for _, item in tree.search(0b1111, 1)) == ['0b111', '0b1111']
+
+def test_similar_groups():
+    hashes = [("a", 0b0000), ("b", 0b0011), ("c", 0b1100), ("d", 0b1110)]
+    assert similar_groups(hashes, 1) == [["c", "d"]]
+    assert similar_groups(hashes, 2) == [["a", "b", "c", "d"]]
+
+def test_perceptual_hash_survives_resize(tmp_path):
+    original = os.path.join("tests", "resources", "in", "Frog.jpg")
+    with Image.open(original) as image:
+        image.resize((400, 267)).save(tmp_path / "small.jpg", quality=40)
+    other = os.path.join("tests", "resources", "in", "Gorilla.jpg")
+    for algorithm in ("ahash", "dhash"):
+        frog = parse_perceptual_hash(perceptual_hash(original, algorithm))[1]
+        small = parse_perceptual_hash(perceptual_hash(str(tmp_path / "small.jpg"), algorithm))[1]
+        gorilla = parse_perceptual_hash(perceptual_hash(other, algorithm))[1]
+        assert hamming(frog, small) <= DEFAULT_DISTANCE < hamming(frog, gorilla)
+
+def test_perceptual_hash_skips_decompression_bomb(tmp_path, monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    assert perceptual_hash(os.path.join("tests", "resources", "in", "Frog.jpg")) is None
+
+def test_phash_needs_numpy(monkeypatch):
+    import importlib.util
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec",
+                        lambda name, *args: None if name == "numpy" else find_spec(name, *args))
+    check_algorithm("dhash")
+    with pytest.raises(ValueError, match="numpy"):
+        check_algorithm("phash")
+
+@pytest.mark.parametrize("backend", [CsvIndexStore, SqliteIndexStore, BinaryIndexStore])
+def test_similar_saves_perceptual_hashes(tmp_path, backend):
+    shutil.copytree(os.path.join("tests", "resources", "in"), tmp_path, dirs_exist_ok=True)
+    backend.for_collection(str(tmp_path)).write(index_files(walk_library(str(tmp_path))))
+    cmd = SimilarCommand(argparse.ArgumentParser().add_subparsers())
+    cmd.execute(argparse.Namespace(input=str(tmp_path), perceptual="dhash", distance=0,
+                                   jobs=1, verbose="WARNING"))
+    with open_store(str(tmp_path)) as store:
+        assert all(entry.phash.startswith("dhash:") for entry in store.entries())
@@ -0,0 +1,78 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import glob
+import os
+
+import pytest
+from PIL import Image
+
+from imagectl.exif import get_date_taken, parse_metadata, read_exif, read_metadata
+from imagectl.models import IndexEntry
+
+BIRD = f"tests{os.sep}resources{os.sep}in{os.sep}Bird.jpg"
+
+@pytest.mark.parametrize("in_file", sorted(glob.glob(f"tests{os.sep}resources{os.sep}*{os.sep}*.jpg")))
+def test_read_exif_same_as_pillow(in_file):
+    with Image.open(in_file) as image:
+        expected = image.getexif()
+    tags = read_exif(in_file)
+    assert tags[306] == expected[306]
+    assert tags[272] == expected[272]
+    assert tags[274] == expected[274]
+
+def test_get_date_taken_heif(tmp_path):
+    pillow_heif = pytest.importorskip("pillow_heif")
+    pillow_heif.register_heif_opener()
+    heic = str(tmp_path / "Bird.heic")
+    with Image.open(BIRD) as image:
+        image.reduce(8).save(heic, exif=image.getexif().tobytes())
+    assert read_exif(heic)[306] == "2015:10:16 14:40:21"
+    assert get_date_taken(heic) == "2015:10:16 14:40:21"
+
+def test_get_date_taken_falls_back_to_pillow(tmp_path):
+    png = str(tmp_path / "Bird.png")
+    with Image.open(BIRD) as image:
+        image.reduce(8).save(png, exif=image.getexif().tobytes())
+    assert read_exif(png) is None
+    assert get_date_taken(png) == "2015:10:16 14:40:21"
+
+def test_exif_past_scan_limit_falls_back_to_pillow(tmp_path):
+    with open(BIRD, 'rb') as f:
+        data = f.read()
+    padding = b'\xff\xe2' + (65535).to_bytes(2, 'big') + bytes(65533)
+    jpeg = tmp_path / "padded.jpg"
+    jpeg.write_bytes(data[:2] + padding * 5 + data[2:])
+    assert read_exif(str(jpeg)) is None
+    assert get_date_taken(str(jpeg)) == "2015:10:16 14:40:21"
+    assert parse_metadata(data[:64]) is None
+
+def test_malformed_date_taken_not_recorded(tmp_path):
+    jpeg = str(tmp_path / "malformed.jpg")
+    with Image.open(BIRD) as image:
+        exif = image.getexif()
+        exif[306] = "2015:10,16\n14:40:21"
+        exif[272] = "Camera, Model"
+        image.reduce(8).save(jpeg, exif=exif.tobytes())
+    metadata = read_metadata(jpeg)
+    assert metadata.taken is None
+    entry = IndexEntry(name="malformed.jpg", created="2024-01-01T10:30:00",
+                       modified="2024-01-01T10:30:00", size=1024, hash="ab")
+    entry.set_metadata(metadata)
+    row = entry.model_dump()
+    assert row.count('\n') == 1
+    assert IndexEntry.from_str(row) == entry
+    assert IndexEntry.from_str(row).model == "Camera, Model"
@@ -0,0 +1,64 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import hashlib
+import os
+
+import pytest
+
+from imagectl import hashcache
+from imagectl.hashing import algorithm_for_digest, get_hash
+
+FROG = f"tests{os.sep}resources{os.sep}in{os.sep}Frog.jpg"
+
+@pytest.mark.parametrize("algorithm", ["md5", "sha256", "blake2b"])
+def test_get_hash_matches_whole_file_digest(algorithm):
+    with open(FROG, 'rb') as f:
+        expected = hashlib.new(algorithm, f.read()).hexdigest()
+    assert get_hash(FROG, algorithm, chunk_size=4096) == expected
+
+def test_get_hash_unknown_algorithm():
+    with pytest.raises(ValueError):
+        get_hash(FROG, "crc32")
+
+def test_algorithm_for_digest():
+    assert algorithm_for_digest(get_hash(FROG)) == "md5"
+    assert algorithm_for_digest(get_hash(FROG, "sha256")) == "sha256"
+    assert algorithm_for_digest(get_hash(FROG, "blake2b")) == "blake2b"
+
+def test_hash_cache_skips_unchanged_files(tmp_path):
+    hashcache.configure(path=str(tmp_path / "hashes.db"))
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b'one')
+    os.utime(image, (1_600_000_000, 1_600_000_000))
+    first = get_hash(str(image))
+    assert hashcache.get_cache().lookup(os.stat(image), "md5") == first
+
+    # same size and time, so the cached hash is returned without reading
+    image.write_bytes(b'two')
+    os.utime(image, (1_600_000_000, 1_600_000_000))
+    assert get_hash(str(image)) == first
+    assert get_hash(str(image), use_cache=False) != first
+
+    os.utime(image, (1_600_000_001, 1_600_000_001))
+    assert get_hash(str(image)) != first
+
+def test_hash_cache_ignores_racy_files(tmp_path):
+    hashcache.configure(path=str(tmp_path / "hashes.db"))
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b'one')
+    get_hash(str(image))
+    assert hashcache.get_cache().lookup(os.stat(image), "md5") is None
@@ -0,0 +1,81 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import asyncio
+import os
+import shutil
+
+from imagectl import aio
+from imagectl.cmds.index import index_file, index_files, index_library_async, walk_library
+from imagectl.models import IndexEntry
+
+IN_DIR = f"tests{os.sep}resources{os.sep}in"
+
+def test_walk_library_relative_names():
+    names = sorted(rel_name for _, rel_name in walk_library(IN_DIR))
+    assert names == ["Bird copy.jpg", "Bird.jpg", "Frog.jpg", "Gorilla.jpg"]
+
+def test_parallel_index_same_as_serial():
+    serial = [e.model_dump() for e in index_files(walk_library(IN_DIR))]
+    parallel = [e.model_dump() for e in index_files(walk_library(IN_DIR), jobs=3)]
+    assert parallel == serial
+
+def test_async_index_same_as_serial():
+    async def index_all(engine):
+        return [e async for e in index_library_async(engine, IN_DIR)]
+    serial = [e.model_dump() for e in index_files(walk_library(IN_DIR))]
+    overlapped = [e.model_dump() for e in aio.run(index_all, io_depth=2)]
+    assert overlapped == serial
+
+def test_async_map_keeps_input_order():
+    async def slower_first(n):
+        await asyncio.sleep(0.01 * (5 - n))
+        return n
+    async def map_all(engine):
+        return [n async for n in engine.ordered_map(slower_first,
+                                                    aio.aiter_sync((n,) for n in range(5)))]
+    assert aio.run(map_all, io_depth=2) == [0, 1, 2, 3, 4]
+
+def test_incremental_index_reuses_unchanged_hash():
+    qual_name = os.path.join(IN_DIR, "Frog.jpg")
+    old = IndexEntry.from_stat("Frog.jpg", os.stat(qual_name))
+    old.hash = "0" * 32
+    entry = index_file(qual_name, "Frog.jpg", previous={"Frog.jpg": old})
+    assert entry.hash == old.hash
+
+    old.size += 1
+    entry = index_file(qual_name, "Frog.jpg", previous={"Frog.jpg": old})
+    assert entry.hash != old.hash
+
+def test_index_records_metadata():
+    entry = index_file(os.path.join(IN_DIR, "Bird.jpg"), "Bird.jpg")
+    assert entry.taken.startswith("2015-10-16T")
+    assert entry.has_metadata()
+
+def test_async_walk_same_as_serial(tmp_path, monkeypatch):
+    shutil.copytree(IN_DIR, tmp_path / "a" / ".hid")
+    shutil.copy(os.path.join(IN_DIR, "Frog.jpg"), tmp_path / "a" / ".Frog.jpg")
+    shutil.copytree(IN_DIR, tmp_path / "locked")
+    scandir = os.scandir
+    def unreadable(path):
+        if path.endswith("locked"):
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+    monkeypatch.setattr(os, "scandir", unreadable)
+
+    async def walk_all(engine):
+        return sorted([names async for names in engine.walk(str(tmp_path))])
+    assert aio.run(walk_all, io_depth=2) == sorted(walk_library(str(tmp_path)))
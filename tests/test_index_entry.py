@@ -2,11 +2,14 @@
 suite testing models
 """
 import logging
+import os
+import time
 
 import pytest
 from pydantic import BaseModel
 
 from imagectl.models import IndexEntry
+from imagectl.storage import BinaryIndexStore, CsvIndexStore, open_store
 
 ENTRY = 'foo,2024-01-01T10:30:00,2024-01-01T10:30:00,1024,\n'
 ENTRY_WITH_COMMA_IN_NAME = 'foo%2Cbar,2024-01-01T10:30:00,2024-01-01T10:30:00,1024,\n'
@@ -36,4 +39,36 @@ def test_deserialise():
     assert entry.created == "2024-01-01T10:30:00"
     assert entry.modified == "2024-01-01T10:30:00"
     assert entry.size == 1024
-    assert entry.size == 1024
\ No newline at end of file
+    assert entry.size == 1024
+
+
+def test_stat_matches(tmp_path):
+    """test comparison with a single stat"""
+    image = tmp_path / "foo.jpg"
+    image.write_bytes(b'foo')
+    entry = IndexEntry.from_stat("foo.jpg", os.stat(image))
+    assert entry.matches(str(image))
+
+    os.utime(image, ns=(os.stat(image).st_atime_ns, os.stat(image).st_mtime_ns + 5_000))
+    assert not entry.matches(str(image))
+
+
+@pytest.mark.parametrize("backend", [CsvIndexStore, BinaryIndexStore])
+def test_stat_matches_in_repeated_hour(tmp_path, monkeypatch, backend):
+    """test a time in the hour repeated when daylight saving ends"""
+    if not hasattr(time, 'tzset'):
+        pytest.skip("time zones cannot be changed on this platform")
+    monkeypatch.setenv('TZ', 'Europe/London')
+    time.tzset()
+    try:
+        image = tmp_path / "foo.jpg"
+        image.write_bytes(b'foo')
+        # 01:30 GMT on 27 October 2024, after 01:30 BST the same night
+        os.utime(image, (1729992600, 1729992600))
+        backend.for_collection(str(tmp_path)).write(
+            [IndexEntry.from_stat("foo.jpg", os.stat(image))])
+        with open_store(str(tmp_path)) as store:
+            assert store.get("foo.jpg").matches(str(image))
+    finally:
+        monkeypatch.undo()
+        time.tzset()
@@ -0,0 +1,94 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+from imagectl.merkle import (DIFFERENT, EXTRA, MISSING, Difference, build_tree, diff_trees,
+                             load_tree, read_tree, update_tree, write_tree)
+from imagectl.metrics import reset_metrics
+from imagectl.models import IndexEntry
+from imagectl.storage import CsvIndexStore
+
+def entry(name: str, size: int = 100, hash: str = "a" * 32) -> IndexEntry:
+    return IndexEntry(name=name, created="2024-01-01T10:30:00",
+                      modified="2024-01-01T10:30:00", size=size, hash=hash)
+
+LIBRARY = [entry("top.jpg"), entry("2019/01/a.jpg"), entry("2019/02/b.jpg", 200),
+           entry("2020/c.jpg", 300, "c" * 32)]
+
+def stores(tmp_path, left, right):
+    (tmp_path / "left").mkdir()
+    (tmp_path / "right").mkdir()
+    ours = CsvIndexStore.for_collection(str(tmp_path / "left"))
+    theirs = CsvIndexStore.for_collection(str(tmp_path / "right"))
+    ours.write(left)
+    theirs.write(right)
+    return ours, theirs
+
+def test_tree_digests_roll_up():
+    tree = build_tree(LIBRARY)
+    assert sorted(tree.dirs) == ["", "2019", "2019/01", "2019/02", "2020"]
+    assert tree.get("").count == 4 and tree.get("2019").size == 300
+    assert tree.children("2019") == ["2019/01", "2019/02"]
+    # the digests depend on the content, not the order of the index
+    assert build_tree(reversed(LIBRARY)).dirs == tree.dirs
+
+    changed = build_tree(LIBRARY[:2] + [entry("2019/02/b.jpg", 201)] + LIBRARY[3:])
+    assert changed.get("").tree != tree.get("").tree
+    assert changed.get("2019").files == tree.get("2019").files
+    assert changed.get("2019/01") == tree.get("2019/01")
+    assert changed.get("2020") == tree.get("2020")
+
+def test_diff_descends_only_into_differences(tmp_path):
+    ours, theirs = stores(tmp_path, LIBRARY,
+                          LIBRARY[:2] + [entry("2019/02/b.jpg", 201), entry("2021/d.jpg")])
+    differences = list(diff_trees(load_tree(ours), load_tree(theirs), ours, theirs))
+    assert differences == [Difference(DIFFERENT, "2019/02/b.jpg", 1, 201),
+                           Difference(MISSING, "2020/", 1, 300),
+                           Difference(EXTRA, "2021/", 1, 100)]
+
+    # the same libraries read nothing below the root
+    assert list(diff_trees(load_tree(ours), load_tree(ours), ours, theirs)) == []
+
+def test_diff_reads_only_directories_whose_files_differ(tmp_path, monkeypatch):
+    ours, theirs = stores(tmp_path, LIBRARY,
+                          LIBRARY[:2] + [entry("2019/02/b.jpg", 201)] + LIBRARY[3:])
+    read = []
+    for store in (ours, theirs):
+        find = store.find_in_directory
+        monkeypatch.setattr(store, "find_in_directory",
+                            lambda path, find=find: read.append(path) or find(path))
+    metrics = reset_metrics()
+    assert len(list(diff_trees(load_tree(ours), load_tree(theirs), ours, theirs))) == 1
+    assert read == ["2019/02", "2019/02"]
+    assert metrics.stages["compare"].count == 1
+
+def test_saved_tree_is_discarded_when_index_changes(tmp_path):
+    ours, _ = stores(tmp_path, LIBRARY, [])
+    assert read_tree(ours) is None
+    saved = write_tree(ours)
+    assert read_tree(ours).dirs == saved.dirs
+    ours.write(LIBRARY[1:])
+    assert read_tree(ours) is None
+    assert load_tree(ours).get("").count == 3
+
+def test_update_tree_same_as_rebuilding(tmp_path):
+    ours, _ = stores(tmp_path, LIBRARY, [])
+    tree = build_tree(LIBRARY)
+    updated = LIBRARY[:1] + [entry("2019/02/b.jpg", 201), entry("2020/new/d.jpg", 50, "d" * 32)]
+    ours.write(updated)
+    tree = update_tree(tree, ours, ["2019/01", "2019/02", "2020", "2020/new"])
+    rebuilt = build_tree(updated)
+    assert tree.dirs == rebuilt.dirs and tree.algorithm == rebuilt.algorithm
+    assert tree.children("2020") == ["2020/new"]
@@ -0,0 +1,68 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import json
+import shutil
+
+import pytest
+
+from imagectl.__main__ import main
+from imagectl.metrics import BUCKETS, Metrics, reset_metrics
+from imagectl.transfer import copy_file
+
+def test_histogram_percentiles():
+    metrics = Metrics()
+    for _ in range(98):
+        metrics.add('hash', 0.001)
+    metrics.add('hash', 0.05)
+    metrics.add('hash', 100)
+    stage = metrics.stages['hash']
+    assert stage.count == 100
+    assert stage.percentile(0.5) == 0.0016
+    assert stage.percentile(0.99) == 0.1024
+    assert stage.buckets[-1] == 1
+
+def test_prometheus_groups_each_metric():
+    metrics = Metrics()
+    metrics.add('hash', 0.001, bytes=10)
+    metrics.add('copy', 0.002, bytes=20)
+    text = metrics.to_prometheus('index')
+    types = [line.split()[2] for line in text.splitlines() if line.startswith('# TYPE')]
+    families = [line.split('{')[0].removesuffix('_bucket').removesuffix('_sum').removesuffix('_count')
+                for line in text.splitlines() if not line.startswith('#')]
+    # every sample of a metric follows its TYPE line, together
+    assert [f for i, f in enumerate(families) if i == 0 or families[i - 1] != f] == types
+    assert 'imagectl_stage_seconds_bucket{command="index",stage="copy",le="+Inf"} 1' in text
+
+def test_shared_metrics_record_stages(tmp_path):
+    metrics = reset_metrics()
+    src = tmp_path / 'src.jpg'
+    src.write_bytes(b'x' * 100)
+    copy_file(str(src), str(tmp_path / 'dst.jpg'))
+    metrics.write(str(tmp_path / 'metrics.json'), 'organise')
+    stages = json.loads((tmp_path / 'metrics.json').read_text())['stages']
+    assert stages['copy']['count'] == 1
+    assert stages['copy']['bytes'] == 100
+    assert sum(stages['copy']['buckets'].values()) == 1
+    assert len(stages['copy']['buckets']) == len(BUCKETS) + 1
+
+@pytest.mark.parametrize('progress', [['--progress'], ['--progress-interval', '0.01']])
+def test_progress_before_command(tmp_path, progress):
+    shutil.copy('tests/resources/in/Bird.jpg', tmp_path / 'Bird.jpg')
+    main([*progress, '--metrics-out', str(tmp_path / 'metrics.json'),
+          'index', '-i', str(tmp_path)])
+    stages = json.loads((tmp_path / 'metrics.json').read_text())['stages']
+    assert stages['hash']['count'] == 1
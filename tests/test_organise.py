@@ -14,7 +14,13 @@
 #  the License.
 #
 ###############################################################################
+import argparse
+import os
+import shutil
+
+from imagectl.cmds.index import index_files, walk_library
 from imagectl.cmds.organise import OrganiserCommand
+from imagectl.storage import open_store
 
 
 def test_get_new_file_name_no_optimisations():
@@ -22,3 +28,57 @@ def test_get_new_file_name_no_optimisations():
 
 def test_get_new_file_name_avoid_dupe_date():
     assert OrganiserCommand.get_new_file_name("2025-01-03-foo.png", "2025", "01", "03") == "2025-01-03-foo.png"
+
+def organise(in_dir, out_dir, jobs, from_index=False):
+    cmd = OrganiserCommand(argparse.ArgumentParser().add_subparsers())
+    cmd.execute(argparse.Namespace(input=in_dir, output=str(out_dir), move=False, jobs=jobs,
+                                   link_mode="auto", from_index=from_index, verbose="WARNING"))
+    return sorted(str(p.relative_to(out_dir)) for p in out_dir.rglob('*') if p.is_file())
+
+def test_parallel_organise_same_as_serial(tmp_path):
+    in_dir = os.path.join("tests", "resources", "in")
+    serial = organise(in_dir, tmp_path / "serial", 1)
+    assert serial == [os.path.join("2012", "06", "2012-06-30-Bird copy.jpg"),
+                      os.path.join("2012", "06", "2012-06-30-Frog.jpg"),
+                      os.path.join("2012", "06", "2012-06-30-Gorilla.jpg"),
+                      os.path.join("2015", "10", "2015-10-16-Bird.jpg")]
+    assert organise(in_dir, tmp_path / "parallel", 3) == serial
+
+def test_organise_from_index_same_as_reading_images(tmp_path):
+    in_dir = tmp_path / "in"
+    shutil.copytree(os.path.join("tests", "resources", "in"), in_dir)
+    open_store(str(in_dir)).write(index_files(walk_library(str(in_dir))))
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    open_store(str(out_dir)).write([])
+    expected = organise(os.path.join("tests", "resources", "in"), tmp_path / "read", 1)
+    organised = [name for name in organise(str(in_dir), out_dir, 1, from_index=True)
+                 if not name.startswith(".")]
+    assert organised == expected
+    with open_store(str(out_dir)) as store:
+        assert sorted(e.name for e in store.entries()) == expected
+        assert store.get(expected[0]).taken.startswith("2012-06-30")
+
+def test_organise_from_index_keeps_files_the_index_does_not_know(tmp_path):
+    in_dir = tmp_path / "in"
+    shutil.copytree(os.path.join("tests", "resources", "in"), in_dir)
+    open_store(str(in_dir)).write(index_files(walk_library(str(in_dir))))
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    open_store(str(out_dir)).write([])
+    stranger = out_dir / "2012" / "06" / "2012-06-30-Frog.jpg"
+    stranger.parent.mkdir(parents=True)
+    shutil.copy(in_dir / "Gorilla.jpg", stranger)
+    organise(str(in_dir), out_dir, 1, from_index=True)
+    assert stranger.read_bytes() == (in_dir / "Gorilla.jpg").read_bytes()
+
+def test_organise_from_index_in_place_keeps_index(tmp_path):
+    lib = tmp_path / "lib"
+    organise(os.path.join("tests", "resources", "in"), lib, 1)
+    open_store(str(lib)).write(index_files(walk_library(str(lib))))
+    cmd = OrganiserCommand(argparse.ArgumentParser().add_subparsers())
+    cmd.execute(argparse.Namespace(input=str(lib), output=str(lib), move=True, jobs=1,
+                                   link_mode="auto", from_index=True, verbose="WARNING"))
+    with open_store(str(lib)) as store:
+        assert store.count() == 4
+    assert len([p for p in lib.rglob('*.jpg')]) == 4
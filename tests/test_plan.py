@@ -0,0 +1,89 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import argparse
+import os
+import shutil
+
+from imagectl.cmds.dedupe import DedupeCommand
+from imagectl.plan import (DELETE, SKIPPED, Action, apply_plan, journal_path,
+                           read_plan)
+
+RESOURCES = os.path.join("tests", "resources", "in")
+
+def options(tmp_path, **kwargs):
+    values = dict(reference=str(tmp_path / "ref"), target=str(tmp_path / "trgt"), exec=False,
+                  content=True, collection=None, link_mode="auto", plan=None, apply=None, jobs=2,
+                  verbose="WARNING")
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+def collections(tmp_path):
+    os.makedirs(tmp_path / "ref")
+    os.makedirs(tmp_path / "trgt" / "sub")
+    shutil.copy(os.path.join(RESOURCES, "Bird.jpg"), tmp_path / "ref" / "Bird.jpg")
+    shutil.copy(os.path.join(RESOURCES, "Bird.jpg"), tmp_path / "trgt" / "Robin.jpg")
+    shutil.copy(os.path.join(RESOURCES, "Frog.jpg"), tmp_path / "trgt" / "sub" / "Frog.jpg")
+
+def test_plan_then_apply(tmp_path):
+    collections(tmp_path)
+    plan = str(tmp_path / "dedupe.plan")
+    cmd = DedupeCommand(argparse.ArgumentParser().add_subparsers())
+    cmd.execute(options(tmp_path, plan=plan))
+    header, actions = read_plan(plan)
+    assert header["reference"] == str(tmp_path / "ref")
+    assert [(a.op, os.path.basename(a.source)) for a in actions] == \
+        [("delete", "Robin.jpg"), ("move", "Frog.jpg")]
+    assert os.path.exists(tmp_path / "trgt" / "Robin.jpg") # nothing done yet
+
+    cmd.execute(options(tmp_path, apply=plan))
+    assert not os.path.exists(tmp_path / "trgt" / "Robin.jpg")
+    assert os.path.exists(tmp_path / "ref" / "sub" / "Frog.jpg")
+    with open(journal_path(plan)) as f:
+        assert sorted(f.read().splitlines()) == ["0 applied", "1 applied"]
+
+def test_apply_resumes_and_verifies_before_deleting(tmp_path):
+    collections(tmp_path)
+    ref, trgt = tmp_path / "ref", tmp_path / "trgt"
+    shutil.copy(os.path.join(RESOURCES, "Frog.jpg"), ref / "Frog.jpg")
+    actions = [Action(op=DELETE, source=str(trgt / "sub" / "Frog.jpg"), size=os.path.getsize(ref / "Frog.jpg"),
+                      hash="8bfc29bb53cfa195b7b9c550dcc24cf7", keep=str(ref / "Frog.jpg")),
+               Action(op=DELETE, source=str(trgt / "Robin.jpg"), size=os.path.getsize(ref / "Bird.jpg"),
+                      hash="266e3e562393bde0fbe882361b491713", keep=str(ref / "Bird.jpg"))]
+    journal = str(tmp_path / "plan.journal")
+    with open(journal, "w") as f:
+        f.write("0 applied\n")
+    with open(ref / "Bird.jpg", "ab") as f:
+        f.write(b"changed")
+    assert apply_plan(actions, journal=journal)[SKIPPED] == 1
+    assert os.path.exists(trgt / "sub" / "Frog.jpg") # already in the journal
+    assert os.path.exists(trgt / "Robin.jpg") # the copy kept no longer matches
+
+def test_consolidate_collections(tmp_path):
+    collections(tmp_path)
+    os.makedirs(tmp_path / "drive")
+    shutil.copy(os.path.join(RESOURCES, "Frog.jpg"), tmp_path / "drive" / "Frog.jpg")
+    shutil.copy(os.path.join(RESOURCES, "Gorilla.jpg"), tmp_path / "drive" / "Bird.jpg")
+    cmd = DedupeCommand(argparse.ArgumentParser().add_subparsers())
+    cmd.execute(options(tmp_path, content=False, collection=[str(tmp_path / "drive")], exec=True))
+
+    ref = tmp_path / "ref"
+    remaining = sorted(str(p.relative_to(tmp_path)) for p in tmp_path.rglob("*.jpg"))
+    # one copy of each file, all in the reference, the clashing name renamed
+    assert len(remaining) == 3
+    assert all(name.startswith("ref") for name in remaining)
+    assert os.path.exists(ref / "sub" / "Frog.jpg")
+    assert len([name for name in remaining if name.startswith(os.path.join("ref", "Bird."))]) == 2
@@ -0,0 +1,86 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import os
+import shutil
+import threading
+
+import pytest
+
+from imagectl.cmds.index import index_files, walk_library
+from imagectl.server import Client, IndexServer, Library, make_server, remove_socket
+from imagectl.storage import open_store
+
+def indexed_library(tmp_path):
+    base = tmp_path / "lib"
+    shutil.copytree(os.path.join("tests", "resources", "in"), base)
+    entries = list(index_files(walk_library(str(base))))
+    open_store(str(base)).write(entries)
+    return str(base), {e.name: e for e in entries}
+
+def test_reload_applies_only_changes(tmp_path):
+    base, entries = indexed_library(tmp_path)
+    library = Library(base)
+    assert library.reload()
+    assert not library.reload()
+    assert library.find_by_name("Frog.jpg")[0]["hash"] == entries["Frog.jpg"].hash
+
+    changed = entries["Frog.jpg"].model_copy(update={"name": "Toad.jpg"})
+    assert library.apply((e.name, e.size, e.hash) for e in
+                         [changed, entries["Bird.jpg"], entries["Gorilla.jpg"]]) == (1, 2)
+    assert library.find_by_name("Frog.jpg") == []
+    assert [m["name"] for m in library.find_by_hash(changed.hash)] == ["Toad.jpg"]
+    assert entries["Bird copy.jpg"].size not in library.sizes
+
+def test_queries_over_socket(tmp_path):
+    base, entries = indexed_library(tmp_path)
+    library = Library(base)
+    library.reload()
+    address = str(tmp_path / "imagectl.sock")
+    with make_server(IndexServer([library]), address) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with Client(address) as client:
+                frog = entries["Frog.jpg"]
+                assert client.query("has", hash=frog.hash) == {"found": True}
+                assert client.query("has", hash="0" * 32) == {"found": False}
+                assert [m["name"] for m in client.query("lookup", hash=frog.hash)["matches"]] \
+                       == ["Frog.jpg"]
+                assert client.query("name", name="Frog.jpg")["matches"][0]["size"] == frog.size
+                copy = shutil.copy(os.path.join(base, "Frog.jpg"), tmp_path / "new.jpg")
+                assert [m["name"] for m in client.query("file", path=str(copy))["matches"]] \
+                       == ["Frog.jpg"]
+                results = client.query("batch", requests=[{"op": "has", "hash": frog.hash},
+                                                          {"op": "nope"}])["results"]
+                assert results[0] == {"found": True} and "error" in results[1]
+                assert client.query("stats")["collections"][0]["entries"] == len(entries)
+        finally:
+            server.shutdown()
+
+def test_only_sockets_are_replaced_or_removed(tmp_path):
+    index = tmp_path / ".imagectl"
+    index.write_text("NAME\n")
+    with pytest.raises(ValueError):
+        make_server(IndexServer([]), str(index))
+    assert index.exists()
+
+    address = str(tmp_path / "imagectl.sock")
+    server = make_server(IndexServer([]), address)
+    server.server_close()
+    os.remove(address)
+    os.rename(index, address) # something else now has the name
+    remove_socket(server)
+    assert os.path.exists(address)
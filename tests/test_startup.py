@@ -0,0 +1,61 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import subprocess
+import sys
+
+import pytest
+
+from imagectl.cmds import COMMANDS
+
+RUN_CLI = """
+import sys
+from imagectl.__main__ import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+print('\\n'.join(sys.modules), file=sys.stderr)
+"""
+
+def imported_by(*args):
+    """returns the modules imported starting the cli with args, in a fresh
+       interpreter as this one has imported everything already"""
+    result = subprocess.run([sys.executable, '-c', RUN_CLI] + list(args),
+                            capture_output=True, text=True)
+    return set(result.stderr.splitlines())
+
+def test_help_imports_no_commands():
+    modules = imported_by('--help')
+    assert 'imagectl.cmds.index' not in modules
+    for heavy in ('pydantic', 'PIL', 'pillow_heif', 'numpy', 'importlib.metadata', 'sqlite3'):
+        assert heavy not in modules
+
+@pytest.mark.parametrize('cmd', sorted(COMMANDS))
+def test_command_imports_no_image_libraries(cmd):
+    modules = imported_by(cmd, '--help')
+    assert f'imagectl.cmds.{cmd}' in modules
+    if cmd != 'organise':
+        assert 'imagectl.cmds.organise' not in modules
+    for heavy in ('PIL', 'pillow_heif', 'numpy'):
+        assert heavy not in modules
+
+def test_command_run_by_another_is_loaded_on_demand():
+    from imagectl.__main__ import CommandRegistry
+    commands = CommandRegistry()
+    assert commands['verify'].NAME == 'verify'
+    with pytest.raises(KeyError):
+        commands['nonexistent']
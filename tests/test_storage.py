@@ -0,0 +1,125 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import pytest
+
+from imagectl.models import IndexEntry
+from imagectl.storage import BinaryIndexStore, CsvIndexStore, SqliteIndexStore, open_store
+
+ENTRIES = [
+    IndexEntry(name="2024/foo,bar.jpg", created="2024-01-01T10:30:00",
+               modified="2024-01-01T10:30:00", size=1024, hash="a" * 32),
+    IndexEntry(name="2024/baz.jpg", created="2024-01-02T10:30:00",
+               modified="2024-01-02T10:30:00", size=2048, hash="b" * 32),
+    IndexEntry(name="baz.jpg", created="2024-01-02T10:30:00",
+               modified="2024-01-02T10:30:00", size=2048, hash="b" * 32),
+]
+
+@pytest.mark.parametrize("backend", [CsvIndexStore, SqliteIndexStore, BinaryIndexStore])
+def test_write_and_lookup(tmp_path, backend):
+    with backend.for_collection(str(tmp_path)) as store:
+        store.write(ENTRIES)
+        assert sorted(e.name for e in store.entries()) == sorted(e.name for e in ENTRIES)
+        assert store.get("2024/foo,bar.jpg").size == 1024
+        assert store.get("missing.jpg") is None
+        assert [e.name for e in store.find_by_hash("b" * 32)] == ["2024/baz.jpg", "baz.jpg"]
+        assert [e.name for e in store.find_by_size(1024)] == ["2024/foo,bar.jpg"]
+
+@pytest.mark.parametrize("backend", [CsvIndexStore, SqliteIndexStore, BinaryIndexStore])
+def test_upsert_and_remove(tmp_path, backend):
+    with backend.for_collection(str(tmp_path)) as store:
+        store.write(ENTRIES[:2])
+        changed = ENTRIES[0].model_copy(update={"size": 4096})
+        store.upsert([changed, ENTRIES[2]])
+        assert store.count() == 3
+        assert store.get(changed.name).size == 4096
+        store.remove(["baz.jpg"])
+        assert store.get("baz.jpg") is None
+
+def test_csv_sqlite_round_trip(tmp_path):
+    csv = CsvIndexStore.for_collection(str(tmp_path))
+    csv.write(ENTRIES)
+    with SqliteIndexStore.for_collection(str(tmp_path)) as db:
+        db.write(csv.entries())
+        assert open_store(str(tmp_path)).path == db.path
+        csv.write(db.entries())
+    assert [e.model_dump() for e in csv.entries()] == [e.model_dump() for e in ENTRIES]
+
+def test_binary_round_trip(tmp_path):
+    with BinaryIndexStore.for_collection(str(tmp_path)) as store:
+        entries = ENTRIES + [ENTRIES[1].model_copy(update={"name": "ünïcode.jpg",
+                                                           "phash": "dhash:0123456789abcdef"})]
+        store.write(entries)
+        assert [e.name for e in store.entries()] == sorted(e.name for e in entries)
+        for entry in entries:
+            assert store.get(entry.name).model_dump() == entry.model_dump()
+
+@pytest.mark.parametrize("backend", [CsvIndexStore, SqliteIndexStore, BinaryIndexStore])
+def test_interrupted_write_resumes(tmp_path, backend):
+    with backend.for_collection(str(tmp_path)) as store:
+        store.write(ENTRIES[:1])
+        with pytest.raises(KeyboardInterrupt):
+            with store.writer() as writer:
+                writer.add(ENTRIES[1])
+                raise KeyboardInterrupt()
+        # the old index is untouched until the new one is complete
+        assert [e.name for e in store.entries()] == [ENTRIES[0].name]
+
+        with store.writer(resume=True) as writer:
+            assert writer.done == {ENTRIES[1].name}
+            writer.add(ENTRIES[2])
+        assert sorted(e.name for e in store.entries()) == sorted(e.name for e in ENTRIES[1:])
+
+def test_resume_drops_incomplete_line(tmp_path):
+    store = CsvIndexStore.for_collection(str(tmp_path))
+    with open(store.path + '.partial', 'w') as partial:
+        partial.write(CsvIndexStore.HEADER + ENTRIES[0].model_dump() + 'baz.jpg,2024-01')
+    with store.writer(resume=True) as writer:
+        assert writer.done == {ENTRIES[0].name}
+        writer.add(ENTRIES[2])
+    assert [e.name for e in store.entries()] == [ENTRIES[0].name, ENTRIES[2].name]
+
+def test_other_writes_keep_partial_index(tmp_path):
+    store = CsvIndexStore.for_collection(str(tmp_path))
+    store.write(ENTRIES[:1])
+    with open(store.path + '.partial', 'w') as partial:
+        partial.write(CsvIndexStore.HEADER + ENTRIES[1].model_dump())
+    store.upsert(ENTRIES[2:])
+    store.remove([ENTRIES[0].name])
+    with store.writer(resume=True) as writer:
+        assert writer.done == {ENTRIES[1].name}
+
+@pytest.mark.parametrize("backend", [CsvIndexStore, SqliteIndexStore, BinaryIndexStore])
+def test_find_in_directory(tmp_path, backend):
+    with backend.for_collection(str(tmp_path)) as store:
+        store.write(ENTRIES + [ENTRIES[1].model_copy(update={"name": "2024/01/qux.jpg"}),
+                               ENTRIES[1].model_copy(update={"name": "2024-01.jpg"})])
+        assert sorted(e.name for e in store.find_in_directory("2024")) == \
+            ["2024/baz.jpg", "2024/foo,bar.jpg"]
+        assert sorted(e.name for e in store.find_in_directory("")) == ["2024-01.jpg", "baz.jpg"]
+        assert [e.name for e in store.find_in_directory("2024/01")] == ["2024/01/qux.jpg"]
+        assert list(store.find_in_directory("2023")) == []
+
+@pytest.mark.parametrize("backend", [CsvIndexStore, SqliteIndexStore, BinaryIndexStore])
+def test_metadata_round_trip(tmp_path, backend):
+    dated = ENTRIES[0].model_copy(update={"taken": "2012-06-30T14:05:09", "width": 640,
+                                          "height": 480, "model": "Canon, EOS 5D", "orientation": 6})
+    with backend.for_collection(str(tmp_path)) as store:
+        store.write([dated, ENTRIES[1]])
+        entry = store.get(dated.name)
+        assert (entry.taken, entry.width, entry.height, entry.model, entry.orientation) == \
+               ("2012-06-30T14:05:09", 640, 480, "Canon, EOS 5D", 6)
+        assert not store.get(ENTRIES[1].name).has_metadata()
@@ -0,0 +1,76 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import os
+import shutil
+
+from imagectl.hashing import get_hash
+from imagectl.models import IndexEntry, line_name, read_index_sorted
+from imagectl.plan import APPLIED, COPY, SKIPPED, Action, apply_action
+from imagectl.storage import CsvIndexStore, SqliteIndexStore
+from imagectl.sync import (ADDED, MODIFIED, REMOVED, RENAMED, UNCHANGED, Change, diff_indexes,
+                           diff_rows)
+
+def entry(name: str, size: int = 100, hash: str = "a" * 32) -> IndexEntry:
+    return IndexEntry(name=name, created="2024-01-01T10:30:00",
+                      modified="2024-01-01T10:30:00", size=size, hash=hash)
+
+def test_read_index_sorted_in_runs(tmp_path):
+    names = ["b.jpg", "a b.jpg", "a,b.jpg", "2019/z.jpg", "a%.jpg", "a.jpg", "é.jpg"]
+    store = CsvIndexStore.for_collection(str(tmp_path))
+    store.write(entry(name) for name in names)
+    assert [line_name(line) for line in read_index_sorted(store.path, run_size=2)] == sorted(names)
+    assert [e.name for e in store.entries_by_name()] == sorted(names)
+
+def test_diff_indexes(tmp_path):
+    (tmp_path / "source").mkdir()
+    (tmp_path / "target").mkdir()
+    source = CsvIndexStore.for_collection(str(tmp_path / "source"))
+    target = SqliteIndexStore.for_collection(str(tmp_path / "target"))
+    source.write([entry("same.jpg"), entry("new.jpg", 200, "b" * 32),
+                  entry("2019/edited.jpg", 300, "c" * 32), entry("2019/moved here.jpg", 400, "d" * 32)])
+    with target:
+        target.write([entry("same.jpg"), entry("2019/edited.jpg", 300, "e" * 32),
+                      entry("2020/moved.jpg", 400, "d" * 32), entry("gone.jpg", 500, "f" * 32)])
+        changes = sorted(diff_indexes(source, target))
+    assert changes == [Change(ADDED, "new.jpg", 200, "b" * 32),
+                       Change(MODIFIED, "2019/edited.jpg", 300, "c" * 32),
+                       Change(REMOVED, "gone.jpg", 500, "f" * 32),
+                       Change(RENAMED, "2019/moved here.jpg", 400, "d" * 32, "2020/moved.jpg"),
+                       Change(UNCHANGED, "same.jpg", 100, "a" * 32)]
+
+def test_diff_rows_matches_renames_in_runs():
+    source = [("a,new.jpg", 100, "a" * 32), ("b.jpg", 100, ""), ("copy 1.jpg", 200, "c" * 32),
+              ("copy 2.jpg", 200, "c" * 32), ("d.jpg", 300, "d" * 32)]
+    target = [("e.jpg", 100, ""), ("old 1.jpg", 200, "c" * 32), ("old 2.jpg", 200, "c" * 32),
+              ("old%.jpg", 100, "a" * 32), ("z.jpg", 300, "f" * 32)]
+    assert sorted(diff_rows(source, target, run_size=2)) == [
+        Change(ADDED, "b.jpg", 100, ""),
+        Change(ADDED, "d.jpg", 300, "d" * 32),
+        Change(REMOVED, "e.jpg", 100, ""),
+        Change(REMOVED, "z.jpg", 300, "f" * 32),
+        Change(RENAMED, "a,new.jpg", 100, "a" * 32, "old%.jpg"),
+        Change(RENAMED, "copy 1.jpg", 200, "c" * 32, "old 1.jpg"),
+        Change(RENAMED, "copy 2.jpg", 200, "c" * 32, "old 2.jpg")]
+
+def test_copy_action_replaces_dest_once(tmp_path):
+    source = os.path.join("tests", "resources", "in", "Frog.jpg")
+    shutil.copy(os.path.join("tests", "resources", "in", "Bird.jpg"), tmp_path / "Frog.jpg")
+    action = Action(op=COPY, source=source, size=os.path.getsize(source), hash=get_hash(source),
+                    dest=str(tmp_path / "Frog.jpg"))
+    assert apply_action(action) == APPLIED
+    assert get_hash(str(tmp_path / "Frog.jpg")) == action.hash
+    assert apply_action(action) == SKIPPED
@@ -0,0 +1,70 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import os
+import shutil
+
+import pytest
+
+from imagectl.transfer import AUTO, copy_file, move_file
+
+FROG = os.path.join("tests", "resources", "in", "Frog.jpg")
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / "Frog.jpg"
+    shutil.copy2(FROG, path)
+    return str(path)
+
+def test_auto_copy_keeps_content_and_times(src, tmp_path):
+    dst = str(tmp_path / "copy.jpg")
+    assert copy_file(src, dst) in AUTO
+    with open(src, 'rb') as a, open(dst, 'rb') as b:
+        assert a.read() == b.read()
+    assert os.stat(dst).st_mtime_ns == os.stat(src).st_mtime_ns
+    assert not os.path.samefile(src, dst)
+
+@pytest.mark.parametrize("mode", ["copy", "hardlink"])
+def test_copy_modes_overwrite_existing(src, tmp_path, mode):
+    dst = tmp_path / "copy.jpg"
+    dst.write_bytes(b'old')
+    assert copy_file(src, str(dst), mode) == mode
+    assert dst.stat().st_size == os.stat(src).st_size
+
+def test_hardlink_shares_inode(src, tmp_path):
+    dst = str(tmp_path / "link.jpg")
+    copy_file(src, dst, "hardlink")
+    assert os.path.samefile(src, dst)
+
+def test_move_file_renames(src, tmp_path):
+    dst = str(tmp_path / "moved.jpg")
+    assert move_file(src, dst) == "rename"
+    assert not os.path.exists(src) and os.path.exists(dst)
+
+def test_unknown_mode(src, tmp_path):
+    with pytest.raises(ValueError):
+        copy_file(src, str(tmp_path / "copy.jpg"), "teleport")
+
+@pytest.mark.parametrize("mode", ["auto", "copy"])
+def test_copy_onto_itself_keeps_the_file(src, tmp_path, mode):
+    link = str(tmp_path / "link.jpg")
+    os.link(src, link)
+    for dst in (src, link):
+        with pytest.raises(shutil.SameFileError):
+            copy_file(src, dst, mode)
+    with open(src, 'rb') as a, open(FROG, 'rb') as b:
+        assert a.read() == b.read()
+    assert os.path.samefile(src, link)
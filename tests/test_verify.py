@@ -0,0 +1,97 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import argparse
+import os
+import shutil
+
+from imagectl import aio
+from imagectl.cmds.index import index_files, walk_library
+from imagectl.cmds.verify import (CHANGED, CORRUPT, MISSING, UNDECODABLE, VERIFIED, Sampler,
+                                  VerifyCommand)
+from imagectl.models import IndexEntry
+from imagectl.scrub import DecodedCache
+from imagectl.storage import open_store
+
+def test_rotating_sample_covers_every_entry():
+    entries = [IndexEntry(name=f"{i}.jpg", created="", modified="", size=0) for i in range(200)]
+    seen = set()
+    for day in range(4):
+        sample = Sampler(0.25, day=day)
+        seen.update(e.name for e in entries if sample(e))
+    assert len(seen) == len(entries)
+    assert not any(Sampler(0)(e) for e in entries)
+
+def test_check(tmp_path):
+    shutil.copytree(os.path.join("tests", "resources", "in"), tmp_path, dirs_exist_ok=True)
+    entries = {e.name: e for e in index_files(walk_library(str(tmp_path)))}
+    assert VerifyCommand.check(str(tmp_path), entries["Frog.jpg"], False) == VERIFIED
+    assert VerifyCommand.check(str(tmp_path), entries["Frog.jpg"], True) == VERIFIED
+
+    os.utime(tmp_path / "Gorilla.jpg", (1_600_000_000, 1_600_000_000))
+    assert VerifyCommand.check(str(tmp_path), entries["Gorilla.jpg"], False) == CHANGED
+
+    with open(tmp_path / "Bird.jpg", "r+b") as f:
+        f.write(b'rot')
+    assert VerifyCommand.check(str(tmp_path), entries["Bird.jpg"], False) == CORRUPT
+
+    os.remove(tmp_path / "Frog.jpg")
+    assert VerifyCommand.check(str(tmp_path), entries["Frog.jpg"], False) == MISSING
+
+def test_check_async(tmp_path):
+    shutil.copytree(os.path.join("tests", "resources", "in"), tmp_path, dirs_exist_ok=True)
+    entries = list(index_files(walk_library(str(tmp_path))))
+    os.remove(tmp_path / "Frog.jpg")
+    checks = [(str(tmp_path), e, e.name == "Bird.jpg") for e in entries]
+
+    async def check_all(engine):
+        return [result async for result in VerifyCommand.check_async(engine, checks)]
+    results = {entry.name: (audit, state) for entry, audit, state in aio.run(check_all, io_depth=1)}
+    assert results == {e.name: (audit, VerifyCommand.check(base_dir, e, audit))
+                       for base_dir, e, audit in checks}
+    assert results["Frog.jpg"] == (False, MISSING)
+
+def test_decode_finds_truncated_images_and_caches_passes(tmp_path):
+    shutil.copytree(os.path.join("tests", "resources", "in"), tmp_path / "in")
+    shutil.copy(tmp_path / "in" / "Gorilla.jpg", tmp_path / "in" / "Gorilla copy.jpg")
+    entries = list(index_files(walk_library(str(tmp_path / "in"))))
+    with open(tmp_path / "in" / "Frog.jpg", "r+b") as f:
+        f.truncate(os.path.getsize(tmp_path / "in" / "Frog.jpg") // 2)
+    files = [(e.name, e.hash, e.size) for e in entries]
+    cache = str(tmp_path / "decoded.db")
+
+    failures = []
+    decoded, known = VerifyCommand.decode(str(tmp_path / "in"), files, 2, failures, cache)
+    # the copy of Gorilla.jpg has the same hash so is decoded once
+    assert (decoded, known) == (4, 0)
+    assert [(f["name"], f["state"]) for f in failures] == [("Frog.jpg", UNDECODABLE)]
+
+    failures = []
+    assert VerifyCommand.decode(str(tmp_path / "in"), files, 2, failures, cache) == (1, 4)
+    assert [f["name"] for f in failures] == ["Frog.jpg"]
+
+def test_decode_only_files_with_their_indexed_hash(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    shutil.copytree(os.path.join("tests", "resources", "in"), tmp_path / "in")
+    open_store(str(tmp_path / "in")).write(index_files(walk_library(str(tmp_path / "in"))))
+    os.utime(tmp_path / "in" / "Gorilla.jpg", (1_600_000_000, 1_600_000_000))
+    cmd = VerifyCommand(argparse.ArgumentParser().add_subparsers())
+    cmd.execute(argparse.Namespace(input=str(tmp_path / "in"), jobs=1, sample=0,
+                                   sample_mode="rotating", use_async=False, io_depth=1,
+                                   decode=True, decode_jobs=1, report=None, verbose="WARNING"))
+    with DecodedCache() as cache:
+        decoded = {e.name: e.hash in cache for e in open_store(str(tmp_path / "in")).entries()}
+    assert decoded["Frog.jpg"] and not decoded["Gorilla.jpg"]
@@ -0,0 +1,123 @@
+###############################################################################
+# Copyright 2024 Tim Stephenson and contributors
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#  use this file except in compliance with the License.  You may obtain a copy
+#  of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations under
+#  the License.
+#
+###############################################################################
+import argparse
+import os
+import shutil
+import time
+
+import pytest
+
+from imagectl.cmds.watch import WatchCommand
+from imagectl.merkle import build_tree, read_tree
+from imagectl.storage import open_store
+from imagectl.watcher import Changes, InotifyWatcher, PollingWatcher
+
+RESOURCES = os.path.join("tests", "resources", "in")
+
+def options(in_dir, out_dir=None):
+    return argparse.Namespace(input=str(in_dir), output=None if out_dir is None else str(out_dir),
+                              move=False, link_mode="auto", algorithm="md5", jobs=2,
+                              backend=None, perceptual=None, verbose="WARNING")
+
+def library(tmp_path):
+    in_dir = tmp_path / "in"
+    os.makedirs(in_dir / "2015")
+    shutil.copy(os.path.join(RESOURCES, "Bird.jpg"), in_dir / "Bird.jpg")
+    shutil.copy(os.path.join(RESOURCES, "Frog.jpg"), in_dir / "2015" / "Frog.jpg")
+    return in_dir
+
+def test_inotify_batches_changes(tmp_path):
+    in_dir = library(tmp_path)
+    try:
+        watcher = InotifyWatcher(str(in_dir))
+    except OSError:
+        pytest.skip("inotify is not available")
+    with watcher:
+        shutil.copy(os.path.join(RESOURCES, "Gorilla.jpg"), in_dir / "Gorilla.jpg")
+        os.rename(in_dir / "Bird.jpg", in_dir / "Robin.jpg")
+        shutil.rmtree(in_dir / "2015")
+        os.makedirs(in_dir / "2016")
+        (in_dir / "notes.txt").write_text("ignored")
+        changes = next(watcher.batches(debounce=0.1))
+    assert changes.files == {"Gorilla.jpg", "Bird.jpg", "Robin.jpg",
+                             os.path.join("2015", "Frog.jpg")}
+    assert changes.renamed == {"Robin.jpg": "Bird.jpg"}
+    assert changes.dirs == {"2016"}
+    assert "2015" in changes.removed_dirs
+
+def test_polling_finds_renames_by_inode(tmp_path):
+    in_dir = library(tmp_path)
+    watcher = PollingWatcher(str(in_dir), interval=0.01)
+    os.rename(in_dir / "Bird.jpg", in_dir / "Robin.jpg")
+    changes = next(watcher.batches(debounce=0.01))
+    assert changes.files == {"Bird.jpg", "Robin.jpg"}
+    assert changes.renamed == {"Robin.jpg": "Bird.jpg"}
+
+def test_apply_updates_index_in_place(tmp_path):
+    in_dir = library(tmp_path)
+    cmd = WatchCommand(argparse.ArgumentParser().add_subparsers())
+    with open_store(str(in_dir)) as store:
+        cmd.apply(cmd.full_scan(str(in_dir), store), store, options(in_dir))
+        bird = store.get("Bird.jpg")
+        assert store.count() == 2
+
+        os.rename(in_dir / "Bird.jpg", in_dir / "Robin.jpg")
+        os.remove(in_dir / "2015" / "Frog.jpg")
+        shutil.copy(os.path.join(RESOURCES, "Gorilla.jpg"), in_dir / "Gorilla.jpg")
+        changes = Changes()
+        changes.files.update({"Bird.jpg", "Robin.jpg", os.path.join("2015", "Frog.jpg"),
+                              "Gorilla.jpg"})
+        changes.renamed["Robin.jpg"] = "Bird.jpg"
+        cmd.apply(changes, store, options(in_dir))
+
+        assert sorted(entry.name for entry in store.entries()) == ["Gorilla.jpg", "Robin.jpg"]
+        assert store.get("Robin.jpg").hash == bird.hash
+
+def test_apply_organises_new_images(tmp_path):
+    in_dir = library(tmp_path)
+    out_dir = tmp_path / "out"
+    cmd = WatchCommand(argparse.ArgumentParser().add_subparsers())
+    with open_store(str(in_dir)) as store:
+        cmd.apply(cmd.full_scan(str(in_dir), store), store, options(in_dir, out_dir))
+    assert sorted(str(p.relative_to(out_dir)) for p in out_dir.rglob('*') if p.is_file()) == \
+        [os.path.join("2012", "06", "2012-06-30-Frog.jpg"),
+         os.path.join("2015", "10", "2015-10-16-Bird.jpg")]
+
+def test_batches_wait_for_interval(tmp_path):
+    in_dir = library(tmp_path)
+    watcher = PollingWatcher(str(in_dir), interval=0.01)
+    batches = watcher.batches(debounce=0.01, interval=0.3)
+    os.rename(in_dir / "Bird.jpg", in_dir / "Robin.jpg")
+    next(batches)
+    os.rename(in_dir / "Robin.jpg", in_dir / "Wren.jpg")
+    start = time.monotonic()
+    assert "Wren.jpg" in next(batches).files
+    assert time.monotonic() - start >= 0.25
+
+def test_apply_keeps_directory_digests_current(tmp_path):
+    in_dir = library(tmp_path)
+    cmd = WatchCommand(argparse.ArgumentParser().add_subparsers())
+    with open_store(str(in_dir)) as store:
+        cmd.apply(cmd.full_scan(str(in_dir), store), store, options(in_dir))
+        os.makedirs(in_dir / "2016" / "06")
+        shutil.copy(os.path.join(RESOURCES, "Gorilla.jpg"), in_dir / "2016" / "06" / "Gorilla.jpg")
+        os.remove(in_dir / "2015" / "Frog.jpg")
+        changes = Changes()
+        changes.files.update({os.path.join("2016", "06", "Gorilla.jpg"),
+                              os.path.join("2015", "Frog.jpg")})
+        cmd.apply(changes, store, options(in_dir))
+        assert read_tree(store).dirs == build_tree(store.entries()).dirs